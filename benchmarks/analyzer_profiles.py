@@ -0,0 +1,173 @@
+# This file is part of the Etsin service
+#
+# Copyright 2017-2021 Ministry of Education and Culture, Finland
+#
+# :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# :license: MIT
+
+"""
+Benchmark the analyzer profiles in elastic/resources/analyzer_profiles against the configured Elasticsearch.
+
+For every profile a separate benchmark index is created, a fixed synthetic corpus is bulk indexed into it and a
+standard set of Etsin style queries is run against it. Reported per profile: index size in bytes after force merge,
+indexing throughput in docs/sec and query latency percentiles. The benchmark indices are deleted afterwards.
+
+The dataset mapping does not reference the profile analyzers by itself, so by default the benchmark adds an 'ngram'
+subfield analyzed with the profile analyzers to title and description. This is the cost that using the analyzers
+at index time would have. Use ngram_text_fields=no to measure the plain mapping.
+
+Run from the repository root:
+    python -m benchmarks.analyzer_profiles [documents=5000] [repeat=20] [profiles=ngram,edge_ngram,standard]
+        [ngram_text_fields=yes] [output=results.json]
+"""
+
+import json
+import sys
+from time import perf_counter
+
+from benchmarks.synthetic_corpus import generate_es_documents, query_terms
+from etsin_finder_search.elastic.domain.es_dataset_data_model import ESDatasetModel
+from etsin_finder_search.elastic.service.es_service import ElasticSearchService
+from etsin_finder_search.utils import get_elasticsearch_config
+
+BENCHMARK_INDEX_PREFIX = 'metax-benchmark-'
+FREE_TEXT_FIELDS = ['title.*', 'description.*', 'keyword', 'creator_name', 'organization_name_en',
+                    'organization_name_fi', 'project_name_en', 'project_name_fi']
+NGRAM_TEXT_FIELDS = ['title.*.ngram', 'description.*.ngram']
+
+
+def etsin_queries(term, ngram_text_fields):
+    """
+    Queries resembling the ones Etsin dataset search sends
+
+    :return: Dict of query name to query body
+    """
+    fields = FREE_TEXT_FIELDS + (NGRAM_TEXT_FIELDS if ngram_text_fields else [])
+    free_text = {'multi_match': {'query': term, 'fields': fields, 'type': 'best_fields', 'operator': 'or'}}
+    return {
+        'free_text': {'query': free_text, 'size': 20},
+        'free_text_with_aggregations': {
+            'query': free_text,
+            'size': 20,
+            'aggs': {
+                'organization': {'terms': {'field': 'organization_name_en.keyword', 'size': 10}},
+                'access_type': {'terms': {'field': 'access_rights.access_type.pref_label.en.keyword', 'size': 10}},
+                'field_of_science': {'terms': {'field': 'field_of_science.pref_label.en.keyword', 'size': 10}},
+                'keyword': {'terms': {'field': 'all_keywords_en', 'size': 10}},
+            }
+        },
+        'partial_word': {
+            'query': {'multi_match': {'query': term[:4], 'fields': fields}},
+            'size': 20
+        },
+        'latest_datasets': {'query': {'match_all': {}}, 'sort': [{'date_modified': 'desc'}], 'size': 20},
+    }
+
+
+def benchmark_mapping(ngram_text_fields):
+    mapping = ElasticSearchService._get_json_file_as_str(ElasticSearchService.INDEX_DOC_TYPE_MAPPING_FILENAME)
+    if ngram_text_fields:
+        analyzers = {'title': 'etsin_ngram_analyzer', 'description': 'etsin_long_ngram_analyzer'}
+        for template in mapping['dynamic_templates']:
+            for name, definition in template.items():
+                if name in analyzers:
+                    definition['mapping']['fields']['ngram'] = {'type': 'text', 'analyzer': analyzers[name]}
+    return mapping
+
+
+def percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100.0 * (len(ordered) - 1))))]
+
+
+def benchmark_profile(es_config, profile, documents, terms, repeat, ngram_text_fields):
+    es_client = ElasticSearchService(dict(es_config, ANALYZER_PROFILE=profile))
+    es_client.INDEX_NAME = BENCHMARK_INDEX_PREFIX + profile
+    es = es_client.es
+
+    es_client.delete_index()
+    es.indices.create(index=es_client.INDEX_NAME, body=ElasticSearchService.get_index_definition(profile))
+    es.indices.put_mapping(index=es_client.INDEX_NAME, doc_type=es_client.INDEX_DOC_TYPE_NAME,
+                           body=benchmark_mapping(ngram_text_fields))
+
+    try:
+        models = [ESDatasetModel(doc) for doc in documents]
+        start = perf_counter()
+        es_client.do_bulk_request_for_datasets(models, [])
+        es.indices.refresh(index=es_client.INDEX_NAME)
+        indexing_time = perf_counter() - start
+
+        es.indices.forcemerge(index=es_client.INDEX_NAME, max_num_segments=1)
+        stats = es.indices.stats(index=es_client.INDEX_NAME, metric='store')
+        index_bytes = stats['indices'][es_client.INDEX_NAME]['primaries']['store']['size_in_bytes']
+
+        latencies = {}
+        for _ in range(repeat):
+            for term in terms:
+                for query_name, body in etsin_queries(term, ngram_text_fields).items():
+                    start = perf_counter()
+                    es.search(index=es_client.INDEX_NAME, body=body)
+                    latencies.setdefault(query_name, []).append((perf_counter() - start) * 1000)
+    finally:
+        es_client.delete_index()
+
+    return {
+        'profile': profile,
+        'documents': len(documents),
+        'index_bytes': index_bytes,
+        'docs_per_sec': round(len(documents) / indexing_time, 1),
+        'query_latency_ms': {
+            name: {'p50': round(percentile(values, 50), 2), 'p95': round(percentile(values, 95), 2)}
+            for name, values in latencies.items()
+        }
+    }
+
+
+def print_results(results):
+    print('{0:<12} {1:>10} {2:>14} {3:>12}'.format('profile', 'docs/sec', 'index bytes', 'documents'))
+    for result in results:
+        print('{0:<12} {1:>10} {2:>14} {3:>12}'.format(
+            result['profile'], result['docs_per_sec'], result['index_bytes'], result['documents']))
+
+    print('\nQuery latency p50 / p95 (ms)')
+    for result in results:
+        for name, latency in sorted(result['query_latency_ms'].items()):
+            print('{0:<12} {1:<28} {2:>8} / {3:>8}'.format(result['profile'], name, latency['p50'], latency['p95']))
+
+
+def main():
+    instructions = """\nRun the program from the repository root using 'python -m benchmarks.analyzer_profiles
+    [documents=N] [repeat=N] [profiles=ngram,edge_ngram,standard] [ngram_text_fields=yes|no] [output=file.json]'"""
+
+    try:
+        run_args = dict([arg.split('=', maxsplit=1) for arg in sys.argv[1:]])
+        documents_amount = int(run_args.get('documents', 5000))
+        repeat = int(run_args.get('repeat', 20))
+    except ValueError:
+        print(instructions)
+        sys.exit(1)
+
+    profiles = run_args.get('profiles', ','.join(ElasticSearchService.ANALYZER_PROFILES)).split(',')
+    if any(profile not in ElasticSearchService.ANALYZER_PROFILES for profile in profiles):
+        print(instructions)
+        sys.exit(1)
+
+    es_config = get_elasticsearch_config()
+    if not es_config:
+        print("Unable to get Elasticsearch config")
+        sys.exit(1)
+
+    ngram_text_fields = run_args.get('ngram_text_fields', 'yes') == 'yes'
+    documents = list(generate_es_documents(documents_amount))
+    terms = query_terms(10)
+    results = [benchmark_profile(es_config, profile, documents, terms, repeat, ngram_text_fields)
+               for profile in profiles]
+
+    print_results(results)
+    if run_args.get('output'):
+        with open(run_args['output'], 'w') as output_file:
+            json.dump(results, output_file, indent=4, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,387 @@
+# This file is part of the Etsin service
+#
+# Copyright 2017-2021 Ministry of Education and Culture, Finland
+#
+# :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# :license: MIT
+
+"""
+Record the Metax RabbitMQ message stream into a file and replay it through the consumer, to measure consumer
+throughput and catch regressions before they are deployed.
+
+capture binds an exclusive, auto-deleted queue to the Metax exchange, so the etsin queues are left untouched, and
+writes every create, update and delete message as a JSON line with its routing key, body and receive time.
+
+replay feeds a recording into MetaxConsumer:
+- mode=direct (default) runs the consumer against an in-process stand-in for the pika connection and channel. The
+  stand-in delivers the messages to the callbacks the consumer registers, honors the prefetch count and runs the
+  connection timers and thread safe callbacks, so batch and worker modes behave as they do against a broker.
+  Documents are written into a separate benchmark index of the configured Elasticsearch, which is deleted afterwards.
+  Reported: messages/sec, latency percentiles from delivery to ack or reject, and Elasticsearch requests.
+- mode=amqp publishes the recording into the Metax exchange of the configured RabbitMQ, meant for a local broker
+  with the real consumer running. Consumer side numbers are then read from the consumer metrics endpoint.
+
+speed=recorded keeps the recorded gaps between messages, speed=max sends as fast as the consumer takes them and a
+number, e.g. speed=10, replays that many times faster than recorded.
+
+Run from the repository root:
+    python -m benchmarks.consumer_replay capture output=events.jsonl [duration=600] [messages=N]
+    python -m benchmarks.consumer_replay replay input=events.jsonl [mode=direct|amqp] [speed=max]
+        [batch_size=N] [batch_max_wait_ms=N] [coalesce=yes] [workers=N] [output=results.json]
+"""
+
+import json
+import queue
+import random
+import sys
+import time
+from collections import Counter
+from time import perf_counter
+from types import SimpleNamespace
+
+import pika
+
+from benchmarks.analyzer_profiles import percentile
+from etsin_finder_search.elastic.service.es_service import ElasticSearchService
+from etsin_finder_search.rabbitmq.rabbitmq_client import MetaxConsumer
+from etsin_finder_search.utils import get_elasticsearch_config, get_metax_rabbit_mq_config
+
+BENCHMARK_INDEX_NAME = 'metax-benchmark-consumer'
+ROUTING_KEYS = ['create', 'update', 'delete']
+
+
+def capture(rabbit_settings, output, duration=None, max_messages=None):
+    """
+    Record messages of the Metax exchange until duration seconds have passed or max_messages have been recorded
+
+    :return: Number of recorded messages
+    """
+    connection = pika.BlockingConnection(pika.ConnectionParameters(
+        random.choice(rabbit_settings['HOSTS']),
+        rabbit_settings['PORT'],
+        rabbit_settings['VHOST'],
+        pika.PlainCredentials(rabbit_settings['USER'], rabbit_settings['PASSWORD'])))
+    channel = connection.channel()
+    capture_queue = channel.queue_declare('', exclusive=True, auto_delete=True).method.queue
+    for routing_key in ROUTING_KEYS:
+        channel.queue_bind(queue=capture_queue, exchange=rabbit_settings['EXCHANGE'], routing_key=routing_key)
+
+    recorded = 0
+    end = time.time() + duration if duration else None
+    try:
+        with open(output, 'w') as output_file:
+            for method, properties, body in channel.consume(capture_queue, auto_ack=True, inactivity_timeout=1):
+                if method is not None:
+                    output_file.write(json.dumps({
+                        'timestamp': time.time(),
+                        'routing_key': method.routing_key,
+                        'body': body.decode('utf-8')}) + '\n')
+                    recorded += 1
+                if (max_messages and recorded >= max_messages) or (end and time.time() >= end):
+                    break
+        channel.cancel()
+    finally:
+        connection.close()
+
+    return recorded
+
+
+def read_recording(filename):
+    with open(filename) as recording:
+        return [json.loads(line) for line in recording if line.strip()]
+
+
+class StandInConnection:
+    """
+    Stand-in for the pika BlockingConnection used by the consumer. Due timers and thread safe callbacks are run by
+    process_data_events on the calling thread, like the pika I/O loop does.
+    """
+
+    def __init__(self):
+        self.timers = {}
+        self._next_timer = 0
+        self.threadsafe_callbacks = queue.Queue()
+
+    def call_later(self, delay, callback):
+        self._next_timer += 1
+        self.timers[self._next_timer] = (perf_counter() + delay, callback)
+        return self._next_timer
+
+    def remove_timeout(self, timer_id):
+        self.timers.pop(timer_id, None)
+
+    def add_callback_threadsafe(self, callback):
+        self.threadsafe_callbacks.put(callback)
+
+    def process_data_events(self, time_limit=0):
+        end = perf_counter() + time_limit
+        while True:
+            self._run_pending()
+            remaining = end - perf_counter()
+            if remaining <= 0:
+                return
+            time.sleep(min(remaining, 0.0005))
+
+    def _run_pending(self):
+        while True:
+            try:
+                callback = self.threadsafe_callbacks.get_nowait()
+            except queue.Empty:
+                break
+            callback()
+
+        now = perf_counter()
+        for timer_id, (due, callback) in sorted(self.timers.items(), key=lambda item: item[1][0]):
+            if due > now:
+                break
+            if self.timers.pop(timer_id, None) is not None:
+                callback()
+
+
+class StandInChannel:
+    """
+    Stand-in for the pika BlockingChannel used by the consumer. Records the time from delivery to settlement of
+    every message and what was published by the consumer.
+    """
+
+    def __init__(self):
+        self.consumers = {}
+        self.prefetch_count = 0
+        self.delivered_at = {}
+        self.latencies = []
+        self.outcomes = Counter()
+        self.published = Counter()
+
+    def basic_qos(self, prefetch_size=0, prefetch_count=0, global_qos=False):
+        self.prefetch_count = prefetch_count
+
+    def basic_consume(self, queue, on_message_callback, auto_ack=False):
+        self.consumers[queue] = on_message_callback
+        return 'stand-in-' + queue
+
+    def basic_cancel(self, consumer_tag):
+        pass
+
+    def queue_declare(self, queue, passive=False, durable=False, arguments=None):
+        return SimpleNamespace(method=SimpleNamespace(queue=queue, message_count=0))
+
+    def queue_bind(self, queue, exchange, routing_key=None):
+        pass
+
+    def basic_publish(self, exchange, routing_key, body, properties=None, mandatory=False):
+        self.published[routing_key] += 1
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        self._settle(delivery_tag, multiple, 'ack')
+
+    def basic_nack(self, delivery_tag=0, multiple=False, requeue=True):
+        self._settle(delivery_tag, multiple, 'nack_requeue' if requeue else 'nack')
+
+    def can_deliver(self):
+        return not self.prefetch_count or len(self.delivered_at) < self.prefetch_count
+
+    def deliver(self, queue, routing_key, delivery_tag, body):
+        self.delivered_at[delivery_tag] = perf_counter()
+        self.consumers[queue](
+            self, SimpleNamespace(delivery_tag=delivery_tag, routing_key=routing_key, consumer_tag='stand-in-' + queue),
+            pika.BasicProperties(content_type='application/json', delivery_mode=2), body)
+
+    def _settle(self, delivery_tag, multiple, outcome):
+        now = perf_counter()
+        tags = [tag for tag in self.delivered_at if tag <= delivery_tag] if multiple else [delivery_tag]
+        for tag in tags:
+            delivered_at = self.delivered_at.pop(tag, None)
+            if delivered_at is not None:
+                self.latencies.append(now - delivered_at)
+                self.outcomes[outcome] += 1
+
+
+class BenchmarkConsumer(MetaxConsumer):
+    """
+    MetaxConsumer writing into the benchmark index, with its Elasticsearch HTTP requests counted
+    """
+
+    def _init_es_client(self, es_settings):
+        self.es_client = ElasticSearchService(es_settings)
+        self.es_client.INDEX_NAME = BENCHMARK_INDEX_NAME
+        self.es_client.delete_index()
+        if not self.es_client.ensure_index_existence():
+            return False
+
+        self.es_requests = Counter()
+        transport = self.es_client.es.transport
+        perform_request = transport.perform_request
+
+        def counting_perform_request(method, url, *args, **kwargs):
+            self.es_requests['{0} {1}'.format(method, '_bulk' if '/_bulk' in url else 'other')] += 1
+            return perform_request(method, url, *args, **kwargs)
+
+        transport.perform_request = counting_perform_request
+        return True
+
+    def _set_queue_names(self, is_local_dev):
+        # Never the unique local dev queue names, which are stored into a file
+        super(BenchmarkConsumer, self)._set_queue_names(False)
+
+
+def replay_direct(consumer, records, speed=None, settle_timeout=60):
+    """
+    Deliver recorded messages to the consumer through the stand-in channel
+
+    :param speed: Replay speed relative to the recording, as fast as possible if None
+    :return: Results as a dict
+    """
+    channel = StandInChannel()
+    connection = StandInConnection()
+    consumer.channel = channel
+    consumer.connection = connection
+    consumer._create_and_bind_queues(False)
+    if not consumer._setup_consumers():
+        raise RuntimeError('Unable to set up consumers')
+
+    queues = {'create': consumer.create_queue, 'update': consumer.update_queue, 'delete': consumer.delete_queue}
+    records = [record for record in records if record['routing_key'] in queues]
+    first_timestamp = records[0]['timestamp'] if records else 0
+
+    start = perf_counter()
+    for delivery_tag, record in enumerate(records, start=1):
+        if speed:
+            connection.process_data_events(start + (record['timestamp'] - first_timestamp) / speed - perf_counter())
+        while not channel.can_deliver():
+            connection.process_data_events(0.001)
+
+        channel.deliver(queues[record['routing_key']], record['routing_key'], delivery_tag,
+                        record['body'].encode('utf-8'))
+        connection.process_data_events(0)
+
+    deadline = perf_counter() + settle_timeout
+    while channel.delivered_at and perf_counter() < deadline:
+        connection.process_data_events(0.001)
+    elapsed = perf_counter() - start
+
+    consumer.before_stop()
+    latencies_ms = [latency * 1000 for latency in channel.latencies] or [0]
+    return {
+        'messages': len(records),
+        'unsettled': len(channel.delivered_at),
+        'elapsed_seconds': round(elapsed, 3),
+        'messages_per_sec': round(len(records) / elapsed, 1) if elapsed else None,
+        'latency_ms': {
+            'p50': round(percentile(latencies_ms, 50), 2),
+            'p95': round(percentile(latencies_ms, 95), 2),
+            'p99': round(percentile(latencies_ms, 99), 2),
+            'max': round(max(latencies_ms), 2),
+        },
+        'outcomes': dict(channel.outcomes),
+        'published': dict(channel.published),
+        'es_requests': dict(consumer.es_requests, total=sum(consumer.es_requests.values())),
+    }
+
+
+def replay_amqp(rabbit_settings, records, speed=None):
+    """
+    Publish recorded messages into the Metax exchange of the configured RabbitMQ
+
+    :return: Results as a dict
+    """
+    connection = pika.BlockingConnection(pika.ConnectionParameters(
+        random.choice(rabbit_settings['HOSTS']),
+        rabbit_settings['PORT'],
+        rabbit_settings['VHOST'],
+        pika.PlainCredentials(rabbit_settings['USER'], rabbit_settings['PASSWORD'])))
+    channel = connection.channel()
+    first_timestamp = records[0]['timestamp'] if records else 0
+    properties = pika.BasicProperties(content_type='application/json', delivery_mode=2)
+
+    start = perf_counter()
+    try:
+        for record in records:
+            if speed:
+                delay = start + (record['timestamp'] - first_timestamp) / speed - perf_counter()
+                if delay > 0:
+                    connection.sleep(delay)
+            channel.basic_publish(rabbit_settings['EXCHANGE'], record['routing_key'], record['body'].encode('utf-8'),
+                                  properties)
+    finally:
+        connection.close()
+    elapsed = perf_counter() - start
+
+    return {
+        'messages': len(records),
+        'elapsed_seconds': round(elapsed, 3),
+        'published_per_sec': round(len(records) / elapsed, 1) if elapsed else None,
+    }
+
+
+def print_results(results):
+    for name, value in results.items():
+        if isinstance(value, dict):
+            value = ', '.join('{0}: {1}'.format(key, item) for key, item in sorted(value.items()))
+        print('{0:<18} {1}'.format(name, value))
+
+
+def main():
+    instructions = """\nRun the program from the repository root using
+    'python -m benchmarks.consumer_replay capture output=events.jsonl [duration=seconds] [messages=N]' or
+    'python -m benchmarks.consumer_replay replay input=events.jsonl [mode=direct|amqp] [speed=recorded|max|N]
+        [batch_size=N] [batch_max_wait_ms=N] [coalesce=yes|no] [workers=N] [output=results.json]'"""
+
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    try:
+        run_args = dict([arg.split('=', maxsplit=1) for arg in sys.argv[2:]])
+        speed = run_args.get('speed', 'max')
+        speed = {'recorded': 1.0, 'max': None}[speed] if speed in ('recorded', 'max') else float(speed)
+        batch_size = int(run_args.get('batch_size', 0))
+        batch_max_wait_ms = int(run_args.get('batch_max_wait_ms', 1000))
+        workers = int(run_args.get('workers', 1))
+        duration = float(run_args['duration']) if 'duration' in run_args else None
+        max_messages = int(run_args['messages']) if 'messages' in run_args else None
+    except ValueError:
+        print(instructions)
+        sys.exit(1)
+
+    if command == 'capture' and run_args.get('output'):
+        rabbit_settings = get_metax_rabbit_mq_config()
+        if not rabbit_settings:
+            print("Unable to get RabbitMQ config")
+            sys.exit(1)
+        print("Recorded {0} messages".format(capture(rabbit_settings, run_args['output'], duration, max_messages)))
+        return
+
+    if command != 'replay' or not run_args.get('input') or run_args.get('mode', 'direct') not in ('direct', 'amqp'):
+        print(instructions)
+        sys.exit(1)
+
+    records = read_recording(run_args['input'])
+    if run_args.get('mode') == 'amqp':
+        rabbit_settings = get_metax_rabbit_mq_config()
+        if not rabbit_settings:
+            print("Unable to get RabbitMQ config")
+            sys.exit(1)
+        results = replay_amqp(rabbit_settings, records, speed)
+    else:
+        es_config = get_elasticsearch_config()
+        if not es_config:
+            print("Unable to get Elasticsearch config")
+            sys.exit(1)
+
+        consumer = BenchmarkConsumer(rabbit_settings={
+            'HOSTS': ['stand-in'], 'PORT': 0, 'VHOST': '/', 'EXCHANGE': 'metax', 'USER': '', 'PASSWORD': '',
+            'BATCH_SIZE': batch_size, 'BATCH_MAX_WAIT_MS': batch_max_wait_ms, 'WORKERS': workers,
+            'COALESCE_EVENTS': run_args.get('coalesce', 'no') == 'yes', 'RETRY_DELAYS_MS': []}, es_settings=es_config)
+        if not consumer.init_ok:
+            print("Unable to initialize consumer")
+            sys.exit(1)
+        try:
+            results = replay_direct(consumer, records, speed)
+        finally:
+            consumer.es_client.delete_index()
+
+    print_results(results)
+    if run_args.get('output'):
+        with open(run_args['output'], 'w') as output_file:
+            json.dump(results, output_file, indent=4, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+# This file is part of the Etsin service
+#
+# Copyright 2017-2021 Ministry of Education and Culture, Finland
+#
+# :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# :license: MIT
+
+"""
+Benchmark CRConverter with its compiled declarative mapping against the hand-written converter it replaced.
+
+Both converters convert the same catalog records, by default copies of the test catalog record, or the records of a
+Metax response saved into a json file with input=. Reported per converter: median time per record over the rounds
+and records per second. The documents of the converters are checked to be identical before measuring. The compiled
+mapping is measured both without and with a ReferenceInterner shared by all the records, and the hit rate and the
+memory saved by the interner are reported.
+
+Run from the repository root:
+    python -m benchmarks.converter_mapping [records=1000] [rounds=10] [input=catalog_records.json]
+"""
+
+import copy
+import functools
+import json
+import os
+import statistics
+import sys
+from time import perf_counter
+
+from benchmarks.legacy_cr_converter import LegacyCRConverter
+from etsin_finder_search.catalog_record_converter import CRConverter
+from etsin_finder_search.catalog_record_mapping import ReferenceInterner
+
+TEST_RECORD_PATH = os.path.join(os.path.dirname(__file__), '..', 'tests', 'test_objects', 'metax_catalog_record.json')
+
+
+def load_records(amount, input_path=None):
+    """
+    :return: List of catalog records, copies of the test catalog record with unique identifiers unless input_path
+        is given
+    """
+    if input_path:
+        with open(input_path) as input_file:
+            records = json.load(input_file)
+        return records[:amount] if amount else records
+
+    with open(TEST_RECORD_PATH) as record_file:
+        record = json.load(record_file)
+
+    records = []
+    for i in range(amount):
+        copied = copy.deepcopy(record)
+        copied['identifier'] = '{0}-{1}'.format(record['identifier'], i)
+        records.append(copied)
+    return records
+
+
+def measure(convert, records, rounds):
+    """
+    :return: Median seconds per record over the rounds
+    """
+    per_record = []
+    for _ in range(rounds):
+        start = perf_counter()
+        for record in records:
+            convert(record)
+        per_record.append((perf_counter() - start) / len(records))
+    return statistics.median(per_record)
+
+
+def _without_timer(converter):
+    # Measure the conversion without the timing of CONVERSION_SECONDS, the hand-written converter has none
+    return functools.partial(CRConverter.convert_metax_cr_json_to_es_data_model.__wrapped__, converter)
+
+
+def run(records, rounds):
+    # The hand-written converter kept the repeated names, compare the documents it produced
+    interned = CRConverter(ReferenceInterner())
+    converters = [('hand-written', LegacyCRConverter().convert_metax_cr_json_to_es_data_model),
+                  ('compiled mapping', _without_timer(CRConverter())),
+                  ('interned', _without_timer(interned))]
+
+    for record in records:
+        documents = [json.dumps(convert(copy.deepcopy(record))) for _, convert in converters]
+        if any(document != documents[0] for document in documents[1:]):
+            raise AssertionError("Converters disagree on catalog record {0}".format(record.get('identifier')))
+    # Interning of a single pass over the records, the measured rounds below only add to the hits
+    print(interned.interner.report())
+
+    return [{'converter': name, 'records': len(records), 'seconds_per_record': measure(convert, records, rounds)}
+            for name, convert in converters]
+
+
+def print_results(results):
+    baseline = results[0]['seconds_per_record']
+    print('{0:<20}{1:>16}{2:>16}{3:>10}'.format('converter', 'us/record', 'records/s', 'speedup'))
+    for result in results:
+        seconds = result['seconds_per_record']
+        print('{0:<20}{1:>16.1f}{2:>16.0f}{3:>9.2f}x'.format(
+            result['converter'], seconds * 1e6, 1 / seconds, baseline / seconds))
+
+
+def main():
+    instructions = """\nRun the program from the repository root using 'python -m benchmarks.converter_mapping
+    [records=N] [rounds=N] [input=catalog_records.json]'"""
+
+    try:
+        run_args = dict([arg.split('=', maxsplit=1) for arg in sys.argv[1:]])
+        records_amount = int(run_args.get('records', 1000))
+        rounds = int(run_args.get('rounds', 10))
+    except ValueError:
+        print(instructions)
+        sys.exit(1)
+
+    records = load_records(records_amount, run_args.get('input'))
+    print_results(run(records, rounds))
+
+
+if __name__ == '__main__':
+    main()
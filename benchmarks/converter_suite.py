@@ -0,0 +1,209 @@
+# This file is part of the Etsin service
+#
+# Copyright 2017-2021 Ministry of Education and Culture, Finland
+#
+# :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# :license: MIT
+
+"""
+Benchmark suite of the conversion of catalog records into Elasticsearch bulk rows, run on synthetic Metax catalog
+records from benchmarks/synthetic_corpus.py.
+
+Each scenario scales one part of the catalog records, e.g. the amount of creators or files, and the typical scenario
+resembles an average dataset. For every scenario the stages below are measured:
+    convert: CRConverter.convert_metax_cr_json_to_es_data_model
+    serialize: ESDatasetModel.to_es_document_string
+    bulk_row: ElasticSearchService._create_bulk_update_row
+    pipeline: all of the above for each record, as the reindexer does them
+Reported per stage: operations per second, the median over the rounds, and the peak memory allocated during one pass
+over the records as measured by tracemalloc.
+
+Before measuring, the documents are checked to match the ones of the hand-written converter the mapping replaced,
+apart from the file types which are listed once since.
+
+The results can be saved with output= and compared with the results of an earlier commit with baseline=, which
+prints the change of each measurement. The records are generated with a fixed seed, so runs are comparable.
+
+Run from the repository root:
+    python -m benchmarks.converter_suite [scale=1] [rounds=5] [scenarios=typical,many_files]
+        [output=results.json] [baseline=earlier_results.json]
+"""
+
+import copy
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import tracemalloc
+from time import perf_counter
+
+from benchmarks.legacy_cr_converter import LegacyCRConverter
+from benchmarks.synthetic_corpus import generate_metax_catalog_records
+from etsin_finder_search.catalog_record_converter import CRConverter
+from etsin_finder_search.elastic.domain.es_dataset_data_model import ESDatasetModel
+from etsin_finder_search.elastic.service.es_service import ElasticSearchService
+
+# Scenario name to the amount of records at scale 1 and the parameters of generate_metax_catalog_records
+SCENARIOS = {
+    'typical': (1000, {}),
+    'many_creators': (200, {'creators': 50}),
+    'deep_organizations': (500, {'organization_depth': 8}),
+    'many_projects': (200, {'projects': 20}),
+    'many_files': (20, {'files': 10000}),
+    'remote_resources': (200, {'remote_resources': 200}),
+    'long_description': (200, {'description_words': 5000}),
+}
+STAGES = ('convert', 'serialize', 'bulk_row', 'pipeline')
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def stage_functions():
+    """
+    :return: Dict of stage name to a function doing the stage for one input, and the name of the stage whose
+        outputs are its inputs, None for catalog records
+    """
+    # CONVERSION_SECONDS is left out, it would be measured along with the conversion
+    convert = CRConverter.convert_metax_cr_json_to_es_data_model.__wrapped__
+    converter = CRConverter()
+    es_service = ElasticSearchService({'HOSTS': ['localhost']})
+
+    def pipeline(record):
+        return es_service._create_bulk_update_row(ESDatasetModel(convert(converter, record)))
+
+    return {
+        'convert': (lambda record: convert(converter, record), None),
+        'serialize': (lambda model: model.to_es_document_string(), 'models'),
+        'bulk_row': (es_service._create_bulk_update_row, 'models'),
+        'pipeline': (pipeline, None),
+    }
+
+
+def measure(function, inputs, rounds):
+    """
+    :return: Tuple of operations per second, median over the rounds, and the peak bytes allocated during one pass
+    """
+    # Warm up caches, e.g. the interned strings and the allocator, before measuring
+    for item in inputs:
+        function(item)
+
+    per_second = []
+    for _ in range(rounds):
+        start = perf_counter()
+        for item in inputs:
+            function(item)
+        per_second.append(len(inputs) / (perf_counter() - start))
+
+    tracemalloc.start()
+    try:
+        for item in inputs:
+            function(item)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return statistics.median(per_second), peak
+
+
+def check_documents(records, documents):
+    legacy = LegacyCRConverter()
+    for record, document in zip(records, documents):
+        expected = legacy.convert_metax_cr_json_to_es_data_model(copy.deepcopy(record))
+        expected['file_type'] = list({json.dumps(file_type): file_type for file_type in expected['file_type']}.values())
+        if document != expected:
+            raise AssertionError("Converters disagree on catalog record {0}".format(record.get('identifier')))
+
+
+def run_scenario(name, scale, rounds):
+    amount, parameters = SCENARIOS[name]
+    records = list(generate_metax_catalog_records(max(1, int(amount * scale)), **parameters))
+    converter = CRConverter()
+    models = [ESDatasetModel(converter.convert_metax_cr_json_to_es_data_model(record)) for record in records]
+    check_documents(records, [model.doc_obj for model in models])
+    inputs = {None: records, 'models': models}
+    document_bytes = statistics.mean(len(model.to_es_document_string()) for model in models)
+
+    results = []
+    for stage, (function, input_name) in stage_functions().items():
+        ops_per_sec, peak_bytes = measure(function, inputs[input_name], rounds)
+        results.append({
+            'scenario': name,
+            'stage': stage,
+            'records': len(records),
+            'document_bytes': round(document_bytes),
+            'ops_per_sec': round(ops_per_sec, 1),
+            'peak_bytes': peak_bytes,
+        })
+    return results
+
+
+def run(scenarios, scale, rounds):
+    return {
+        'commit': _git_commit(),
+        'python': platform.python_version(),
+        'scale': scale,
+        'rounds': rounds,
+        'results': [result for name in scenarios for result in run_scenario(name, scale, rounds)],
+    }
+
+
+def _change(value, baseline_value):
+    if not baseline_value:
+        return ''
+    return '{0:+.1f}%'.format((value / baseline_value - 1) * 100)
+
+
+def print_results(run_results, baseline=None):
+    baseline_results = {}
+    if baseline:
+        baseline_results = dict(((result['scenario'], result['stage']), result) for result in baseline['results'])
+        print('Compared with commit {0}'.format(baseline.get('commit')))
+
+    print('{0:<20}{1:<11}{2:>9}{3:>11}{4:>14}{5:>10}{6:>14}{7:>10}'.format(
+        'scenario', 'stage', 'records', 'doc bytes', 'ops/sec', 'change', 'peak KiB', 'change'))
+    for result in run_results['results']:
+        earlier = baseline_results.get((result['scenario'], result['stage']), {})
+        print('{0:<20}{1:<11}{2:>9}{3:>11}{4:>14.1f}{5:>10}{6:>14.1f}{7:>10}'.format(
+            result['scenario'], result['stage'], result['records'], result['document_bytes'], result['ops_per_sec'],
+            _change(result['ops_per_sec'], earlier.get('ops_per_sec')), result['peak_bytes'] / 1024,
+            _change(result['peak_bytes'], earlier.get('peak_bytes'))))
+
+
+def main():
+    instructions = """\nRun the program from the repository root using 'python -m benchmarks.converter_suite
+    [scale=N] [rounds=N] [scenarios={0}] [output=file.json] [baseline=file.json]'""".format(','.join(SCENARIOS))
+
+    try:
+        run_args = dict([arg.split('=', maxsplit=1) for arg in sys.argv[1:]])
+        scale = float(run_args.get('scale', 1))
+        rounds = int(run_args.get('rounds', 5))
+    except ValueError:
+        print(instructions)
+        sys.exit(1)
+
+    scenarios = run_args.get('scenarios', ','.join(SCENARIOS)).split(',')
+    if any(scenario not in SCENARIOS for scenario in scenarios):
+        print(instructions)
+        sys.exit(1)
+
+    baseline = None
+    if run_args.get('baseline'):
+        with open(run_args['baseline']) as baseline_file:
+            baseline = json.load(baseline_file)
+
+    results = run(scenarios, scale, rounds)
+    print_results(results, baseline)
+    if run_args.get('output'):
+        with open(run_args['output'], 'w') as output_file:
+            json.dump(results, output_file, indent=4, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
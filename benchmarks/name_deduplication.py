@@ -0,0 +1,87 @@
+# This file is part of the Etsin service
+#
+# Copyright 2017-2021 Ministry of Education and Culture, Finland
+#
+# :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# :license: MIT
+
+"""
+Report how much deduplicating the organization and project name lists shrinks the Elasticsearch documents.
+
+Converts the catalog records with and without DEDUPLICATE_NAMES and compares the serialized documents, as they are
+sent in bulk requests. The records are copies of the test catalog record by default, or the records of a Metax
+response saved into a json file with input=.
+
+Run from the repository root:
+    python -m benchmarks.name_deduplication [records=1000] [input=catalog_records.json]
+"""
+
+import sys
+
+from benchmarks.converter_mapping import load_records
+from etsin_finder_search.catalog_record_converter import CRConverter
+from etsin_finder_search.elastic.domain.es_dataset_data_model import ESDatasetModel
+
+NAME_FIELDS = ('organization_name_fi', 'organization_name_en', 'project_name_fi', 'project_name_en')
+
+
+def _document_bytes(document):
+    return len(ESDatasetModel(document).to_es_document_string().encode('utf-8'))
+
+
+def run(records):
+    """
+    :return: Dict of the amount of documents, their average size with and without deduplication, and the average
+        amount of names in the name lists with and without deduplication
+    """
+    with_duplicates = CRConverter()
+    deduplicated = CRConverter(deduplicate_names=True)
+    totals = {'documents': 0, 'bytes_before': 0, 'bytes_after': 0, 'names_before': 0, 'names_after': 0}
+    for record in records:
+        before = with_duplicates.convert_metax_cr_json_to_es_data_model(record)
+        if not before:
+            continue
+        after = deduplicated.convert_metax_cr_json_to_es_data_model(record)
+
+        totals['documents'] += 1
+        totals['bytes_before'] += _document_bytes(before)
+        totals['bytes_after'] += _document_bytes(after)
+        totals['names_before'] += sum(len(before.get(field, [])) for field in NAME_FIELDS)
+        totals['names_after'] += sum(len(after.get(field, [])) for field in NAME_FIELDS)
+
+    documents = totals['documents'] or 1
+    return {
+        'documents': totals['documents'],
+        'avg_bytes_before': totals['bytes_before'] / documents,
+        'avg_bytes_after': totals['bytes_after'] / documents,
+        'avg_names_before': totals['names_before'] / documents,
+        'avg_names_after': totals['names_after'] / documents,
+    }
+
+
+def print_report(result):
+    saved = result['avg_bytes_before'] - result['avg_bytes_after']
+    print('documents: {0}'.format(result['documents']))
+    print('average document size: {0:.0f} -> {1:.0f} bytes, {2:.0f} bytes ({3:.1%}) smaller'.format(
+        result['avg_bytes_before'], result['avg_bytes_after'], saved,
+        saved / result['avg_bytes_before'] if result['avg_bytes_before'] else 0))
+    print('average names per document: {0:.1f} -> {1:.1f}'.format(
+        result['avg_names_before'], result['avg_names_after']))
+
+
+def main():
+    instructions = """\nRun the program from the repository root using 'python -m benchmarks.name_deduplication
+    [records=N] [input=catalog_records.json]'"""
+
+    try:
+        run_args = dict([arg.split('=', maxsplit=1) for arg in sys.argv[1:]])
+        records_amount = int(run_args.get('records', 1000))
+    except ValueError:
+        print(instructions)
+        sys.exit(1)
+
+    print_report(run(load_records(records_amount, run_args.get('input'))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,229 @@
+# This file is part of the Etsin service
+#
+# Copyright 2017-2021 Ministry of Education and Culture, Finland
+#
+# :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# :license: MIT
+
+"""
+Deterministic synthetic data for benchmarks. The same seed always produces the same corpus, so results from
+different runs and commits are comparable.
+"""
+
+import random
+
+SYLLABLES = ['ka', 'lo', 'mi', 'nen', 'tu', 'ra', 'vi', 'sa', 'ke', 'hel', 'ton', 'ma', 'ri', 'jo', 'es', 'ter',
+             'da', 'ta', 'set', 'bio', 'geo', 'lin', 'gu', 'is', 'tic', 'cli', 'mate', 'for', 'est', 'sea']
+
+ACCESS_TYPES = ['open', 'login', 'embargo', 'restricted', 'permit']
+FIELDS_OF_SCIENCE = [('ta111', 'Mathematics'), ('ta112', 'Statistics'), ('ta113', 'Computer science'),
+                     ('ta114', 'Physical sciences'), ('ta1172', 'Environmental sciences'), ('ta516', 'Linguistics'),
+                     ('ta6121', 'Languages'), ('ta5141', 'Sociology')]
+FILE_TYPES = ['text', 'image', 'video', 'audio', 'software', 'dataset']
+LICENSES = [('CC-BY-4.0', 'Creative Commons Attribution 4.0 International (CC BY 4.0)'),
+            ('CC0-1.0', 'Creative Commons CCZero 1.0 Universal (CC0 1.0)'),
+            ('other', 'Other')]
+AGENT_ROLES = ['contributor', 'curator', 'rights_holder']
+
+FAIRDATA_CODE = 'http://uri.suomi.fi/codelist/fairdata/{0}/code/{1}'
+
+
+def _word(rnd):
+    return ''.join(rnd.choice(SYLLABLES) for _ in range(rnd.randint(1, 4)))
+
+
+def _sentence(rnd, words):
+    return ' '.join(_word(rnd) for _ in range(words)).capitalize()
+
+
+def _vocabulary(rnd, size):
+    return [_sentence(rnd, rnd.randint(2, 4)) for _ in range(size)]
+
+
+def generate_es_documents(amount, seed=1, description_words=150):
+    """
+    Generate Elasticsearch documents shaped like the output of CRConverter
+
+    :param amount: Amount of documents
+    :param seed: Random seed
+    :param description_words: Average amount of words in descriptions
+    :return: Generator of document dicts
+    """
+
+    rnd = random.Random(seed)
+    organizations = _vocabulary(rnd, 60)
+    people = _vocabulary(rnd, 400)
+    projects = _vocabulary(rnd, 80)
+    keywords = [_word(rnd) for _ in range(300)]
+
+    for i in range(amount):
+        creators = rnd.sample(people, rnd.randint(1, 6))
+        orgs = rnd.sample(organizations, rnd.randint(1, 4))
+        access_type = rnd.choice(ACCESS_TYPES)
+        fos_id, fos_label = rnd.choice(FIELDS_OF_SCIENCE)
+        words = max(1, int(rnd.gauss(description_words, description_words / 3)))
+
+        yield {
+            'identifier': 'cr-synthetic-{0:08d}'.format(i),
+            'preferred_identifier': 'urn:nbn:fi:att:synthetic-{0:08d}'.format(i),
+            'dataset_version_set': [],
+            'data_catalog': {'en': 'Synthetic catalog', 'fi': 'Synteettinen katalogi'},
+            'data_catalog_identifier': 'urn:nbn:fi:att:data-catalog-ida',
+            'date_modified': '2020-{0:02d}-{1:02d}T12:00:00+03:00'.format(rnd.randint(1, 12), rnd.randint(1, 28)),
+            'title': {'en': _sentence(rnd, rnd.randint(4, 14)), 'fi': _sentence(rnd, rnd.randint(4, 14))},
+            'description': {'en': _sentence(rnd, words), 'fi': _sentence(rnd, words)},
+            'keyword': rnd.sample(keywords, rnd.randint(1, 8)),
+            'creator': [{'name': {'und': name}, 'agent_type': 'Person'} for name in creators],
+            'creator_name': creators,
+            'publisher': {'name': {'en': orgs[0]}, 'agent_type': 'Organization'},
+            'organization_name_fi': orgs,
+            'organization_name_en': orgs,
+            'project_name_fi': rnd.sample(projects, rnd.randint(0, 2)),
+            'project_name_en': rnd.sample(projects, rnd.randint(0, 2)),
+            'access_rights': {
+                'access_type': {
+                    'identifier': 'http://uri.suomi.fi/codelist/fairdata/access_type/code/' + access_type,
+                    'pref_label': {'en': access_type.capitalize(), 'fi': access_type}
+                }
+            },
+            'field_of_science': [{
+                'identifier': 'http://www.yso.fi/onto/okm-tieteenala/' + fos_id,
+                'pref_label': {'en': fos_label, 'und': fos_label}
+            }],
+            'file_type': [{
+                'identifier': 'http://uri.suomi.fi/codelist/fairdata/file_type/code/' + file_type,
+                'pref_label': {'en': file_type.capitalize()}
+            } for file_type in rnd.sample(FILE_TYPES, rnd.randint(0, 3))],
+        }
+
+
+def _reference(scheme, code, label, definition=False):
+    obj = {
+        'identifier': FAIRDATA_CODE.format(scheme, code),
+        'in_scheme': 'http://uri.suomi.fi/codelist/fairdata/' + scheme,
+        'pref_label': {'en': label, 'fi': label, 'und': label},
+    }
+    if definition:
+        obj['definition'] = {'en': 'A statement or formal explanation of the meaning of a concept.'}
+    return obj
+
+
+def _organization_chains(rnd, amount, depth):
+    """
+    :return: List of amount organizations, each with a chain of depth parent organizations in is_part_of
+    """
+    names = _vocabulary(rnd, amount * (depth + 1))
+    organizations = []
+    for i in range(amount):
+        organization = None
+        for level in range(depth, -1, -1):
+            name = names[i * (depth + 1) + level]
+            child = {
+                '@type': 'Organization',
+                'identifier': FAIRDATA_CODE.format('organization', '{0}-{1}'.format(i, level)),
+                'name': {'en': name, 'fi': name.lower(), 'und': name},
+            }
+            if organization is not None:
+                child['is_part_of'] = organization
+            organization = child
+        organizations.append(organization)
+    return organizations
+
+
+def _person(rnd, name, organizations):
+    return {'@type': 'Person', 'name': name, 'member_of': rnd.choice(organizations)}
+
+
+def generate_metax_catalog_records(amount, seed=1, creators=3, organization_depth=2, projects=1, files=10,
+                                   remote_resources=0, description_words=150):
+    """
+    Generate Metax catalog records shaped like the ones Metax API returns, the input of CRConverter. Every size
+    parameter is the amount for each record, so the cost of each part of the conversion can be scaled on its own.
+
+    :param amount: Amount of catalog records
+    :param seed: Random seed
+    :param creators: Amount of creators, persons who are members of organizations
+    :param organization_depth: Length of the is_part_of chain above each organization
+    :param projects: Amount of projects in is_output_of, each with a funding agency and a source organization
+    :param files: Amount of files
+    :param remote_resources: Amount of remote resources
+    :param description_words: Average amount of words in descriptions
+    :return: Generator of catalog record dicts
+    """
+    rnd = random.Random(seed)
+    organizations = _organization_chains(rnd, 20, organization_depth)
+    people = _vocabulary(rnd, 400)
+    project_names = _vocabulary(rnd, 80)
+    keywords = [_word(rnd) for _ in range(300)]
+
+    for i in range(amount):
+        identifier = 'cr-synthetic-{0:08d}'.format(i)
+        words = max(1, int(rnd.gauss(description_words, description_words / 3)))
+        access_type = rnd.choice(ACCESS_TYPES)
+        license_code, license_title = rnd.choice(LICENSES)
+        fos_code, fos_label = rnd.choice(FIELDS_OF_SCIENCE)
+        date_modified = '2020-{0:02d}-{1:02d}T12:00:00+03:00'.format(rnd.randint(1, 12), rnd.randint(1, 28))
+
+        research_dataset = {
+            'preferred_identifier': 'urn:nbn:fi:att:synthetic-{0:08d}'.format(i),
+            'title': {'en': _sentence(rnd, rnd.randint(4, 14)), 'fi': _sentence(rnd, rnd.randint(4, 14))},
+            'description': {'en': _sentence(rnd, words), 'fi': _sentence(rnd, words)},
+            'keyword': rnd.sample(keywords, rnd.randint(1, 8)),
+            'creator': [_person(rnd, rnd.choice(people), organizations) for _ in range(creators)],
+            'publisher': rnd.choice(organizations),
+            'access_rights': {
+                'description': {'en': 'Terms of use'},
+                'access_type': _reference('access_type', access_type, access_type.capitalize()),
+                'license': [{'identifier': FAIRDATA_CODE.format('license', license_code),
+                             'title': {'en': license_title, 'fi': license_title, 'und': license_title}}],
+            },
+            'field_of_science': [{'identifier': 'http://www.yso.fi/onto/okm-tieteenala/' + fos_code,
+                                  'pref_label': {'en': fos_label, 'und': fos_label}}],
+            'theme': [{'identifier': 'http://www.yso.fi/onto/koko/p{0}'.format(rnd.randint(1, 50)),
+                       'pref_label': {'en': _word(rnd)}}],
+            'is_output_of': [{
+                'identifier': 'project-{0}'.format(rnd.randint(1, 1000)),
+                'name': {'en': name, 'fi': name.lower()},
+                'funder_type': _reference('funder_type', 'tekes', 'Tekes'),
+                'has_funding_agency': [rnd.choice(organizations)],
+                'source_organization': [rnd.choice(organizations)],
+            } for name in (rnd.choice(project_names) for _ in range(projects))],
+            'files': [{
+                'identifier': 'pid:urn:{0}:{1}'.format(i, file_no),
+                'title': 'file title {0}'.format(file_no),
+                'file_type': _reference('file_type', file_type, file_type.capitalize(), definition=True),
+                'use_category': _reference('use_category', 'outcome', 'Outcome material'),
+            } for file_no, file_type in enumerate(rnd.choice(FILE_TYPES) for _ in range(files))],
+            'remote_resources': [{
+                'title': 'remote resource {0}'.format(resource_no),
+                'file_type': _reference('file_type', file_type, file_type.capitalize(), definition=True),
+                'access_url': {'identifier': 'https://example.com/{0}/{1}'.format(i, resource_no)},
+            } for resource_no, file_type in enumerate(rnd.choice(FILE_TYPES) for _ in range(remote_resources))],
+        }
+        for role in AGENT_ROLES:
+            if rnd.random() < 0.5:
+                research_dataset[role] = [rnd.choice([_person(rnd, rnd.choice(people), organizations),
+                                                      rnd.choice(organizations)])]
+
+        yield {
+            'identifier': identifier,
+            'state': 'published',
+            'deprecated': False,
+            'date_created': date_modified,
+            'date_modified': date_modified,
+            'data_catalog': {'identifier': 'urn:nbn:fi:att:data-catalog-ida',
+                             'catalog_json': {'identifier': 'urn:nbn:fi:att:data-catalog-ida',
+                                              'title': {'en': 'Synthetic catalog', 'fi': 'Synteettinen katalogi'}}},
+            'dataset_version_set': [],
+            'research_dataset': research_dataset,
+        }
+
+
+def query_terms(amount, seed=2):
+    """
+    Query strings drawn from the same vocabulary as the corpus, so that queries have matches
+
+    :return: List of query strings
+    """
+    rnd = random.Random(seed)
+    return [_sentence(rnd, rnd.randint(1, 3)).lower() for _ in range(amount)]
@@ -0,0 +1,617 @@
+# This file is part of the Etsin service
+#
+# Copyright 2017-2021 Ministry of Education and Culture, Finland
+#
+# :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# :license: MIT
+
+"""
+Declarative mapping of Metax catalog records into Elasticsearch documents.
+
+MAPPING lists the fields of the document in the order they are written. Each FieldSpec names the target field, the
+source path in the catalog record, the kind of transform and its options. compile_mapping turns the spec into a flat
+list of closures once, at import time, so converting a record only runs the closures in order without interpreting
+the spec again.
+
+Mappings compiled with a ReferenceInterner reuse the converted reference data objects, such as licenses, themes and
+file types, across the records they convert instead of building a new object for each occurrence.
+"""
+
+import sys
+from collections import OrderedDict, namedtuple
+
+from etsin_finder_search.reindexing_log import get_logger
+from etsin_finder_search.utils import \
+    get_catalog_record_dataset_version_set, \
+    get_catalog_record_data_catalog_title, \
+    get_catalog_record_data_catalog_identifier
+
+log = get_logger(__name__)
+
+# target: Document field, or the base name of the field pair of a language handled kind
+# source: Path of keys from the catalog record root, or a tuple of paths for kinds reading several
+# kind: One of the transform kinds below
+# options: Dict of options of the kind
+FieldSpec = namedtuple('FieldSpec', ['target', 'source', 'kind', 'options'])
+FieldSpec.__new__.__defaults__ = (None,)
+
+# Transform kinds
+VALUE = 'value'                          # the source value as it is
+OPTIONAL = 'optional'                    # the source value if it is truthy, otherwise the field is left out
+FIRST_OF = 'first_of'                    # the first truthy value of the source paths, otherwise the last one
+DERIVED = 'derived'                      # the result of a function of the whole catalog record
+NAME_LISTS = 'name_lists'                # empty lists for names in each language, filled by later fields
+REFERENCES = 'references'                # reference data object or a list of them, with identifier and label
+REFERENCE_ITEMS = 'reference_items'      # list of reference data objects
+OTHER_IDENTIFIERS = 'other_identifiers'  # notations and types of other identifiers
+ACCESS_RIGHTS = 'access_rights'          # description, license and access type of the access rights
+FUNDER_NAMES = 'funder_names'            # names of the funding agencies and source organizations of projects
+PROJECTS = 'projects'                    # names of the projects
+FILE_TYPES = 'file_types'                # distinct file types of the files and remote resources
+AGENTS = 'agents'                        # persons or organizations, with their names
+UNIQUE_NAMES = 'unique_names'            # drops repeated names from the name lists, keeping the first occurrence
+
+RESEARCH_DATASET = 'research_dataset'
+
+# Order in which languages of a langstring are tried when picking the name of an organization or a project
+LANGUAGE_PREFERENCES = {'fi': ('fi', 'und', 'en'), 'en': ('en', 'und', 'fi')}
+NAME_LANGUAGES = ('fi', 'en')
+AGENT_TYPES = ('Agent', 'Person', 'Organization')
+
+
+def _rd(key):
+    return (RESEARCH_DATASET, key)
+
+
+MAPPING = (
+    FieldSpec('identifier', ('identifier',), VALUE),
+    FieldSpec('preferred_identifier', _rd('preferred_identifier'), VALUE),
+    FieldSpec('dataset_version_set', None, DERIVED, {'function': get_catalog_record_dataset_version_set}),
+    FieldSpec('data_catalog', None, DERIVED, {'function': get_catalog_record_data_catalog_title}),
+    FieldSpec('data_catalog_identifier', None, DERIVED, {'function': get_catalog_record_data_catalog_identifier}),
+    FieldSpec('organization_name', None, NAME_LISTS, {'languages': NAME_LANGUAGES}),
+    FieldSpec('date_modified', (('date_modified',), ('date_created',)), FIRST_OF),
+    FieldSpec('title', _rd('title'), OPTIONAL),
+    FieldSpec('description', _rd('description'), OPTIONAL),
+    FieldSpec('keyword', _rd('keyword'), OPTIONAL),
+    FieldSpec('preservation_state', ('preservation_state',), OPTIONAL),
+    FieldSpec('preservation_identifier', ('preservation_identifier',), OPTIONAL),
+    FieldSpec('preservation_dataset_version', ('preservation_dataset_version',), OPTIONAL),
+    FieldSpec('preservation_dataset_origin_version', ('preservation_dataset_origin_version',), OPTIONAL),
+    FieldSpec('other_identifier', _rd('other_identifier'), OTHER_IDENTIFIERS),
+    FieldSpec('access_rights', _rd('access_rights'), ACCESS_RIGHTS),
+    FieldSpec('theme', _rd('theme'), REFERENCES, {'label': 'pref_label'}),
+    FieldSpec('field_of_science', _rd('field_of_science'), REFERENCES, {'label': 'pref_label'}),
+    FieldSpec('infrastructure', _rd('infrastructure'), REFERENCE_ITEMS, {'label': 'pref_label'}),
+    FieldSpec('organization_name', _rd('is_output_of'), FUNDER_NAMES, {'languages': NAME_LANGUAGES}),
+    FieldSpec('project_name', _rd('is_output_of'), PROJECTS, {'languages': NAME_LANGUAGES}),
+    FieldSpec('file_type', (_rd('files'), _rd('remote_resources')), FILE_TYPES,
+              {'field': 'file_type', 'label': 'pref_label'}),
+    FieldSpec('contributor', _rd('contributor'), AGENTS, {'names': 'organization_name'}),
+    FieldSpec('publisher', _rd('publisher'), AGENTS, {'names': 'organization_name'}),
+    FieldSpec('curator', _rd('curator'), AGENTS, {'names': 'organization_name'}),
+    FieldSpec('creator', _rd('creator'), AGENTS, {'names': 'organization_name', 'agent_names': 'creator_name'}),
+    FieldSpec('rights_holder', _rd('rights_holder'), AGENTS, {'names': 'organization_name'}),
+    FieldSpec('organization_name', None, UNIQUE_NAMES, {'languages': NAME_LANGUAGES}),
+    FieldSpec('project_name', None, UNIQUE_NAMES, {'languages': NAME_LANGUAGES}),
+)
+
+# Documents as they were before the name lists were deduplicated, the same organization is listed again for each
+# agent and project it appears in
+MAPPING_WITH_DUPLICATE_NAMES = tuple(spec for spec in MAPPING if spec.kind != UNIQUE_NAMES)
+
+
+def _compile_getter(path):
+    """
+    :return: Function of (catalog record, research dataset) returning the value at path, or None
+    """
+    if path[0] == RESEARCH_DATASET and len(path) == 2:
+        key = path[1]
+        return lambda cr, rd: rd.get(key)
+    if len(path) == 1:
+        key = path[0]
+        return lambda cr, rd: cr.get(key)
+
+    def get(cr, rd):
+        value = cr
+        for key in path:
+            value = value.get(key) if isinstance(value, dict) else None
+        return value
+    return get
+
+
+# Transforms shared by the kinds
+
+def _reference(obj, label):
+    out = {'identifier': obj.get('identifier', ''), label: obj.get(label, {})}
+    if 'description' in obj:
+        out['description'] = obj['description']
+    if 'definition' in obj:
+        out['definition'] = obj['definition']
+    return out
+
+
+def _set_reference(obj, label, out):
+    """
+    Set the fields of a reference data object directly on out
+    """
+    out['identifier'] = obj.get('identifier', '')
+    out[label] = obj.get(label, {})
+    if 'description' in obj:
+        out['description'] = obj['description']
+    if 'definition' in obj:
+        out['definition'] = obj['definition']
+
+
+_MISSING = object()
+
+
+def _approximate_size(obj):
+    """
+    :return: Bytes taken by obj and the dicts, lists and strings it contains, shared objects counted every time
+    """
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            size += sys.getsizeof(key) + _approximate_size(value)
+    elif isinstance(obj, list):
+        for value in obj:
+            size += _approximate_size(value)
+    return size
+
+
+class ReferenceInterner:
+    """
+    Bounded LRU cache of converted reference data objects, keyed by the label field and the identifier of the
+    object. The same licenses, access types, themes, fields of science and file types repeat across nearly every
+    catalog record, so the documents of a batch can share one converted object for each of them instead of
+    keeping a copy per occurrence.
+
+    A cached object is only reused when the label, description and definition of the object being converted are
+    equal to the cached ones, a reference data object changed in Metax is converted again and replaces the cached
+    one. The documents share the cached objects, so they must not be modified after conversion. Not thread safe,
+    use one interner per converting thread.
+    """
+
+    DEFAULT_MAX_SIZE = 10000
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes_saved = 0
+
+    def reference(self, obj, label):
+        """
+        :return: Converted reference data object, the cached one when an equal object has been converted before
+        """
+        identifier = obj.get('identifier')
+        if not identifier or not isinstance(identifier, str):
+            return _reference(obj, label)
+
+        key = (label, identifier)
+        entry = self._entries.get(key)
+        if entry is not None:
+            converted, size = entry
+            if converted[label] == obj.get(label, {}) and \
+                    converted.get('description', _MISSING) == obj.get('description', _MISSING) and \
+                    converted.get('definition', _MISSING) == obj.get('definition', _MISSING):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                self.bytes_saved += size
+                return converted
+
+        self.misses += 1
+        converted = _reference(obj, label)
+        self._entries[key] = (converted, _approximate_size(converted))
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+        return converted
+
+    def __len__(self):
+        return len(self._entries)
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def report(self):
+        return "Reference data interning: {0} lookups, hit rate {1:.1%}, {2} cached objects, {3} evicted, " \
+               "about {4:.1f} MiB of duplicate objects saved".format(
+                   self.hits + self.misses, self.hit_rate(), len(self._entries), self.evictions,
+                   self.bytes_saved / 2 ** 20)
+
+
+def _pick_name(name, preferred_order):
+    for language in preferred_order:
+        if language in name:
+            return name[language]
+
+    # If name is not available in preferred languages, choose any name
+    return list(name.values())[0]
+
+
+def _compile_name_appender(languages):
+    """
+    :param languages: Pair of languages, each with its own name list in the output
+    :return: Function adding the names of organizations or projects, and of the organizations they are part or
+        members of, to the name lists of the output
+    """
+    first_order, second_order = [LANGUAGE_PREFERENCES[language] for language in languages]
+    # Most names are in the preferred language, look it up before going through the preference order
+    first, second = first_order[0], second_order[0]
+
+    def add_names(objs, out, first_field, second_field):
+        first_names = []
+        second_names = []
+        if isinstance(objs, list):
+            for obj in objs:
+                name = obj.get('name')
+                if isinstance(name, dict):
+                    first_name = name[first] if first in name else _pick_name(name, first_order)
+                    second_name = name[second] if second in name else _pick_name(name, second_order)
+                    if first_name is not None and second_name is not None:
+                        first_names.append(first_name)
+                        second_names.append(second_name)
+
+                # Parent organizations are added right away, before the names of this level
+                if 'is_part_of' in obj:
+                    add_names(obj['is_part_of'], out, first_field, second_field)
+                if 'member_of' in obj:
+                    add_names(obj['member_of'], out, first_field, second_field)
+        elif objs:
+            name = objs.get('name')
+            if isinstance(name, dict):
+                first_names.append(_pick_name(name, first_order))
+                second_names.append(_pick_name(name, second_order))
+            else:
+                first_names.append(None)
+                second_names.append(None)
+
+            if 'is_part_of' in objs:
+                add_names(objs['is_part_of'], out, first_field, second_field)
+            if 'member_of' in objs:
+                add_names(objs['member_of'], out, first_field, second_field)
+
+        out[first_field].extend(first_names)
+        out[second_field].extend(second_names)
+
+    return add_names
+
+
+def _agent(obj):
+    if not obj or 'name' not in obj or '@type' not in obj:
+        log.warning("Agent object does not have either name or @type")
+        return None
+
+    agent_type = obj['@type']
+    if agent_type not in AGENT_TYPES:
+        log.warning("Agent object's @type is not one of allowed values")
+        return None
+
+    # Name should be langstring
+    name = obj['name']
+    if not isinstance(name, dict):
+        name = {'und': name}
+
+    out = {'name': name, 'agent_type': agent_type}
+    if obj.get('identifier', False):
+        out['identifier'] = obj['identifier']
+    return out
+
+
+def _agent_with_organization(obj):
+    out = _agent(obj)
+    if out is None:
+        return None
+
+    agent_type = obj.get('@type')
+    if agent_type == 'Person':
+        parent = obj.get('member_of', False)
+    elif agent_type == 'Organization':
+        parent = obj.get('is_part_of', False)
+    else:
+        parent = None
+
+    if parent:
+        org = _agent(parent)
+        if org is not None:
+            out['belongs_to_org'] = org
+    return out
+
+
+# Compilers of the kinds, each returning a closure of (catalog record, research dataset, output document).
+# reference is the function converting reference data objects, _reference or ReferenceInterner.reference.
+
+def _compile_value(target, source, options, reference):
+    get = _compile_getter(source)
+
+    def value(cr, rd, out):
+        out[target] = get(cr, rd)
+    return value
+
+
+def _compile_optional(target, source, options, reference):
+    get = _compile_getter(source)
+
+    def optional(cr, rd, out):
+        value = get(cr, rd)
+        if value:
+            out[target] = value
+    return optional
+
+
+def _compile_first_of(target, source, options, reference):
+    getters = [_compile_getter(path) for path in source]
+
+    def first_of(cr, rd, out):
+        value = None
+        for get in getters:
+            value = get(cr, rd)
+            if value:
+                break
+        out[target] = value
+    return first_of
+
+
+def _compile_derived(target, source, options, reference):
+    function = options['function']
+
+    def derived(cr, rd, out):
+        out[target] = function(cr)
+    return derived
+
+
+def _compile_name_lists(target, source, options, reference):
+    fields = ['{0}_{1}'.format(target, language) for language in options['languages']]
+
+    def name_lists(cr, rd, out):
+        for field in fields:
+            out[field] = []
+    return name_lists
+
+
+def _compile_references(target, source, options, reference):
+    get = _compile_getter(source)
+    label = options['label']
+
+    def references(cr, rd, out):
+        value = get(cr, rd)
+        if not value:
+            return
+        if isinstance(value, list):
+            out[target] = [reference(obj, label) for obj in value]
+        else:
+            out[target] = []
+            if isinstance(value, dict):
+                # A single object is set on the document itself
+                _set_reference(value, label, out)
+    return references
+
+
+def _compile_reference_items(target, source, options, reference):
+    get = _compile_getter(source)
+    label = options['label']
+
+    def reference_items(cr, rd, out):
+        value = get(cr, rd)
+        if value:
+            out[target] = [reference(obj, label) if isinstance(obj, dict) else {} for obj in value]
+    return reference_items
+
+
+def _compile_other_identifiers(target, source, options, reference):
+    get = _compile_getter(source)
+
+    def other_identifiers(cr, rd, out):
+        value = get(cr, rd)
+        if not value:
+            return
+
+        output = out[target] = []
+        for obj in value:
+            other_identifier = {}
+            if obj.get('notation'):
+                other_identifier['notation'] = obj['notation']
+            id_type = obj.get('type', False)
+            if id_type:
+                other_identifier['type'] = reference(id_type, 'pref_label') if isinstance(id_type, dict) else {}
+            output.append(other_identifier)
+    return other_identifiers
+
+
+def _compile_access_rights(target, source, options, reference):
+    get = _compile_getter(source)
+
+    def access_rights(cr, rd, out):
+        value = get(cr, rd)
+        if not value:
+            return
+
+        output = out[target] = {}
+        if 'description' in value:
+            output['description'] = value['description']
+        if 'definition' in value:
+            output['definition'] = value['definition']
+
+        license = value.get('license', False)
+        if license:
+            if isinstance(license, list):
+                output['license'] = [reference(obj, 'title') for obj in license]
+            elif isinstance(license, dict):
+                _set_reference(license, 'title', output)
+
+        access_type = value.get('access_type', False)
+        if access_type:
+            output['access_type'] = reference(access_type, 'pref_label') if isinstance(access_type, dict) else {}
+    return access_rights
+
+
+def _compile_funder_names(target, source, options, reference):
+    get = _compile_getter(source)
+    add_names = _compile_name_appender(options['languages'])
+    first_field, second_field = ['{0}_{1}'.format(target, language) for language in options['languages']]
+
+    def funder_names(cr, rd, out):
+        for project in get(cr, rd) or []:
+            if project.get('has_funding_agency', []):
+                add_names(project['has_funding_agency'], out, first_field, second_field)
+            if project.get('source_organization', []):
+                add_names(project['source_organization'], out, first_field, second_field)
+    return funder_names
+
+
+def _compile_projects(target, source, options, reference):
+    get = _compile_getter(source)
+    add_names = _compile_name_appender(options['languages'])
+    first_field, second_field = ['{0}_{1}'.format(target, language) for language in options['languages']]
+    projects_field = source[-1]
+
+    def projects(cr, rd, out):
+        value = get(cr, rd)
+        if not value:
+            return
+
+        out[first_field] = []
+        out[second_field] = []
+        add_names(value, out, first_field, second_field)
+        out[projects_field] = [{'name': project['name']} for project in value]
+    return projects
+
+
+def _compile_file_types(target, source, options, reference):
+    getters = [_compile_getter(path) for path in source]
+    field = options['field']
+    label = options['label']
+    count_field = options.get('count')
+
+    def file_types(cr, rd, out):
+        values = [get(cr, rd) for get in getters]
+        if not any(values):
+            return
+
+        # Distinct file types in the order they are first encountered. Datasets can have tens of thousands of files
+        # of a handful of types, so the files are only counted instead of converting the file type of each.
+        converted = {}
+        counts = {}
+        for value in values:
+            for obj in value or ():
+                if field not in obj:
+                    continue
+
+                file_type = obj[field]
+                if isinstance(file_type, dict):
+                    key = str(file_type.get('identifier', ''))
+                else:
+                    key = None
+                if key in counts:
+                    counts[key] += 1
+                else:
+                    counts[key] = 1
+                    converted[key] = reference(file_type, label) if key is not None else {}
+
+        if count_field:
+            # The converted objects may be shared with other documents, count on copies
+            out[target] = [dict(file_type, **{count_field: counts[key]}) for key, file_type in converted.items()]
+        else:
+            out[target] = list(converted.values())
+    return file_types
+
+
+def _compile_agents(target, source, options, reference):
+    get = _compile_getter(source)
+    agent_names_field = options.get('agent_names')
+    add_names = _compile_name_appender(NAME_LANGUAGES)
+    first_field, second_field = ['{0}_{1}'.format(options['names'], language) for language in NAME_LANGUAGES]
+
+    def agents(cr, rd, out):
+        value = get(cr, rd)
+        if not value:
+            return
+
+        if isinstance(value, list):
+            converted = [agent for agent in (_agent_with_organization(obj) for obj in value) if agent is not None]
+            out[target] = converted
+            if agent_names_field:
+                names = []
+                for agent in converted:
+                    names.extend(agent['name'].values())
+                out[agent_names_field] = names
+        else:
+            agent = _agent_with_organization(value)
+            out[target] = agent if agent is not None else {}
+            if agent_names_field:
+                out[agent_names_field] = list(agent['name'].values()) if agent is not None else []
+
+        add_names(value, out, first_field, second_field)
+    return agents
+
+
+def _compile_unique_names(target, source, options, reference):
+    first_field, second_field = ['{0}_{1}'.format(target, language) for language in options['languages']]
+
+    def unique_names(cr, rd, out):
+        first_names = out.get(first_field)
+        if not first_names or len(first_names) < 2:
+            return
+
+        # The lists are parallel, a name is repeated only when it is repeated in both languages
+        try:
+            pairs = dict.fromkeys(zip(first_names, out[second_field]))
+        except TypeError:
+            log.warning("Unable to deduplicate {0}, it contains names that are not strings".format(target))
+            return
+
+        if len(pairs) < len(first_names):
+            out[first_field] = [first for first, _ in pairs]
+            out[second_field] = [second for _, second in pairs]
+    return unique_names
+
+
+_COMPILERS = {
+    VALUE: _compile_value,
+    OPTIONAL: _compile_optional,
+    FIRST_OF: _compile_first_of,
+    DERIVED: _compile_derived,
+    NAME_LISTS: _compile_name_lists,
+    REFERENCES: _compile_references,
+    REFERENCE_ITEMS: _compile_reference_items,
+    OTHER_IDENTIFIERS: _compile_other_identifiers,
+    ACCESS_RIGHTS: _compile_access_rights,
+    FUNDER_NAMES: _compile_funder_names,
+    PROJECTS: _compile_projects,
+    FILE_TYPES: _compile_file_types,
+    AGENTS: _compile_agents,
+    UNIQUE_NAMES: _compile_unique_names,
+}
+
+
+def with_options(mapping, kind, **options):
+    """
+    :return: Copy of mapping with options added to the options of the fields of kind
+    """
+    return tuple(spec._replace(options=dict(spec.options or {}, **options)) if spec.kind == kind else spec
+                 for spec in mapping)
+
+
+def compile_mapping(mapping, interner=None):
+    """
+    :param mapping: Sequence of FieldSpec
+    :param interner: ReferenceInterner reusing converted reference data objects, or None to always build new ones
+    :return: List of closures of (catalog record, research dataset, output document) writing the fields in order
+    """
+    reference = interner.reference if interner is not None else _reference
+    steps = []
+    for spec in mapping:
+        if spec.kind not in _COMPILERS:
+            raise ValueError("Unknown transform kind '{0}' for field {1}".format(spec.kind, spec.target))
+        steps.append(_COMPILERS[spec.kind](spec.target, spec.source, spec.options or {}, reference))
+    return steps
+
+
+COMPILED_MAPPING = compile_mapping(MAPPING)
+COMPILED_MAPPING_WITH_DUPLICATE_NAMES = compile_mapping(MAPPING_WITH_DUPLICATE_NAMES)
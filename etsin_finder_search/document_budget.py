@@ -0,0 +1,219 @@
+# This file is part of the Etsin service
+#
+# Copyright 2017-2021 Ministry of Education and Culture, Finland
+#
+# :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# :license: MIT
+
+"""
+Size budget of the Elasticsearch documents, enforced after conversion. A few datasets with enormous descriptions or
+file lists produce documents that are slow to index and can fail a whole bulk request.
+
+The budget is set in the ELASTICSEARCH config:
+    MAX_DOCUMENT_BYTES: Largest serialized document, 0 or unset for no limit
+    MAX_FIELD_BYTES: Largest serialized top level field of a document, 0 or unset for no limit
+    OVERSIZED_DOCUMENT_POLICY: What to do with a document over the budget, one of
+        truncate: shorten the strings and lists of the oversized fields until they fit
+        drop: leave the oversized fields out of the document
+        separate: keep the document as it is, but index it with its own request instead of a bulk request
+    OVERSIZED_REPORT_SIZE: Amount of the largest oversized documents listed in the report of a reindexing run
+
+identifier and preferred_identifier are never truncated or dropped.
+"""
+
+import heapq
+import json
+import threading
+
+from etsin_finder_search import metrics
+from etsin_finder_search.reindexing_log import get_logger
+
+log = get_logger(__name__)
+
+TRUNCATE = 'truncate'
+DROP = 'drop'
+SEPARATE = 'separate'
+POLICIES = (TRUNCATE, DROP, SEPARATE)
+
+PROTECTED_FIELDS = ('identifier', 'preferred_identifier')
+
+
+def _size(value):
+    # Documents are serialized with the defaults of json.dumps, which escape everything outside ASCII, so the length
+    # of the string is its length in bytes
+    return len(json.dumps(value))
+
+
+def _document_size(field_sizes):
+    """
+    :return: Size of the serialized document with the given sizes of its fields, without serializing it again
+    """
+    if not field_sizes:
+        return 2
+    # {"key": value, "key": value}
+    return 2 + sum(_size(field) + 2 + size for field, size in field_sizes.items()) + 2 * (len(field_sizes) - 1)
+
+
+def _truncate(value, budget):
+    """
+    :return: Copy of value with its strings and lists shortened so that it fits in budget bytes when serialized,
+        or None if it cannot be made to fit. value itself is not modified, it may be shared with other documents.
+    """
+    if _size(value) <= budget:
+        return value
+
+    if isinstance(value, str):
+        if budget < 2:
+            return None
+        # Longest prefix that fits, escaping makes the serialized length differ from the length of the string
+        low, high = 0, len(value)
+        while low < high:
+            middle = (low + high + 1) // 2
+            if _size(value[:middle]) <= budget:
+                low = middle
+            else:
+                high = middle - 1
+        return value[:low]
+
+    if isinstance(value, list):
+        if budget < 2:
+            return None
+        kept = []
+        size = 2
+        for item in value:
+            item_size = _size(item) + (2 if kept else 0)
+            if size + item_size > budget:
+                break
+            kept.append(item)
+            size += item_size
+        return kept
+
+    if isinstance(value, dict) and value:
+        # E.g. a langstring, each value gets an equal share of the budget
+        overhead = _size(dict.fromkeys(value)) - len(value) * len('null')
+        share = (budget - overhead) // len(value)
+        truncated = {}
+        for key, item in value.items():
+            truncated_item = _truncate(item, share)
+            if truncated_item is None:
+                return None
+            truncated[key] = truncated_item
+        return truncated
+
+    return None
+
+
+class DocumentBudget:
+
+    def __init__(self, max_document_bytes=0, max_field_bytes=0, policy=TRUNCATE, report_size=10):
+        if policy not in POLICIES:
+            raise ValueError("Unknown oversized document policy '{0}', expected one of {1}".format(
+                policy, ', '.join(POLICIES)))
+
+        self.max_document_bytes = max_document_bytes or 0
+        self.max_field_bytes = max_field_bytes or 0
+        self.policy = policy
+        self.report_size = report_size
+        self.oversized_documents = 0
+        # Heap of (size, identifier, offending fields) of the largest oversized documents
+        self._largest = []
+        # The worker threads of the consumer share one budget
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, es_settings):
+        es_settings = es_settings or {}
+        return cls(es_settings.get('MAX_DOCUMENT_BYTES', 0),
+                   es_settings.get('MAX_FIELD_BYTES', 0),
+                   es_settings.get('OVERSIZED_DOCUMENT_POLICY', TRUNCATE),
+                   es_settings.get('OVERSIZED_REPORT_SIZE', 10))
+
+    @property
+    def enabled(self):
+        return bool(self.max_document_bytes or self.max_field_bytes)
+
+    def apply(self, document):
+        """
+        Truncate or drop the fields of a document over the budget, depending on the policy
+
+        :param document: Converted document, modified in place
+        :return: True if the document is over the budget and should be indexed with a request of its own
+        """
+        if not self.enabled:
+            return False
+
+        field_sizes = {field: _size(value) for field, value in document.items()}
+        document_size = _document_size(field_sizes)
+        oversized_fields = [field for field, size in field_sizes.items()
+                            if self.max_field_bytes and size > self.max_field_bytes and field not in PROTECTED_FIELDS]
+        over_document_budget = bool(self.max_document_bytes) and document_size > self.max_document_bytes
+        if not oversized_fields and not over_document_budget:
+            return False
+
+        identifier = document.get('identifier', '')
+        offending = {field: field_sizes[field] for field in oversized_fields}
+        if over_document_budget:
+            # Without a single oversized field, the largest fields are the ones to blame
+            for field in self._largest_fields(field_sizes)[:3]:
+                offending.setdefault(field, field_sizes[field])
+        self._record(document_size, identifier, offending)
+        log.warning("Document {0} is {1} bytes, over the size budget because of {2}, policy {3}".format(
+            identifier, document_size, self._format_fields(offending.items()), self.policy))
+
+        if self.policy == SEPARATE:
+            return True
+
+        for field in oversized_fields:
+            self._shrink(document, field_sizes, field, self.max_field_bytes)
+
+        if self.max_document_bytes:
+            for field in self._largest_fields(field_sizes):
+                document_size = _document_size(field_sizes)
+                if document_size <= self.max_document_bytes:
+                    break
+                self._shrink(document, field_sizes, field, field_sizes[field] - (document_size - self.max_document_bytes))
+
+            if _document_size(field_sizes) > self.max_document_bytes:
+                log.warning("Document {0} is still over the size budget after applying policy {1}".format(
+                    identifier, self.policy))
+        return False
+
+    def _largest_fields(self, field_sizes):
+        return sorted((field for field in field_sizes if field not in PROTECTED_FIELDS),
+                      key=field_sizes.get, reverse=True)
+
+    def _shrink(self, document, field_sizes, field, budget):
+        value = _truncate(document[field], budget) if self.policy == TRUNCATE else None
+        if value is None:
+            del document[field]
+            del field_sizes[field]
+        else:
+            document[field] = value
+            field_sizes[field] = _size(value)
+
+    def _record(self, document_size, identifier, offending):
+        metrics.OVERSIZED_DOCUMENTS.labels(self.policy).inc()
+        entry = (document_size, identifier, sorted(offending.items(), key=lambda item: item[1], reverse=True))
+        with self._lock:
+            self.oversized_documents += 1
+            if len(self._largest) < self.report_size:
+                heapq.heappush(self._largest, entry)
+            elif self._largest and entry[0] > self._largest[0][0]:
+                heapq.heapreplace(self._largest, entry)
+
+    def largest(self):
+        """
+        :return: List of (size, identifier, [(field, size), ...]) of the largest oversized documents, largest first
+        """
+        with self._lock:
+            return sorted(self._largest, reverse=True)
+
+    def report(self):
+        lines = ["{0} documents over the size budget, policy {1}".format(self.oversized_documents, self.policy)]
+        for size, identifier, fields in self.largest():
+            lines.append("  {0} {1} bytes: {2}".format(identifier, size, self._format_fields(fields)))
+        return '\n'.join(lines)
+
+    @staticmethod
+    def _format_fields(fields):
+        return ', '.join('{0} ({1} bytes)'.format(field, size) for field, size in fields)
@@ -13,11 +13,23 @@ class ESDatasetModel:
     Class for Metax dataset data that can be indexed into Etsin Elasticsearch
     """
 
-    def __init__(self, doc_obj):
+    def __init__(self, doc_obj, separate_request=False, partial=False):
+        """
+        :param doc_obj: Document dict
+        :param separate_request: True to index the document with its own request instead of a bulk request, see
+            DocumentBudget
+        :param partial: True if doc_obj holds only the changed fields of an indexed document, to be sent with an
+            update instead of an index action, see PartialUpdates
+        """
         self.doc_obj = doc_obj
+        self.separate_request = separate_request
+        self.partial = partial
 
     def to_es_document_string(self):
         return json.dumps(self.doc_obj)
 
+    def to_es_update_string(self):
+        return json.dumps({'doc': self.doc_obj})
+
     def get_es_document_id(self):
         return self.doc_obj.get('identifier', '')
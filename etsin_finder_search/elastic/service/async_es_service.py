@@ -0,0 +1,324 @@
+# This file is part of the Etsin service
+#
+# Copyright 2017-2021 Ministry of Education and Culture, Finland
+#
+# :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# :license: MIT
+
+import asyncio
+import itertools
+import json
+from urllib.parse import quote
+
+import aiohttp
+from elasticsearch.exceptions import ConnectionError, HTTP_EXCEPTIONS, TransportError
+
+from etsin_finder_search.elastic.service.es_connection import DEFAULT_COMPRESSION_LEVEL, TransferStats, compress_body
+from etsin_finder_search.elastic.service.es_service_base import BaseElasticSearchService
+from etsin_finder_search.metrics import es_operation
+from etsin_finder_search.partial_updates import FINGERPRINT_FIELD
+from etsin_finder_search.reindexing_log import get_logger
+
+log = get_logger(__name__)
+
+
+class AsyncElasticSearchService(BaseElasticSearchService):
+    """
+    Asyncio counterpart of ElasticSearchService. Talks to the Elasticsearch REST API directly over aiohttp,
+    so that a single process can have many requests in flight at the same time.
+
+    Usage:
+        async with AsyncElasticSearchService(es_config) as es_client:
+            await es_client.do_bulk_request_for_datasets(es_data_models, ids_to_delete)
+    """
+
+    MAX_IN_FLIGHT_REQUESTS = 8
+    SCROLL_PAGE_SIZE = 1000
+    SCROLL_KEEPALIVE = '5m'
+
+    def __init__(self, es_settings, base_urls=None, field_fingerprints=False):
+        super().__init__(es_settings, field_fingerprints)
+        self.base_urls = base_urls or self._get_base_urls(es_settings)
+        self.max_in_flight_requests = es_settings.get('MAX_IN_FLIGHT_REQUESTS', self.MAX_IN_FLIGHT_REQUESTS)
+        self.http_compress = es_settings.get('HTTP_COMPRESS', False)
+        self.compression_level = es_settings.get('HTTP_COMPRESS_LEVEL', DEFAULT_COMPRESSION_LEVEL)
+        self.transfer_stats = TransferStats()
+        self._url_cycle = itertools.cycle(self.base_urls)
+        self._session = None
+        self._in_flight = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def open(self):
+        # The session and the semaphore are bound to the running event loop, so they cannot be created in __init__
+        if self._session is None:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=180))
+            self._in_flight = asyncio.Semaphore(self.max_in_flight_requests)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    @classmethod
+    async def get_elasticsearch_service(cls, es_config, field_fingerprints=False):
+        if es_config:
+            # Set up ElasticSearch client. In case connection cannot be established, try every 2 seconds 30 times
+            log.info("Trying to establish connection with Elasticsearch instance..")
+            es_client = cls(es_config, field_fingerprints=field_fingerprints)
+            await es_client.open()
+            i = 0
+            while i < 30:
+                if await es_client._client_ok():
+                    log.info("Connection established with Elasticsearch instance")
+                    return es_client
+                else:
+                    log.error("Connection not established with Elasticsearch instance, trying again..")
+                    await asyncio.sleep(2)
+                    i += 1
+
+            await es_client.close()
+            log.error("Unable to establish connection with Elasticsearch instance, stopped trying")
+            return None
+        else:
+            log.error("Unable to get Elasticsearch config")
+            return None
+
+    @es_operation('ensure_index_existence')
+    async def ensure_index_existence(self, expected_doc_count=None, avg_doc_bytes=None):
+        if not await self._index_exists():
+            if not await self._create_index_and_mapping(expected_doc_count, avg_doc_bytes):
+                log.error("Unable to create Elasticsearch index and type mapping")
+                return False
+        elif self.field_fingerprints and not self._fingerprint_mapping_checked:
+            await self._put_fingerprint_mapping()
+        return True
+
+    @es_operation('delete_index')
+    async def delete_index(self):
+        log.info("Trying to delete index " + self.INDEX_NAME)
+        return self._operation_ok(await self._request('DELETE', '/' + self.INDEX_NAME, ignore=[404]))
+
+    @es_operation('reindex_dataset')
+    async def reindex_dataset(self, dataset_data_model):
+        log.info("{0} {1} into index {2}".format(
+            "Trying to reindex data with doc id {0} having type".format(dataset_data_model.get_es_document_id()),
+            self.INDEX_DOC_TYPE_NAME, self.INDEX_NAME))
+
+        if dataset_data_model.partial:
+            return self._operation_ok(await self._request(
+                'POST', self._doc_path(dataset_data_model.get_es_document_id()) + '/_update',
+                body=dataset_data_model.to_es_update_string()))
+
+        return self._operation_ok(await self._request(
+            'PUT', self._doc_path(dataset_data_model.get_es_document_id()),
+            body=dataset_data_model.to_es_document_string()))
+
+    @es_operation('delete_dataset_from_index')
+    async def delete_dataset_from_index(self, doc_id):
+        log.info("{0}{1} from index {2}".format(
+            "Trying to delete data with doc id {0} having type ".format(doc_id), self.INDEX_DOC_TYPE_NAME,
+            self.INDEX_NAME))
+
+        # A missing document is answered with 404, so no separate existence check round trip is needed
+        response = await self._request('DELETE', self._doc_path(doc_id), ignore=[404])
+        if response.get('found') is False or response.get('result') == 'not_found':
+            log.info("The document does not exist in the index, ignoring")
+            return True
+
+        return self._operation_ok(response)
+
+    @es_operation('get_all_doc_ids_from_index')
+    async def get_all_doc_ids_from_index(self):
+        if not await self._index_exists():
+            log.error("No index exists")
+            return None
+
+        all_doc_ids = []
+        response = await self._request(
+            'POST', '/{0}/_search'.format(self.INDEX_NAME), params={'scroll': self.SCROLL_KEEPALIVE},
+            body=json.dumps({'query': {'match_all': {}}, '_source': False, 'size': self.SCROLL_PAGE_SIZE}))
+        scroll_id = response.get('_scroll_id')
+        hits = response.get('hits', {}).get('hits', [])
+
+        try:
+            while hits:
+                all_doc_ids.extend(row['_id'] for row in hits if row.get('_id', False))
+                if not scroll_id:
+                    break
+
+                response = await self._request(
+                    'POST', '/_search/scroll',
+                    body=json.dumps({'scroll': self.SCROLL_KEEPALIVE, 'scroll_id': scroll_id}))
+                scroll_id = response.get('_scroll_id')
+                hits = response.get('hits', {}).get('hits', [])
+        finally:
+            if scroll_id:
+                await self._request('DELETE', '/_search/scroll', body=json.dumps({'scroll_id': [scroll_id]}),
+                                    ignore=[404])
+
+        return all_doc_ids
+
+    @es_operation('get_field_fingerprints')
+    async def get_field_fingerprints(self, doc_ids):
+        """
+        :return: Dict of the given doc ids found in the index to their field fingerprints, empty if the request fails
+        """
+        if not doc_ids:
+            return {}
+
+        try:
+            response = await self._request(
+                'POST', '/{0}/{1}/_mget'.format(self.INDEX_NAME, self.INDEX_DOC_TYPE_NAME),
+                params={'_source_include': FINGERPRINT_FIELD}, body=json.dumps({'ids': list(doc_ids)}))
+        except TransportError as e:
+            log.error(e)
+            log.error("Unable to get field fingerprints, sending whole documents")
+            return {}
+
+        return dict((doc['_id'], doc.get('_source', {}).get(FINGERPRINT_FIELD)) for doc in response.get('docs', [])
+                    if doc.get('found'))
+
+    @es_operation('do_bulk_request_for_datasets')
+    async def do_bulk_request_for_datasets(self, dataset_models_to_reindex, doc_ids_to_delete):
+        """
+        Split the reindex and delete rows into bulk requests of BULK_OPERATION_ROW_SIZE rows and send them
+        concurrently. The amount of simultaneous requests is limited by max_in_flight_requests.
+
+        :return: True if all bulk requests succeeded
+        """
+
+        log.info("Reindexing {0} documents and trying to delete {1} documents".format(
+            str(len(dataset_models_to_reindex)), str(len(doc_ids_to_delete))))
+
+        rows = []
+        bulk_requests = []
+        for dataset_data in dataset_models_to_reindex:
+            if dataset_data.separate_request:
+                # Oversized documents are indexed one by one so that they cannot fail or slow down a bulk request
+                bulk_requests.append(self.reindex_dataset(dataset_data))
+                continue
+            rows.append(self._create_bulk_update_row(dataset_data))
+            if len(rows) == self.BULK_OPERATION_ROW_SIZE:
+                bulk_requests.append(self._do_bulk_request("\n".join(rows) + "\n"))
+                rows = []
+
+        for doc_id in doc_ids_to_delete:
+            rows.append(self._create_bulk_delete_row(doc_id))
+            if len(rows) == self.BULK_OPERATION_ROW_SIZE:
+                bulk_requests.append(self._do_bulk_request("\n".join(rows) + "\n"))
+                rows = []
+
+        if rows:
+            bulk_requests.append(self._do_bulk_request("\n".join(rows) + "\n"))
+
+        results = await asyncio.gather(*bulk_requests)
+        return all(results)
+
+    async def _do_bulk_request(self, bulk_request_str):
+        log.info("Trying to perform bulk request for data with type {0} into index {1}".format(
+            self.INDEX_DOC_TYPE_NAME, self.INDEX_NAME))
+
+        try:
+            response = await self._request('POST', '/_bulk', body=bulk_request_str,
+                                           content_type='application/x-ndjson', timeout=30)
+        except TransportError as e:
+            log.error(e)
+            response = {'errors': True}
+
+        if not self._operation_ok(response):
+            log.error("Something went wrong with the following bulk request: \n{0}".format(bulk_request_str))
+            return False
+
+        return True
+
+    async def _create_index_and_mapping(self, expected_doc_count=None, avg_doc_bytes=None):
+        log.info("Trying to create index " + self.INDEX_NAME)
+        index_definition = self._get_index_definition_with_layout(expected_doc_count, avg_doc_bytes)
+        is_ok = self._operation_ok(await self._request('PUT', '/' + self.INDEX_NAME,
+                                                       body=json.dumps(index_definition)))
+        if is_ok:
+            log.info("Trying to create mapping type " + self.INDEX_DOC_TYPE_NAME + " for index " + self.INDEX_NAME)
+            return self._operation_ok(await self._request(
+                'PUT', '/{0}/_mapping/{1}'.format(self.INDEX_NAME, self.INDEX_DOC_TYPE_NAME),
+                body=json.dumps(self._get_json_file_as_str(self.INDEX_DOC_TYPE_MAPPING_FILENAME))))
+        return False
+
+    async def _put_fingerprint_mapping(self):
+        try:
+            self._operation_ok(await self._request(
+                'PUT', '/{0}/_mapping/{1}'.format(self.INDEX_NAME, self.INDEX_DOC_TYPE_NAME),
+                body=json.dumps(self._get_fingerprint_mapping())))
+        except TransportError as e:
+            log.error("Unable to map {0}, recreate the index to stop indexing it: {1}".format(FINGERPRINT_FIELD, e))
+
+    async def _client_ok(self):
+        try:
+            await self._request('HEAD', '/')
+            return True
+        except Exception:
+            return False
+
+    async def _index_exists(self):
+        response = await self._request('HEAD', '/' + self.INDEX_NAME, ignore=[404])
+        return response.get('status') != 404
+
+    async def _request(self, method, path, body=None, params=None, ignore=(), content_type='application/json',
+                       timeout=None):
+        """
+        Perform a single HTTP request against the next Elasticsearch host. Error responses are raised as the same
+        exceptions the synchronous elasticsearch client raises, unless their status code is listed in ignore.
+
+        :return: Response body as dict. Bodiless responses (HEAD) are returned as {'status': status_code}
+        """
+
+        url = next(self._url_cycle) + path
+        request_kwargs = {'params': params, 'headers': {'Content-Type': content_type}}
+        if body is not None:
+            data = body.encode('utf-8') if isinstance(body, str) else body
+            body_bytes = len(data)
+            compress_cpu_seconds = 0.0
+            if self.http_compress:
+                data, compress_cpu_seconds = compress_body(data, self.compression_level)
+                request_kwargs['headers']['Content-Encoding'] = 'gzip'
+            self.transfer_stats.record(path, body_bytes, len(data), compress_cpu_seconds)
+            request_kwargs['data'] = data
+        if timeout is not None:
+            request_kwargs['timeout'] = aiohttp.ClientTimeout(total=timeout)
+
+        async with self._in_flight:
+            try:
+                async with self._session.request(method, url, **request_kwargs) as response:
+                    status = response.status
+                    raw_data = await response.text()
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                raise ConnectionError('N/A', str(e), e)
+
+        try:
+            data = json.loads(raw_data) if raw_data else {'status': status}
+        except ValueError:
+            data = {'status': status, 'body': raw_data}
+
+        if not 200 <= status < 300 and status not in ignore:
+            error_message = data.get('error', raw_data) if isinstance(data, dict) else raw_data
+            raise HTTP_EXCEPTIONS.get(status, TransportError)(status, error_message, data)
+
+        return data
+
+    def _doc_path(self, doc_id):
+        return '/{0}/{1}/{2}'.format(self.INDEX_NAME, self.INDEX_DOC_TYPE_NAME, quote(doc_id, safe=''))
+
+    @classmethod
+    def _get_base_urls(cls, settings):
+        """
+        Build host base urls using the same port and protocol rules as the synchronous client
+        """
+        conn_params = cls._get_connection_parameters(settings)
+        scheme = 'https' if conn_params.get('use_ssl', False) else 'http'
+        port = conn_params.get('port', 9200)
+        return ['{0}://{1}:{2}'.format(scheme, host, port) for host in settings['HOSTS']]
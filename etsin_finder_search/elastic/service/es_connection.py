@@ -0,0 +1,106 @@
+# This file is part of the Etsin service
+#
+# Copyright 2017-2021 Ministry of Education and Culture, Finland
+#
+# :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# :license: MIT
+
+import gzip
+import threading
+from time import thread_time
+
+import urllib3
+from elasticsearch.connection import Urllib3HttpConnection
+
+DEFAULT_COMPRESSION_LEVEL = 6
+
+
+class TransferStats:
+    """
+    Request body sizes before and after compression and the CPU time spent compressing, collected separately for
+    bulk requests and for all other requests
+    """
+
+    BULK = 'bulk'
+    OTHER = 'other'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stats = {
+            self.BULK: {'requests': 0, 'body_bytes': 0, 'wire_bytes': 0, 'compress_cpu_seconds': 0.0},
+            self.OTHER: {'requests': 0, 'body_bytes': 0, 'wire_bytes': 0, 'compress_cpu_seconds': 0.0},
+        }
+
+    def record(self, url, body_bytes, wire_bytes, compress_cpu_seconds):
+        kind = self.BULK if url.split('?', 1)[0].endswith('/_bulk') else self.OTHER
+        with self._lock:
+            stats = self.stats[kind]
+            stats['requests'] += 1
+            stats['body_bytes'] += body_bytes
+            stats['wire_bytes'] += wire_bytes
+            stats['compress_cpu_seconds'] += compress_cpu_seconds
+
+    def report(self):
+        """
+        :return: Human readable summary, one line per request kind
+        """
+        lines = []
+        with self._lock:
+            for kind, stats in self.stats.items():
+                if not stats['requests']:
+                    continue
+                ratio = stats['wire_bytes'] / stats['body_bytes'] if stats['body_bytes'] else 1.0
+                lines.append(
+                    "{0} requests: {1}, request body bytes: {2}, bytes on the wire: {3} ({4:.1%}), "
+                    "compression CPU: {5:.3f} s total, {6:.2f} ms per request".format(
+                        kind, stats['requests'], stats['body_bytes'], stats['wire_bytes'], ratio,
+                        stats['compress_cpu_seconds'], stats['compress_cpu_seconds'] * 1000 / stats['requests']))
+        return "\n".join(lines) if lines else "No requests with a body were sent"
+
+
+def compress_body(body, compression_level=DEFAULT_COMPRESSION_LEVEL):
+    """
+    :return: Tuple of gzip compressed body and the CPU seconds spent compressing it
+    """
+    start = thread_time()
+    compressed = gzip.compress(body, compresslevel=compression_level)
+    return compressed, thread_time() - start
+
+
+class MeasuredHttpConnection(Urllib3HttpConnection):
+    """
+    Urllib3HttpConnection that records request body sizes into TransferStats and, if http_compress is set,
+    sends request bodies gzip compressed and asks for compressed responses.
+    The elasticsearch client version in use has no built-in support for request compression.
+    """
+
+    def __init__(self, http_compress=False, compression_level=DEFAULT_COMPRESSION_LEVEL, transfer_stats=None,
+                 **kwargs):
+        super(MeasuredHttpConnection, self).__init__(**kwargs)
+        self.http_compress = http_compress
+        self.compression_level = compression_level
+        self.transfer_stats = transfer_stats
+        if http_compress:
+            self.headers.update(urllib3.make_headers(accept_encoding=True))
+            # The parent class sends self.headers with every request and has no per request headers, so
+            # content-encoding is added by _urlopen_compressed to the requests that carry a compressed body
+            self._pool_urlopen = self.pool.urlopen
+            self.pool.urlopen = self._urlopen_compressed
+
+    def perform_request(self, method, url, params=None, body=None, timeout=None, ignore=()):
+        if body:
+            body_bytes = len(body)
+            compress_cpu_seconds = 0.0
+            if self.http_compress:
+                body, compress_cpu_seconds = compress_body(body, self.compression_level)
+            if self.transfer_stats is not None:
+                self.transfer_stats.record(url, body_bytes, len(body), compress_cpu_seconds)
+
+        return super(MeasuredHttpConnection, self).perform_request(method, url, params=params, body=body,
+                                                                   timeout=timeout, ignore=ignore)
+
+    def _urlopen_compressed(self, method, url, body=None, headers=None, **kwargs):
+        # Request bodies are always compressed in perform_request when http_compress is set
+        if body:
+            headers = dict(headers or {}, **{'content-encoding': 'gzip'})
+        return self._pool_urlopen(method, url, body, headers=headers, **kwargs)
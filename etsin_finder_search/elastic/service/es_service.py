@@ -5,40 +5,45 @@
 # :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
 # :license: MIT
 
-import json
-from os import path
 from time import sleep
 
 from elasticsearch import Elasticsearch
 from elasticsearch.helpers import scan
 
+from etsin_finder_search.elastic.service.es_connection import \
+    DEFAULT_COMPRESSION_LEVEL, \
+    MeasuredHttpConnection, \
+    TransferStats
+from etsin_finder_search.elastic.service.es_service_base import BaseElasticSearchService
+from etsin_finder_search.metrics import es_operation
+from etsin_finder_search.partial_updates import FINGERPRINT_FIELD
 from etsin_finder_search.reindexing_log import get_logger
 
 log = get_logger(__name__)
 
 
-class ElasticSearchService:
+class ElasticSearchService(BaseElasticSearchService):
     """
     Service for operating with Elasticsearch APIs
     """
 
-    INDEX_NAME = 'metax'
-    INDEX_CONFIG_FILENAME = 'metax_index_definition.json'
-    INDEX_DOC_TYPE_NAME = 'dataset'
-    INDEX_DOC_TYPE_MAPPING_FILENAME = 'dataset_type_mapping.json'
-    BULK_OPERATION_ROW_SIZE = 300
-
-    def __init__(self, es_settings):
-        self.es = Elasticsearch(es_settings.get('HOSTS'), timeout=180, **self._get_connection_parameters(es_settings))
+    def __init__(self, es_settings, field_fingerprints=False):
+        super().__init__(es_settings, field_fingerprints)
+        # Request bodies are gzip compressed when HTTP_COMPRESS is set. Sizes are recorded into transfer_stats either way
+        self.transfer_stats = TransferStats()
+        self.es = Elasticsearch(es_settings.get('HOSTS'), timeout=180, connection_class=MeasuredHttpConnection,
+                                http_compress=es_settings.get('HTTP_COMPRESS', False),
+                                compression_level=es_settings.get('HTTP_COMPRESS_LEVEL', DEFAULT_COMPRESSION_LEVEL),
+                                transfer_stats=self.transfer_stats, **self._get_connection_parameters(es_settings))
 
     @classmethod
-    def get_elasticsearch_service(cls, es_config):
+    def get_elasticsearch_service(cls, es_config, field_fingerprints=False):
         if es_config:
             # Set up ElasticSearch client. In case connection cannot be established, try every 2 seconds 30 times
             log.info("Trying to establish connection with Elasticsearch instance..")
             i = 0
             while i < 30:
-                es_client = cls(es_config)
+                es_client = cls(es_config, field_fingerprints)
                 if es_client._client_ok():
                     log.info("Connection established with Elasticsearch instance")
                     return es_client
@@ -53,27 +58,39 @@ class ElasticSearchService:
             log.error("Unable to get Elasticsearch config")
             return None
 
-    def ensure_index_existence(self):
+    @es_operation('ensure_index_existence')
+    def ensure_index_existence(self, expected_doc_count=None, avg_doc_bytes=None):
         if not self._index_exists():
-            if not self._create_index_and_mapping():
+            if not self._create_index_and_mapping(expected_doc_count, avg_doc_bytes):
                 log.error("Unable to create Elasticsearch index and type mapping")
                 return False
+        elif self.field_fingerprints and not self._fingerprint_mapping_checked:
+            self._put_fingerprint_mapping()
         return True
 
+    @es_operation('delete_index')
     def delete_index(self):
         log.info("Trying to delete index " + self.INDEX_NAME)
         return self._operation_ok(self.es.indices.delete(index=self.INDEX_NAME, ignore=[404]))
 
+    @es_operation('reindex_dataset')
     def reindex_dataset(self, dataset_data_model):
         log.info("{0} {1} into index {2}".format(
             "Trying to reindex data with doc id {0} having type".format(dataset_data_model.get_es_document_id()),
             self.INDEX_DOC_TYPE_NAME, self.INDEX_NAME))
 
+        if dataset_data_model.partial:
+            return self._operation_ok(self.es.update(
+                index=self.INDEX_NAME, doc_type=self.INDEX_DOC_TYPE_NAME,
+                id=dataset_data_model.get_es_document_id(),
+                body=dataset_data_model.to_es_update_string()))
+
         return self._operation_ok(self.es.index(
             index=self.INDEX_NAME, doc_type=self.INDEX_DOC_TYPE_NAME,
             id=dataset_data_model.get_es_document_id(),
             body=dataset_data_model.to_es_document_string()))
 
+    @es_operation('delete_dataset_from_index')
     def delete_dataset_from_index(self, doc_id):
         log.info("{0}{1} from index {2}".format(
             "Trying to delete data with doc id {0} having type ".format(doc_id), self.INDEX_DOC_TYPE_NAME,
@@ -85,6 +102,7 @@ class ElasticSearchService:
             log.info("The document does not exist in the index, ignoring")
             return True
 
+    @es_operation('get_all_doc_ids_from_index')
     def get_all_doc_ids_from_index(self):
         if not self._index_exists():
             log.error("No index exists")
@@ -98,6 +116,41 @@ class ElasticSearchService:
 
         return all_doc_ids
 
+    @es_operation('get_all_field_fingerprints_from_index')
+    def get_all_field_fingerprints_from_index(self):
+        """
+        :return: Dict of the ids of all documents in the index to their field fingerprints, None for the documents
+            without them, see PartialUpdates. None if no index exists.
+        """
+        if not self._index_exists():
+            log.error("No index exists")
+            return None
+
+        all_rows = scan(self.es, query={'query': {'match_all': {}}, "_source": [FINGERPRINT_FIELD]},
+                        index=self.INDEX_NAME)
+        return dict((row['_id'], row.get('_source', {}).get(FINGERPRINT_FIELD)) for row in all_rows
+                    if row.get('_id', False))
+
+    @es_operation('get_field_fingerprints')
+    def get_field_fingerprints(self, doc_ids):
+        """
+        :return: Dict of the given doc ids found in the index to their field fingerprints, empty if the request fails
+        """
+        if not doc_ids:
+            return {}
+
+        try:
+            response = self.es.mget(body={'ids': list(doc_ids)}, index=self.INDEX_NAME,
+                                    doc_type=self.INDEX_DOC_TYPE_NAME, _source_include=FINGERPRINT_FIELD)
+        except Exception as e:
+            log.error(e)
+            log.error("Unable to get field fingerprints, sending whole documents")
+            return {}
+
+        return dict((doc['_id'], doc.get('_source', {}).get(FINGERPRINT_FIELD)) for doc in response.get('docs', [])
+                    if doc.get('found'))
+
+    @es_operation('do_bulk_request_for_datasets')
     def do_bulk_request_for_datasets(self, dataset_models_to_reindex, doc_ids_to_delete):
         bulk_request_str = ''
 
@@ -105,7 +158,14 @@ class ElasticSearchService:
             str(len(dataset_models_to_reindex)), str(len(doc_ids_to_delete))))
 
         if dataset_models_to_reindex:
-            for item_no, dataset_data in enumerate(dataset_models_to_reindex, start=1):
+            # Oversized documents are indexed one by one so that they cannot fail or slow down a whole bulk request
+            separate = [dataset_data for dataset_data in dataset_models_to_reindex if dataset_data.separate_request]
+            for dataset_data in separate:
+                self.reindex_dataset(dataset_data)
+
+            bulk_models = [dataset_data for dataset_data in dataset_models_to_reindex
+                           if not dataset_data.separate_request] if separate else dataset_models_to_reindex
+            for item_no, dataset_data in enumerate(bulk_models, start=1):
                 bulk_request_str += self._create_bulk_update_row(dataset_data) + "\n"
                 if item_no % self.BULK_OPERATION_ROW_SIZE == 0:
                     self._do_bulk_request(bulk_request_str)
@@ -121,6 +181,53 @@ class ElasticSearchService:
         if bulk_request_str:
             self._do_bulk_request(bulk_request_str)
 
+    @es_operation('do_bulk_request_for_actions')
+    def do_bulk_request_for_actions(self, actions):
+        """
+        Perform index and delete actions in a single bulk request. Deleting a document that does not exist
+        is considered successful.
+
+        :param actions: List of ('index', ESDatasetModel) or ('delete', doc_id) tuples
+        :return: List of booleans telling whether each action succeeded, in the same order as actions
+        """
+        if not actions:
+            return []
+
+        # Oversized documents are indexed one by one so that they cannot fail or slow down the bulk request
+        separate_results = {}
+        rows = []
+        for position, (action, payload) in enumerate(actions):
+            if action == 'index' and payload.separate_request:
+                separate_results[position] = self.reindex_dataset(payload)
+            elif action == 'index':
+                rows.append(self._create_bulk_update_row(payload))
+            else:
+                rows.append(self._create_bulk_delete_row(payload))
+
+        if not rows:
+            return [separate_results[position] for position in range(len(actions))]
+
+        log.info("Trying to perform bulk request of {0} actions for data with type {1} into index {2}".format(
+            len(rows), self.INDEX_DOC_TYPE_NAME, self.INDEX_NAME))
+
+        try:
+            response = self.es.bulk(body="\n".join(rows) + "\n", request_timeout=30)
+        except Exception as e:
+            log.error(e)
+            log.error("Bulk request failed")
+            response = {}
+            results = [False] * len(rows)
+        else:
+            results = [self._bulk_item_ok(item) for item in response.get('items', [])]
+            if not all(results):
+                log.error('The performed bulk request had errors: \n{0}'.format(
+                    [item for item, ok in zip(response.get('items', []), results) if not ok]))
+            results += [False] * (len(rows) - len(results))
+
+        bulk_results = iter(results)
+        return [separate_results[position] if position in separate_results else next(bulk_results)
+                for position in range(len(actions))]
+
     def _do_bulk_request(self, bulk_request_str):
         log.info("Trying to perform bulk request for data with type {0} into index {1}".format(
             self.INDEX_DOC_TYPE_NAME, self.INDEX_NAME))
@@ -136,19 +243,10 @@ class ElasticSearchService:
         return self._operation_ok(self.es.delete_by_query(index=self.INDEX_NAME,
                                                           body="{\"query\": { \"match_all\": {}}}"))
 
-    def _create_bulk_update_row(self, dataset_data_model):
-        return "{\"index\":{\"_index\": \"" + self.INDEX_NAME + "\", \"_type\": \"" + self.INDEX_DOC_TYPE_NAME \
-               + "\", \"_id\":\"" + dataset_data_model.get_es_document_id() + "\"}}\n" + \
-               dataset_data_model.to_es_document_string()
-
-    def _create_bulk_delete_row(self, doc_id):
-        return "{\"delete\":{\"_index\": \"" + self.INDEX_NAME + "\", \"_type\": \"" + self.INDEX_DOC_TYPE_NAME + \
-               "\", \"_id\":\"" + doc_id + "\"}}"
-
-    def _create_index_and_mapping(self):
+    def _create_index_and_mapping(self, expected_doc_count=None, avg_doc_bytes=None):
         log.info("Trying to create index " + self.INDEX_NAME)
-        is_ok = self._operation_ok(self.es.indices.create(index=self.INDEX_NAME,
-                                                         body=self._get_json_file_as_str(self.INDEX_CONFIG_FILENAME)))
+        is_ok = self._operation_ok(self.es.indices.create(
+            index=self.INDEX_NAME, body=self._get_index_definition_with_layout(expected_doc_count, avg_doc_bytes)))
         if is_ok:
             log.info("Trying to create mapping type " + self.INDEX_DOC_TYPE_NAME + " for index " + self.INDEX_NAME)
             return self._operation_ok(
@@ -156,6 +254,13 @@ class ElasticSearchService:
                                             body=self._get_json_file_as_str(self.INDEX_DOC_TYPE_MAPPING_FILENAME)))
         return False
 
+    def _put_fingerprint_mapping(self):
+        try:
+            self._operation_ok(self.es.indices.put_mapping(
+                index=self.INDEX_NAME, doc_type=self.INDEX_DOC_TYPE_NAME, body=self._get_fingerprint_mapping()))
+        except Exception as e:
+            log.error("Unable to map {0}, recreate the index to stop indexing it: {1}".format(FINGERPRINT_FIELD, e))
+
     def _client_ok(self):
         try:
             is_ok = self.es and self.es.ping()
@@ -171,33 +276,7 @@ class ElasticSearchService:
         return self.es.exists(self.INDEX_NAME, self.INDEX_DOC_TYPE_NAME, doc_id)
 
     @staticmethod
-    def _operation_ok(op_response):
-        if ('errors' in op_response and op_response.get('errors')) or \
-                ('acknowledged' in op_response and not op_response.get('acknowledged')):
-            log.error('The performed operation had errors: \n{0}'.format(op_response))
-            return False
-
-        log.info('Operation OK')
-        return True
-
-    @staticmethod
-    def _get_json_file_as_str(filename):
-        with open(path.dirname(__file__) + '/../resources/' + filename) as json_data:
-            return json.load(json_data)
-
-    @staticmethod
-    def _get_connection_parameters(settings):
-        """
-        https://docs.objectrocket.com/elastic_python_examples.html
-        """
-        if settings['HOSTS'][0] != 'localhost':
-            conf = {'send_get_body_as': 'GET'}
-            if settings.get('USE_SSL', False):
-                conf.update({'port': 443, 'use_ssl': True, 'verify_certs': True})
-            if settings.get('PORT', False):
-                if path.isfile("/.dockerenv"):
-                    conf.update({'port': 9201, 'use_ssl': False, 'verify_certs': False})
-                else:
-                    conf.update({'port': 9200})
-            return conf
-        return {}
+    def _bulk_item_ok(item):
+        action, result = next(iter(item.items()))
+        status = result.get('status', 500)
+        return 200 <= status < 300 or (action == 'delete' and status == 404)
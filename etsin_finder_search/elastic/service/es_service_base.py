@@ -0,0 +1,166 @@
+# This file is part of the Etsin service
+#
+# Copyright 2017-2021 Ministry of Education and Culture, Finland
+#
+# :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# :license: MIT
+
+import json
+import math
+from os import path
+
+from etsin_finder_search.partial_updates import FINGERPRINT_FIELD
+from etsin_finder_search.reindexing_log import get_logger
+
+log = get_logger(__name__)
+
+
+class BaseElasticSearchService:
+    """
+    Index definition, index layout and bulk row building shared by ElasticSearchService and
+    AsyncElasticSearchService, which differ only in how they talk to Elasticsearch
+    """
+
+    INDEX_NAME = 'metax'
+    INDEX_CONFIG_FILENAME = 'metax_index_definition.json'
+    INDEX_DOC_TYPE_NAME = 'dataset'
+    INDEX_DOC_TYPE_MAPPING_FILENAME = 'dataset_type_mapping.json'
+    ANALYZER_PROFILES = ['ngram', 'edge_ngram', 'standard']
+    DEFAULT_ANALYZER_PROFILE = 'ngram'
+    BULK_OPERATION_ROW_SIZE = 300
+    TARGET_SHARD_SIZE_GB = 20
+    # Estimated ratio of primary shard store size to the size of the indexed JSON documents
+    INDEX_SIZE_FACTOR = 1.5
+
+    def __init__(self, es_settings, field_fingerprints=False):
+        """
+        :param field_fingerprints: Whether field fingerprints are written into the documents, e.g. to skip unchanged
+            documents, so that their mapping is put into an existing index. Always the case with PARTIAL_UPDATES.
+        """
+        self.analyzer_profile = es_settings.get('ANALYZER_PROFILE', self.DEFAULT_ANALYZER_PROFILE)
+        self.number_of_shards = es_settings.get('NUMBER_OF_SHARDS')
+        self.number_of_replicas = es_settings.get('NUMBER_OF_REPLICAS')
+        self.target_shard_size_gb = es_settings.get('TARGET_SHARD_SIZE_GB', self.TARGET_SHARD_SIZE_GB)
+        self.field_fingerprints = field_fingerprints or es_settings.get('PARTIAL_UPDATES', False)
+        self._fingerprint_mapping_checked = False
+
+    def _create_bulk_update_row(self, dataset_data_model):
+        if dataset_data_model.partial:
+            return "{\"update\":{\"_index\": \"" + self.INDEX_NAME + "\", \"_type\": \"" + \
+                   self.INDEX_DOC_TYPE_NAME + "\", \"_id\":\"" + dataset_data_model.get_es_document_id() + "\"}}\n" + \
+                   dataset_data_model.to_es_update_string()
+        return "{\"index\":{\"_index\": \"" + self.INDEX_NAME + "\", \"_type\": \"" + self.INDEX_DOC_TYPE_NAME \
+               + "\", \"_id\":\"" + dataset_data_model.get_es_document_id() + "\"}}\n" + \
+               dataset_data_model.to_es_document_string()
+
+    def _create_bulk_delete_row(self, doc_id):
+        return "{\"delete\":{\"_index\": \"" + self.INDEX_NAME + "\", \"_type\": \"" + self.INDEX_DOC_TYPE_NAME + \
+               "\", \"_id\":\"" + doc_id + "\"}}"
+
+    def _get_index_definition_with_layout(self, expected_doc_count, avg_doc_bytes):
+        index_definition = self.get_index_definition(self.analyzer_profile)
+        index_settings = index_definition['settings']['index']
+        shards, replicas, reasoning = self._get_index_layout(index_settings, expected_doc_count, avg_doc_bytes)
+        index_settings.update({'number_of_shards': shards, 'number_of_replicas': replicas})
+        log.info("Index {0} layout: {1} shards, {2} replicas. {3}".format(self.INDEX_NAME, shards, replicas, reasoning))
+        return index_definition
+
+    def _get_index_layout(self, index_settings, expected_doc_count, avg_doc_bytes):
+        """
+        Decide the shard and replica counts of a new index. NUMBER_OF_SHARDS and NUMBER_OF_REPLICAS in the config
+        override everything else. Otherwise the shard count is the expected primary store size divided by
+        TARGET_SHARD_SIZE_GB, when the corpus size is known, and the index definition file value when it is not.
+
+        :param index_settings: 'index' settings of the index definition
+        :param expected_doc_count: Amount of documents going to be indexed, or None
+        :param avg_doc_bytes: Average Elasticsearch document size in bytes, or a function estimating it, called only
+            when the shard count is computed, or None
+        :return: Tuple of number of shards, number of replicas and the reasoning behind them
+        """
+        if not self.number_of_shards and expected_doc_count and callable(avg_doc_bytes):
+            avg_doc_bytes = avg_doc_bytes()
+
+        if self.number_of_shards:
+            shards = self.number_of_shards
+            shards_reason = "Shard count set in config."
+        elif expected_doc_count and avg_doc_bytes:
+            expected_gb = expected_doc_count * avg_doc_bytes * self.INDEX_SIZE_FACTOR / 1024 ** 3
+            shards = max(1, int(math.ceil(expected_gb / self.target_shard_size_gb)))
+            shards_reason = "Shard count from {0} documents * {1} bytes on average * index size factor {2} = " \
+                            "{3:.2f} GB expected, target shard size {4} GB.".format(
+                                expected_doc_count, int(avg_doc_bytes), self.INDEX_SIZE_FACTOR, expected_gb,
+                                self.target_shard_size_gb)
+        else:
+            shards = index_settings['number_of_shards']
+            shards_reason = "Corpus size not known, shard count from {0}.".format(self.INDEX_CONFIG_FILENAME)
+
+        if self.number_of_replicas is not None:
+            replicas = self.number_of_replicas
+            replicas_reason = "Replica count set in config."
+        else:
+            replicas = index_settings['number_of_replicas']
+            replicas_reason = "Replica count from {0}.".format(self.INDEX_CONFIG_FILENAME)
+
+        return shards, replicas, shards_reason + " " + replicas_reason
+
+    @staticmethod
+    def _operation_ok(op_response):
+        if ('errors' in op_response and op_response.get('errors')) or \
+                ('acknowledged' in op_response and not op_response.get('acknowledged')):
+            log.error('The performed operation had errors: \n{0}'.format(op_response))
+            return False
+
+        log.info('Operation OK')
+        return True
+
+    def _get_fingerprint_mapping(self):
+        """
+        Mapping of the field fingerprints, put into an index created before they were written into the documents.
+        Without it the fingerprints would be mapped dynamically and end up searchable. Put once, a conflicting
+        dynamic mapping is only logged since it can be fixed by recreating the index.
+
+        :return: Body of the put mapping request
+        """
+        self._fingerprint_mapping_checked = True
+        mapping = self._get_json_file_as_str(self.INDEX_DOC_TYPE_MAPPING_FILENAME)
+        return {'properties': {FINGERPRINT_FIELD: mapping['properties'][FINGERPRINT_FIELD]}}
+
+    @classmethod
+    def get_index_definition(cls, analyzer_profile):
+        """
+        Index settings with the analysis section of the given analyzer profile. All profiles define the same analyzer
+        names, so the profile can be changed by recreating the index without touching the mapping or the queries.
+
+        :param analyzer_profile: One of ANALYZER_PROFILES, see resources/analyzer_profiles
+        :return: Index definition as dict
+        """
+        if analyzer_profile not in cls.ANALYZER_PROFILES:
+            log.error("Unknown analyzer profile {0}, using {1}".format(analyzer_profile, cls.DEFAULT_ANALYZER_PROFILE))
+            analyzer_profile = cls.DEFAULT_ANALYZER_PROFILE
+
+        index_definition = cls._get_json_file_as_str(cls.INDEX_CONFIG_FILENAME)
+        index_definition['settings']['analysis'] = \
+            cls._get_json_file_as_str('analyzer_profiles/{0}.json'.format(analyzer_profile))
+        return index_definition
+
+    @staticmethod
+    def _get_json_file_as_str(filename):
+        with open(path.dirname(__file__) + '/../resources/' + filename) as json_data:
+            return json.load(json_data)
+
+    @staticmethod
+    def _get_connection_parameters(settings):
+        """
+        https://docs.objectrocket.com/elastic_python_examples.html
+        """
+        if settings['HOSTS'][0] != 'localhost':
+            conf = {'send_get_body_as': 'GET'}
+            if settings.get('USE_SSL', False):
+                conf.update({'port': 443, 'use_ssl': True, 'verify_certs': True})
+            if settings.get('PORT', False):
+                if path.isfile("/.dockerenv"):
+                    conf.update({'port': 9201, 'use_ssl': False, 'verify_certs': False})
+                else:
+                    conf.update({'port': 9200})
+            return conf
+        return {}
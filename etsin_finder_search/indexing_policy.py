@@ -0,0 +1,120 @@
+# This file is part of the Etsin service
+#
+# Copyright 2017-2021 Ministry of Education and Culture, Finland
+#
+# :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# :license: MIT
+
+"""
+Rules deciding whether a Metax catalog record is indexed, deleted from the index or skipped, shared by the reindexer
+and the RabbitMQ consumer. The rules are evaluated in one pass over the fields of the record, in the order below, and
+each decision comes with the reason code of the rule that made it:
+    no_record: SKIP, the record is missing, e.g. it could not be fetched from Metax
+    deprecated: DELETE, the record is deprecated
+    pas_origin_version: DELETE, a PAS version of a dataset with an original version, shown through the original
+    pas_not_preserved: DELETE, a record of the PAS catalog with preservation state other than 120
+    no_data_catalog: SKIP, the record has no data catalog
+    legacy_catalog: SKIP, a record of the legacy catalog
+    not_published: SKIP, e.g. a draft
+    indexed: INDEX
+The decisions are counted by reason, see IndexingPolicy.record. Records decided to be indexed that fail to convert
+are counted separately, see IndexingPolicy.record_conversion_failure.
+"""
+
+import threading
+from collections import Counter, namedtuple
+
+from etsin_finder_search import metrics
+
+INDEX = 'index'
+DELETE = 'delete'
+SKIP = 'skip'
+
+NO_RECORD = 'no_record'
+DEPRECATED = 'deprecated'
+PAS_ORIGIN_VERSION = 'pas_origin_version'
+PAS_NOT_PRESERVED = 'pas_not_preserved'
+NO_DATA_CATALOG = 'no_data_catalog'
+LEGACY_CATALOG = 'legacy_catalog'
+NOT_PUBLISHED = 'not_published'
+INDEXED = 'indexed'
+# Not decided by the rules, but returned by CRConverter.convert_many for records that could not be converted
+CONVERSION_FAILED = 'conversion_failed'
+
+PAS_CATALOG_IDENTIFIER = 'urn:nbn:fi:att:data-catalog-pas'
+LEGACY_CATALOG_IDENTIFIER = 'urn:nbn:fi:att:data-catalog-legacy'
+PRESERVED_STATE = 120
+
+Decision = namedtuple('Decision', ['identifier', 'action', 'reason'])
+
+
+class IndexingPolicy:
+
+    def __init__(self):
+        # (action, reason) to the amount of decisions recorded. Converters of several threads may share the policy.
+        self.counts = Counter()
+        # Records decided to be indexed that could not be converted, already counted as indexed
+        self.conversion_failures = 0
+        self._lock = threading.Lock()
+
+    def classify(self, cr_json):
+        """
+        :param cr_json: Metax catalog record
+        :return: Decision of the record, not recorded
+        """
+        if not cr_json:
+            return Decision(None, SKIP, NO_RECORD)
+
+        identifier = cr_json.get('identifier') or None
+        if cr_json.get('deprecated', False):
+            return Decision(identifier, DELETE, DEPRECATED)
+        if cr_json.get('preservation_dataset_origin_version', False):
+            return Decision(identifier, DELETE, PAS_ORIGIN_VERSION)
+
+        # Same as utils.get_catalog_record_data_catalog_identifier, looked up once
+        data_catalog = cr_json.get('data_catalog', {})
+        dc_identifier = data_catalog.get('catalog_json', {}).get('identifier', False) or \
+            data_catalog.get('identifier', False) or None
+        if dc_identifier == PAS_CATALOG_IDENTIFIER and cr_json.get('preservation_state', 0) != PRESERVED_STATE:
+            return Decision(identifier, DELETE, PAS_NOT_PRESERVED)
+        if dc_identifier is None:
+            return Decision(identifier, SKIP, NO_DATA_CATALOG)
+        if dc_identifier == LEGACY_CATALOG_IDENTIFIER:
+            return Decision(identifier, SKIP, LEGACY_CATALOG)
+        if cr_json.get('state') != 'published':
+            return Decision(identifier, SKIP, NOT_PUBLISHED)
+        return Decision(identifier, INDEX, INDEXED)
+
+    def classify_many(self, cr_jsons):
+        """
+        Classify and record a batch of catalog records, e.g. all the records of a reindexing run
+
+        :param cr_jsons: Iterable of Metax catalog records
+        :return: List of (cr_json, Decision) tuples in the same order
+        """
+        classified = []
+        for cr_json in cr_jsons:
+            decision = self.classify(cr_json)
+            self.record(decision.action, decision.reason)
+            classified.append((cr_json, decision))
+        return classified
+
+    def record(self, action, reason):
+        with self._lock:
+            self.counts[(action, reason)] += 1
+        metrics.INDEXING_DECISIONS.labels(action, reason).inc()
+
+    def record_conversion_failure(self):
+        with self._lock:
+            self.conversion_failures += 1
+        metrics.CONVERSION_FAILURES.inc()
+
+    def report(self):
+        with self._lock:
+            counts = self.counts.most_common()
+            conversion_failures = self.conversion_failures
+        report = "Indexing decisions: " + (', '.join('{0} {1} ({2})'.format(count, action, reason)
+                                                     for (action, reason), count in counts) or 'none')
+        if conversion_failures:
+            report += ". {0} of the records to index could not be converted".format(conversion_failures)
+        return report
@@ -8,6 +8,7 @@
 import requests
 from requests import HTTPError, ConnectionError, Timeout
 import json
+from concurrent.futures import ThreadPoolExecutor
 from time import sleep
 
 from etsin_finder_search.reindexing_log import get_logger
@@ -15,6 +16,9 @@ from etsin_finder_search.reindexing_log import get_logger
 log = get_logger(__name__)
 TIMEOUT = 1200
 NUM_RETRIES = 3
+# Used when fetching many single catalog records, where one slow request should not hold up the rest for long
+FETCH_TIMEOUT = 30
+FETCH_CONCURRENCY = 8
 
 
 class MetaxAPIService:
@@ -89,6 +93,48 @@ class MetaxAPIService:
 
         return json.loads(response.text)
 
+    def get_catalog_records(self, cr_identifiers, concurrency=FETCH_CONCURRENCY):
+        """
+        Get catalog records with the given identifiers from MetaX API, concurrently and over one HTTP session.
+        Unlike with get_catalog_record, a record that does not exist in Metax can be told apart from a failed request.
+
+        :param cr_identifiers: Catalog record identifiers
+        :param concurrency: Maximum number of requests in flight
+        :return: Tuple of a dict of identifier to Metax catalog record json and a set of identifiers of the records
+            not found in Metax. Identifiers whose request failed are in neither.
+        """
+        session = requests.Session()
+        session.auth = (self.USER, self.PW)
+        session.verify = self.VERIFY_SSL
+        session.headers.update({'Accept': 'application/json'})
+
+        def get(identifier):
+            try:
+                return identifier, session.get(self.METAX_GET_CATALOG_RECORD_URL.format(identifier),
+                                               timeout=FETCH_TIMEOUT)
+            except (ConnectionError, Timeout) as e:
+                log.error("Not able to get response from Metax API with identifier {0}: {1}".format(identifier, e))
+                return identifier, None
+
+        records = {}
+        not_found = set()
+        try:
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                for identifier, response in executor.map(get, cr_identifiers):
+                    if response is None:
+                        continue
+                    if response.status_code in (404, 410):
+                        not_found.add(identifier)
+                    elif response.ok:
+                        records[identifier] = response.json()
+                    else:
+                        log.error('Failed to get catalog record: \nidentifier={id}, \nstatus={status}'.format(
+                            id=identifier, status=response.status_code))
+        finally:
+            session.close()
+
+        return records, not_found
+
     def get_latest_catalog_record_identifiers(self):
         """
         Get a list of latest catalog record identifiers in terms of dataset versioning from MetaX API.
@@ -0,0 +1,173 @@
+# This file is part of the Etsin service
+#
+# Copyright 2017-2021 Ministry of Education and Culture, Finland
+#
+# :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# :license: MIT
+
+"""
+In-process metrics of the RabbitMQ consumer and the reindexer, collected with prometheus_client and served over
+HTTP in the Prometheus text format.
+
+Updating a metric costs a dictionary lookup and a lock, so the metrics are always collected. They are only served
+when a port has been configured, see start_metrics_server_if_configured.
+"""
+
+import asyncio
+import functools
+import time
+
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+from etsin_finder_search.reindexing_log import get_logger
+from etsin_finder_search.utils import get_metrics_config
+
+log = get_logger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+ES_OPERATION_SECONDS = Histogram(
+    'etsin_es_operation_duration_seconds', 'Duration of Elasticsearch service operations', ['operation'],
+    buckets=DEFAULT_BUCKETS)
+ES_OPERATIONS = Counter(
+    'etsin_es_operations_total', 'Elasticsearch service operations by outcome', ['operation', 'outcome'])
+ES_OPERATION_LAST_SUCCESS = Gauge(
+    'etsin_es_operation_last_success_timestamp_seconds', 'Time of the last successful Elasticsearch service '
+    'operation', ['operation'])
+
+CONVERSION_SECONDS = Histogram(
+    'etsin_catalog_record_conversion_duration_seconds', 'Duration of converting a Metax catalog record into an '
+    'Elasticsearch document', buckets=DEFAULT_BUCKETS)
+CONVERSION_FAILURES = Counter(
+    'etsin_catalog_record_conversion_failures_total', 'Catalog records decided to be indexed that could not be '
+    'converted into an Elasticsearch document')
+INDEXING_DECISIONS = Counter(
+    'etsin_indexing_decisions_total', 'Catalog records classified by the indexing policy, by action and reason code',
+    ['action', 'reason'])
+OVERSIZED_DOCUMENTS = Counter(
+    'etsin_oversized_documents_total', 'Documents over the document size budget, by the policy applied to them',
+    ['policy'])
+PARTIAL_UPDATES = Counter(
+    'etsin_partial_updates_total', 'Documents written into the index by whether they were sent whole or as a partial '
+    'update', ['kind'])
+PARTIAL_UPDATE_BYTES_SAVED = Counter(
+    'etsin_partial_update_saved_bytes_total', 'Bytes of documents left unsent thanks to partial updates')
+
+CONSUMER_MESSAGES = Counter(
+    'etsin_consumer_messages_total', 'Messages received from Metax RabbitMQ', ['callback_type'])
+CONSUMER_MESSAGE_SECONDS = Histogram(
+    'etsin_consumer_message_duration_seconds', 'Duration of processing a message from Metax RabbitMQ, '
+    'not collected in batch mode', ['callback_type'], buckets=DEFAULT_BUCKETS)
+CONSUMER_LAST_PROCESSED = Gauge(
+    'etsin_consumer_last_processed_timestamp_seconds', 'Time of the last processed message', ['callback_type'])
+CONSUMER_REJECTED_MESSAGES = Counter(
+    'etsin_consumer_rejected_messages_total', 'Messages that could not be processed, by where they were moved',
+    ['callback_type', 'destination'])
+CONSUMER_BATCH_SIZE = Histogram(
+    'etsin_consumer_batch_size', 'Messages per batch in batch mode', buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000))
+CONSUMER_BATCH_SECONDS = Histogram(
+    'etsin_consumer_batch_duration_seconds', 'Duration of writing a batch into the index in batch mode',
+    buckets=DEFAULT_BUCKETS)
+CONSUMER_QUEUE_MESSAGES = Gauge(
+    'etsin_consumer_queue_messages', 'Messages waiting in the consumed RabbitMQ queues', ['queue'])
+RABBITMQ_CONNECTIONS = Counter(
+    'etsin_rabbitmq_connection_attempts_total', 'Attempts to connect to RabbitMQ by host and outcome',
+    ['host', 'outcome'])
+RABBITMQ_RECONNECTS = Counter(
+    'etsin_rabbitmq_reconnects_total', 'Times the consumer reconnected after losing its RabbitMQ connection')
+CONSUMER_FLOOD_MODE = Gauge(
+    'etsin_consumer_flood_mode', 'Whether the consumer is in flood mode')
+CONSUMER_UNCHANGED_DOCUMENTS = Counter(
+    'etsin_consumer_unchanged_documents_total', 'Index writes left out since the document was unchanged, by where '
+    'its earlier digest was found', ['source'])
+CONSUMER_FLOOD_SKIPPED_EVENTS = Counter(
+    'etsin_consumer_flood_skipped_events_total', 'Events left out in flood mode since the index already had the '
+    'current state of their catalog record')
+
+REINDEX_LAST_SUCCESS = Gauge(
+    'etsin_reindex_last_success_timestamp_seconds', 'Time of the last completed reindexing operation')
+REINDEX_SECONDS = Gauge(
+    'etsin_reindex_duration_seconds', 'Duration of the last completed reindexing operation')
+REINDEX_DATASETS = Gauge(
+    'etsin_reindex_datasets', 'Datasets handled by the last completed reindexing operation', ['action'])
+
+
+def _operation_outcome(result):
+    if result is False or (isinstance(result, list) and not all(result)):
+        return 'error'
+    return 'ok'
+
+
+def _record_es_operation(operation, start, outcome):
+    ES_OPERATION_SECONDS.labels(operation).observe(time.perf_counter() - start)
+    ES_OPERATIONS.labels(operation, outcome).inc()
+    if outcome == 'ok':
+        ES_OPERATION_LAST_SUCCESS.labels(operation).set_to_current_time()
+
+
+def es_operation(operation):
+    """
+    Decorator for methods of the Elasticsearch services recording their duration and outcome. A raised exception,
+    a False result or a list result containing False counts as an error.
+
+    :param operation: Name of the operation in the metrics
+    """
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                outcome = 'error'
+                try:
+                    result = await func(*args, **kwargs)
+                    outcome = _operation_outcome(result)
+                    return result
+                finally:
+                    _record_es_operation(operation, start, outcome)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            outcome = 'error'
+            try:
+                result = func(*args, **kwargs)
+                outcome = _operation_outcome(result)
+                return result
+            finally:
+                _record_es_operation(operation, start, outcome)
+        return wrapper
+
+    return decorator
+
+
+_serving = False
+
+
+def start_metrics_server_if_configured(port_key):
+    """
+    Start the metrics server if the METRICS config has a port under port_key
+
+    :param port_key: CONSUMER_PORT or REINDEXER_PORT
+    :return: True if the metrics are being served
+    """
+    global _serving
+    metrics_config = get_metrics_config()
+    if not metrics_config or not metrics_config.get(port_key):
+        return False
+
+    address = metrics_config.get('ADDRESS') or '0.0.0.0'
+    try:
+        # Served from a daemon thread at /metrics
+        start_http_server(metrics_config[port_key], address)
+    except OSError as e:
+        log.error(e)
+        log.error("Unable to start metrics server, continuing without it")
+        return False
+    _serving = True
+    log.info("Serving metrics at {0}:{1}/metrics".format(address, metrics_config[port_key]))
+    return True
+
+
+def is_serving():
+    return _serving
@@ -0,0 +1,196 @@
+# This file is part of the Etsin service
+#
+# Copyright 2017-2021 Ministry of Education and Culture, Finland
+#
+# :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# :license: MIT
+
+"""
+Partial updates of the Elasticsearch documents. Many Metax updates only touch e.g. the preservation state, the
+modification date or a keyword, but the whole document was sent to the index every time.
+
+The top level fields of a document are divided into the groups of FIELD_GROUPS, and a fingerprint of each group is
+stored in the document under FINGERPRINT_FIELD, along with the paths of the fields of each group. Before a document is
+written, its fingerprints are compared with the ones stored in the index, and only the fields of the groups that
+differ are sent with an update action. Elasticsearch merges the partial doc into the indexed document, recursively
+into objects, so fields and object keys cannot be removed with it. The whole document is indexed instead when
+    - the index has no fingerprints for it, e.g. it is new or was indexed before partial updates were enabled
+    - a field or an object key stored earlier in a changed group is missing from the new document, e.g. title.sv
+    - the changed groups are large, more than PARTIAL_UPDATE_MAX_RATIO of the document
+
+Partial updates are set in the ELASTICSEARCH config:
+    PARTIAL_UPDATES: True to store the fingerprints and send partial updates, False by default
+    PARTIAL_UPDATE_MAX_RATIO: Largest partial update as a fraction of the whole document, 0.5 by default
+"""
+
+import hashlib
+import json
+import threading
+
+from etsin_finder_search import metrics
+
+FINGERPRINT_FIELD = 'field_fingerprints'
+# Bumped when FIELD_GROUPS changes, fingerprints of another version are not comparable
+FINGERPRINT_VERSION = 2
+VERSION_KEY = 'version'
+# Key of the dict of group name to the sorted paths of the fields in it, see _get_paths
+PATHS_KEY = 'paths'
+
+# Group name to the top level document fields in it, fields not listed here belong to OTHER_GROUP
+FIELD_GROUPS = {
+    'identifiers': ('identifier', 'preferred_identifier', 'other_identifier', 'dataset_version_set'),
+    'state': ('preservation_state', 'date_modified', 'data_catalog', 'data_catalog_identifier'),
+    'text': ('title', 'description'),
+    'keywords': ('keyword', 'theme', 'field_of_science', 'infrastructure'),
+    'agents': ('creator', 'creator_name', 'contributor', 'publisher', 'curator', 'rights_holder',
+               'organization_name_fi', 'organization_name_en'),
+    'projects': ('is_output_of', 'project_name_fi', 'project_name_en'),
+    'access': ('access_rights',),
+    'files': ('file_type',),
+}
+OTHER_GROUP = 'other'
+
+_GROUP_OF_FIELD = dict((field, group) for group, fields in FIELD_GROUPS.items() for field in fields)
+
+
+def _group_fields(document):
+    """
+    :return: Dict of group name to the list of (field, value) of the document in it
+    """
+    groups = dict((group, []) for group in FIELD_GROUPS)
+    groups[OTHER_GROUP] = []
+    for field, value in document.items():
+        if field != FINGERPRINT_FIELD:
+            groups[_GROUP_OF_FIELD.get(field, OTHER_GROUP)].append((field, value))
+    return groups
+
+
+def _get_paths(field, value):
+    """
+    :return: Path of the field and the dotted paths of the keys of the objects in its value, the parts of the field
+        a partial update is merged into. Lists are replaced as a whole, so their items are not listed.
+    """
+    paths = [field]
+    if isinstance(value, dict):
+        for key, item in value.items():
+            paths.extend(_get_paths(field + '.' + key, item))
+    return paths
+
+
+def _fingerprint(items):
+    serialized = json.dumps(sorted(items, key=lambda item: item[0]), sort_keys=True)
+    return hashlib.blake2b(serialized.encode('utf-8'), digest_size=8).hexdigest()
+
+
+def get_fingerprints(document):
+    """
+    :return: Dict of group name to the fingerprint of the fields of the document in it, groups without fields
+        included, plus the paths of the fields of each group and the fingerprint version
+    """
+    groups = _group_fields(document)
+    fingerprints = dict((group, _fingerprint(items)) for group, items in groups.items())
+    fingerprints[PATHS_KEY] = dict((group, sorted(path for field, value in items for path in _get_paths(field, value)))
+                                   for group, items in groups.items())
+    fingerprints[VERSION_KEY] = FINGERPRINT_VERSION
+    return fingerprints
+
+
+def add_fingerprints(document):
+    """
+    Store the fingerprints in the document under FINGERPRINT_FIELD, unless already there
+
+    :return: The fingerprints of the document
+    """
+    if FINGERPRINT_FIELD not in document:
+        document[FINGERPRINT_FIELD] = get_fingerprints(document)
+    return document[FINGERPRINT_FIELD]
+
+
+def get_fingerprint_digest(fingerprints):
+    """
+    :return: Digest of the whole document with the given fingerprints, equal for equal documents, None without
+        fingerprints
+    """
+    if not fingerprints:
+        return None
+    serialized = json.dumps(fingerprints, sort_keys=True)
+    return hashlib.blake2b(serialized.encode('utf-8'), digest_size=16).hexdigest()
+
+
+class PartialUpdates:
+
+    def __init__(self, enabled=False, max_ratio=0.5):
+        self.enabled = enabled
+        self.max_ratio = max_ratio
+        self.partial_updates = 0
+        self.full_documents = 0
+        self.bytes_saved = 0
+        # The worker threads of the consumer share one instance
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, es_settings):
+        es_settings = es_settings or {}
+        return cls(es_settings.get('PARTIAL_UPDATES', False), es_settings.get('PARTIAL_UPDATE_MAX_RATIO', 0.5))
+
+    def prepare(self, dataset_models, stored_fingerprints):
+        """
+        Add the fingerprints to the documents and turn the models whose changes are small into partial updates
+
+        :param dataset_models: ESDatasetModels with whole documents, modified in place
+        :param stored_fingerprints: Dict of doc id to the fingerprints stored in the index
+        """
+        if not self.enabled:
+            return
+
+        for dataset_model in dataset_models:
+            document = dataset_model.doc_obj
+            add_fingerprints(document)
+            full_size = len(dataset_model.to_es_document_string())
+            partial_doc = self._get_partial_doc(
+                document, stored_fingerprints.get(dataset_model.get_es_document_id()), full_size)
+            if partial_doc is None:
+                with self._lock:
+                    self.full_documents += 1
+                metrics.PARTIAL_UPDATES.labels('full').inc()
+                continue
+
+            dataset_model.doc_obj = partial_doc
+            dataset_model.partial = True
+            saved = full_size - len(dataset_model.to_es_document_string())
+            with self._lock:
+                self.partial_updates += 1
+                self.bytes_saved += saved
+            metrics.PARTIAL_UPDATES.labels('partial').inc()
+            metrics.PARTIAL_UPDATE_BYTES_SAVED.inc(saved)
+
+    def _get_partial_doc(self, document, stored, full_size):
+        """
+        :return: Fields of the changed groups of document and its fingerprints, or None if the whole document is to
+            be indexed
+        """
+        fingerprints = document[FINGERPRINT_FIELD]
+        if not stored or stored.get(VERSION_KEY) != fingerprints[VERSION_KEY]:
+            return None
+
+        groups = _group_fields(document)
+        stored_paths = stored.get(PATHS_KEY, {})
+        # The identifier is the id of the document, see ESDatasetModel.get_es_document_id
+        partial_doc = {'identifier': document.get('identifier', '')}
+        for group, items in groups.items():
+            if fingerprints[group] == stored.get(group):
+                continue
+            # Fields left out by the converter, e.g. preservation_state 0, do not matter unless they were indexed
+            if not set(stored_paths.get(group, ())).issubset(fingerprints[PATHS_KEY][group]):
+                return None
+            partial_doc.update(items)
+
+        partial_doc[FINGERPRINT_FIELD] = fingerprints
+        if len(json.dumps(partial_doc)) > self.max_ratio * full_size:
+            return None
+        return partial_doc
+
+    def report(self):
+        with self._lock:
+            return "{0} partial updates, {1} whole documents, {2} bytes saved by partial updates".format(
+                self.partial_updates, self.full_documents, self.bytes_saved)
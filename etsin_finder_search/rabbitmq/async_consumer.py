@@ -0,0 +1,285 @@
+# This file is part of the Etsin service
+#
+# Copyright 2017-2021 Ministry of Education and Culture, Finland
+#
+# :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# :license: MIT
+
+"""
+Non-blocking variant of the Metax RabbitMQ consumer. Enable it with ASYNC_CONSUMER in the METAX_RABBITMQ config.
+
+The AMQP connection runs on an asyncio event loop, so heartbeats and acks are never held up by index writes.
+Catalog record conversion runs in the default thread pool and index writes go through AsyncElasticSearchService.
+At most CONCURRENCY messages are processed at the same time, and events for the same catalog record are processed
+in the order they were received.
+"""
+
+import asyncio
+import signal
+import threading
+from functools import partial
+from time import perf_counter
+
+import pika
+from pika.adapters.asyncio_connection import AsyncioConnection
+
+from etsin_finder_search import metrics
+from etsin_finder_search.catalog_record_converter import CRConverter
+from etsin_finder_search.catalog_record_mapping import ReferenceInterner
+from etsin_finder_search.elastic.service.async_es_service import AsyncElasticSearchService
+from etsin_finder_search.rabbitmq.rabbitmq_client import MetaxConsumer, ReceivedMessage
+from etsin_finder_search.utils import get_catalog_record_identifier
+
+
+class AsyncMetaxConsumer(MetaxConsumer):
+
+    DEFAULT_CONCURRENCY = 16
+    # Seconds to wait for messages being processed when stopping
+    STOP_TIMEOUT = 10
+    # Messages are processed concurrently on the event loop instead, see CONCURRENCY
+    UNSUPPORTED_OPTIONS = ('BATCH_SIZE', 'COALESCE_EVENTS', 'WORKERS', 'JOURNAL_DIR', 'FLOOD_THRESHOLD')
+
+    def _init_es_client(self, es_settings):
+        # The Elasticsearch client is bound to the event loop, so it is created once the loop runs
+        self.es_settings = es_settings
+        self.es_client = None
+        self.channel = None
+        self.concurrency = self.rabbit_settings.get('CONCURRENCY', self.DEFAULT_CONCURRENCY)
+        self.tasks = set()
+        # Converters of the threads of the default thread pool, see _get_es_actions_in_executor
+        self.executor_converters = threading.local()
+        return True
+
+    def run(self):
+        try:
+            asyncio.run(self._consume())
+        except Exception as e:
+            self.log.error(e)
+            self.log.error('An error occurred while consuming')
+
+    def processing_completed(self):
+        return not self.tasks
+
+    def wait_for_processing(self, seconds):
+        # Stopping is handled on the event loop, see _stop
+        pass
+
+    def _call_threadsafe(self, callback):
+        self.loop.call_soon_threadsafe(callback)
+
+    def _call_later(self, delay, callback):
+        self.loop.call_later(delay, callback)
+
+    async def _consume(self):
+        self.loop = asyncio.get_running_loop()
+        self._init_processing_state()
+
+        self.es_client = await AsyncElasticSearchService.get_elasticsearch_service(
+            self.es_settings, self.recent_documents is not None)
+        if self.es_client is None:
+            return
+
+        try:
+            if not await self.es_client.ensure_index_existence():
+                return
+
+            self.loop.add_signal_handler(signal.SIGTERM, lambda: self.loop.create_task(self._stop()))
+            print('[*] RabbitMQ is running. To exit press CTRL+C. See logs for indexing details.')
+            while not self.stop_requested:
+                if not await self._open_connection() or not await self._setup_async_consumers():
+                    if not self.stop_requested:
+                        self.log.error('Unable to setup RabbitMQ connection or consumers')
+                    return
+
+                self.log.info('RabbitMQ client starting to consume messages..')
+                reason = await self.connection_closed
+                if not self.stop_requested:
+                    # Messages being processed are left unacked, RabbitMQ delivers them again on the new connection
+                    self.log.error('Lost connection to RabbitMQ host {0}: {1}, reconnecting..'.format(self.host, reason))
+                    self.host_selector.record_failure(self.host)
+                    metrics.RABBITMQ_RECONNECTS.inc()
+        finally:
+            await self.es_client.close()
+
+    def _init_processing_state(self):
+        self.processing_slots = asyncio.Semaphore(self.concurrency)
+        # Latest task of each catalog record identifier, used to keep the events of a record in order
+        self.latest_task_by_identifier = {}
+        self.tasks = set()
+        self.connection_closed = None
+
+    async def _open_connection(self):
+        self.log.info("Setting up connection to RabbitMQ server..")
+
+        # Connection retries are needed as long as there is no load balancer in front of rabbitmq-server VMs
+        num_conn_retries = 3000
+
+        for x in range(0, num_conn_retries):
+            if self.stop_requested:
+                return False
+
+            host, wait = self.host_selector.choose()
+            if wait > 0:
+                self.log.info("Connecting to RabbitMQ host {0} in {1:.1f} seconds...".format(host, wait))
+                await asyncio.sleep(wait)
+
+            start = perf_counter()
+            connection_opened = self.loop.create_future()
+            self.connection = AsyncioConnection(
+                pika.ConnectionParameters(
+                    host,
+                    self.rabbit_settings['PORT'],
+                    self.rabbit_settings['VHOST'],
+                    self.credentials),
+                on_open_callback=lambda connection: connection_opened.set_result(None),
+                on_open_error_callback=lambda connection, error: connection_opened.set_result(error),
+                on_close_callback=self._on_connection_closed,
+                custom_ioloop=self.loop)
+
+            error = await connection_opened
+            if error is None:
+                self.host = host
+                self.host_selector.record_success(host, perf_counter() - start)
+                metrics.RABBITMQ_CONNECTIONS.labels(host, 'ok').inc()
+                self.connection_closed = self.loop.create_future()
+                self.log.info("Connection OK")
+                return True
+
+            self.log.error(error)
+            self.log.error("Problem connecting to RabbitMQ host {0}".format(host))
+            self.host_selector.record_failure(host)
+            metrics.RABBITMQ_CONNECTIONS.labels(host, 'error').inc()
+
+        return False
+
+    async def _setup_async_consumers(self):
+        self.log.info("Setting up consumers..")
+        channel_opened = self.loop.create_future()
+        self.connection.channel(on_open_callback=channel_opened.set_result)
+        self.channel = await channel_opened
+        self.channel.add_on_close_callback(self._on_channel_closed)
+
+        # The channel sends the declarations, bindings and consumers in order, so there is no need to wait for
+        # each of them separately. A failing one closes the channel.
+        self._create_and_bind_queues(self.is_local_dev)
+        self.channel.basic_qos(prefetch_count=self.concurrency * 2)
+        self.callbacks = dict((callback_type, partial(self._on_message, callback_type))
+                              for callback_type in ('create', 'update', 'delete'))
+        self._start_consumers_unless_paused()
+
+        self.log.info("Consumers OK")
+        return True
+
+    def _on_message(self, callback_type, ch, method, properties, body):
+        metrics.CONSUMER_MESSAGES.labels(callback_type).inc()
+        message = ReceivedMessage(callback_type, method.delivery_tag, properties, body)
+        task = self.loop.create_task(self._process_message(ch, message))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _process_message(self, channel, message):
+        self.log.debug("Received {0} message from Metax RabbitMQ".format(message.callback_type))
+        body_as_json = self._get_message_body_as_json(message.body)
+        if not body_as_json:
+            self._reject(channel, message, transient=False)
+            return
+
+        cr_id = get_catalog_record_identifier(body_as_json)
+        current_task = asyncio.current_task()
+        previous_task = self.latest_task_by_identifier.get(cr_id) if cr_id else None
+        if cr_id:
+            self.latest_task_by_identifier[cr_id] = current_task
+
+        try:
+            if previous_task is not None:
+                await asyncio.wait([previous_task])
+
+            async with self.processing_slots:
+                start = perf_counter()
+                event_ok, transient = await self._process_event(message.callback_type, body_as_json)
+                self._record_processed_message(message.callback_type, start)
+        finally:
+            if cr_id and self.latest_task_by_identifier.get(cr_id) is current_task:
+                del self.latest_task_by_identifier[cr_id]
+
+        if channel is not self.channel:
+            self.log.info("Connection lost while processing message with delivery tag {0}, RabbitMQ will deliver "
+                          "it again".format(message.delivery_tag))
+        elif event_ok:
+            channel.basic_ack(delivery_tag=message.delivery_tag)
+        else:
+            self.log.error('Failed to process {0} message with delivery tag {1}'.format(
+                message.callback_type, message.delivery_tag))
+            self._reject(channel, message, transient)
+
+    async def _process_event(self, callback_type, body_as_json):
+        """
+        :return: Tuple of whether the event was processed and, if not, whether the failure was transient
+        """
+        try:
+            if not await self.es_client.ensure_index_existence():
+                return False, True
+
+            es_actions = await self.loop.run_in_executor(
+                None, self._get_es_actions_in_executor, callback_type, body_as_json)
+            if es_actions is None:
+                return False, False
+            await self._prepare_index_writes_async([es_actions])
+
+            for required, (action, payload) in es_actions:
+                if action == 'index':
+                    action_ok = await self.es_client.reindex_dataset(payload)
+                else:
+                    action_ok = await self.es_client.delete_dataset_from_index(payload)
+                if required and not action_ok:
+                    return False, True
+        except Exception as e:
+            self.log.error(e)
+            return False, True
+
+        return True, False
+
+    def _get_es_actions_in_executor(self, callback_type, body_as_json):
+        """
+        Decide the index actions for a message in a thread of the default thread pool. ReferenceInterner is not thread
+        safe, so each thread converts with its own converter, sharing the indexing policy.
+        """
+        converter = getattr(self.executor_converters, 'converter', None)
+        if converter is None:
+            converter = CRConverter.from_config(self.es_settings, ReferenceInterner(), self.converter.policy)
+            self.executor_converters.converter = converter
+        return self._get_es_actions_for_event(callback_type, body_as_json, converter, prepare=False)
+
+    async def _prepare_index_writes_async(self, all_es_actions):
+        """
+        _prepare_index_writes with the field fingerprints fetched on the event loop and compared in the default thread
+        pool
+        """
+        dataset_models, previous_digests, to_fetch = self._get_fingerprints_to_fetch(all_es_actions)
+        stored_fingerprints = await self.es_client.get_field_fingerprints(to_fetch) if to_fetch else {}
+        await self.loop.run_in_executor(None, self._apply_field_fingerprints, all_es_actions, dataset_models,
+                                        previous_digests, stored_fingerprints)
+
+    async def _stop(self):
+        """
+        Stop consuming, wait for the messages being processed and close the connection
+        """
+        self.stop_requested = True
+        self.log.info("Stopping RabbitMQ consumer..")
+        # While reconnecting there is no open channel, and the consumers went away with the closed one
+        if self.channel is not None and self.channel.is_open:
+            self._cancel_consumers()
+        if self.tasks:
+            self.log.info("Waiting for reindexing operations to finish before exiting RabbitMQ consumer..")
+            await asyncio.wait(self.tasks, timeout=self.STOP_TIMEOUT)
+        if self.connection is not None and not self.connection.is_closing and not self.connection.is_closed:
+            self.connection.close()
+
+    def _on_channel_closed(self, channel, reason):
+        self.log.error('RabbitMQ channel closed: {0}'.format(reason))
+        if not self.connection.is_closing and not self.connection.is_closed:
+            self.connection.close()
+
+    def _on_connection_closed(self, connection, reason):
+        if self.connection_closed is not None and not self.connection_closed.done():
+            self.connection_closed.set_result(reason)
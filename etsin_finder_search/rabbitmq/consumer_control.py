@@ -0,0 +1,138 @@
+# This file is part of the Etsin service
+#
+# Copyright 2017-2021 Ministry of Education and Culture, Finland
+#
+# :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# :license: MIT
+
+"""
+Control socket of the RabbitMQ consumer. With CONTROL_SOCKET set in the METAX_RABBITMQ config, the consumer listens
+on that Unix socket path, and the reindexer uses it to pause the consumer for the length of a reindexing operation
+instead of stopping and starting the consumer service.
+
+A client sends one command per connection, either pause, resume or status, followed by a newline. The consumer
+answers with its status as one line of json. Pause and resume answer right away, pause_consumer waits until the
+state turns from pausing to paused.
+"""
+
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+
+from etsin_finder_search.reindexing_log import get_logger
+
+log = get_logger(__name__)
+
+COMMANDS = ('pause', 'resume', 'status')
+
+
+class _ControlRequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        command = self.rfile.readline(64).decode('utf-8', 'replace').strip()
+        consumer = self.server.consumer
+        try:
+            if command == 'pause':
+                consumer.request_pause()
+            elif command == 'resume':
+                consumer.request_resume()
+            elif command != 'status':
+                raise ValueError("Unknown command '{0}', expected one of {1}".format(command, ', '.join(COMMANDS)))
+            response = consumer.get_status()
+        except Exception as e:
+            log.error("Consumer control command '{0}' failed: {1}".format(command, e))
+            response = {'error': str(e)}
+
+        self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+
+
+class ConsumerControlServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, consumer):
+        """
+        :param path: Path of the Unix socket, an existing socket file is replaced
+        :param consumer: MetaxConsumer to control
+        """
+        if os.path.exists(path):
+            os.unlink(path)
+        self.consumer = consumer
+        socketserver.UnixStreamServer.__init__(self, path, _ControlRequestHandler)
+        os.chmod(path, 0o660)
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, name='consumer-control', daemon=True).start()
+        log.info("Listening for consumer control commands at {0}".format(self.server_address))
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+
+def start_control_server_if_configured(consumer):
+    """
+    :param consumer: MetaxConsumer to control
+    :return: The server, or None if CONTROL_SOCKET is not configured or the socket cannot be created
+    """
+    path = consumer.rabbit_settings.get('CONTROL_SOCKET')
+    if not path:
+        return None
+
+    try:
+        server = ConsumerControlServer(path, consumer)
+    except OSError as e:
+        log.error(e)
+        log.error("Unable to create consumer control socket, continuing without it")
+        return None
+
+    server.start()
+    return server
+
+
+def send_command(path, command, timeout=10):
+    """
+    :param path: Path of the control socket of the consumer
+    :param command: pause, resume or status
+    :return: Status dict of the consumer, or None if no consumer is listening at path
+    """
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(path)
+            sock.sendall(command.encode('utf-8') + b'\n')
+            response = sock.makefile('rb').readline()
+    except OSError as e:
+        log.debug("No consumer listening at {0}: {1}".format(path, e))
+        return None
+
+    return json.loads(response.decode('utf-8')) if response else None
+
+
+def get_consumer_status(path):
+    return send_command(path, 'status')
+
+
+def pause_consumer(path, timeout=60, poll_interval=0.2):
+    """
+    Pause the consumer and wait for it to finish processing the messages it has received
+
+    :return: Status dict of the consumer, with state paused on success. None if no consumer is listening at path.
+    """
+    status = send_command(path, 'pause')
+    deadline = time.monotonic() + timeout
+    while status and status.get('state') == 'pausing' and time.monotonic() < deadline:
+        time.sleep(poll_interval)
+        status = get_consumer_status(path)
+    return status
+
+
+def resume_consumer(path):
+    """
+    :return: Status dict of the consumer, or None if no consumer is listening at path
+    """
+    return send_command(path, 'resume')
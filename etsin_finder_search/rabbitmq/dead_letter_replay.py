@@ -0,0 +1,101 @@
+# This file is part of the Etsin service
+#
+# Copyright 2017-2021 Ministry of Education and Culture, Finland
+#
+# :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# :license: MIT
+
+"""
+Return messages from the dead-letter queues of the consumer back to the queues they came from, e.g. after
+Elasticsearch has been fixed. The consumer then processes them like any other message.
+"""
+
+import random
+
+import pika
+
+from etsin_finder_search.rabbitmq.rabbitmq_client import \
+    QUEUE_NAMES, \
+    RETRY_COUNT_HEADER, \
+    get_dead_letter_queue_name, \
+    get_queue_names, \
+    is_local_dev_environment
+from etsin_finder_search.reindexing_log import get_logger
+from etsin_finder_search.utils import get_metax_rabbit_mq_config
+
+log = get_logger(__name__)
+
+
+def replay_dead_letters(channel, queue, limit=None):
+    """
+    Move messages from the dead-letter queue of queue back to queue. Only the messages in the dead-letter queue at
+    the start are moved, so messages failing again during the replay are not replayed twice. The channel must be in
+    confirm mode: a message is acked from the dead-letter queue only after the broker has confirmed its republish.
+
+    :param channel: pika BlockingChannel
+    :param queue: Name of the queue whose dead-letter queue is replayed
+    :param limit: Maximum number of messages to replay, all if None
+    :return: Number of replayed messages
+    """
+    dead_letter_queue = get_dead_letter_queue_name(queue)
+    amount = channel.queue_declare(dead_letter_queue, passive=True).method.message_count
+    if limit is not None:
+        amount = min(amount, limit)
+
+    replayed = 0
+    while replayed < amount:
+        method, properties, body = channel.basic_get(dead_letter_queue, auto_ack=False)
+        if method is None:
+            break
+
+        # A replayed message gets all of its retry rounds again
+        headers = dict(properties.headers or {})
+        headers.pop(RETRY_COUNT_HEADER, None)
+        channel.basic_publish('', queue, body, pika.BasicProperties(
+            content_type=properties.content_type,
+            delivery_mode=2,
+            headers=headers), mandatory=True)
+        channel.basic_ack(delivery_tag=method.delivery_tag)
+        replayed += 1
+
+    log.info("Replayed {0} messages from {1} to {2}".format(replayed, dead_letter_queue, queue))
+    return replayed
+
+
+def replay_all_dead_letters(callback_types=None, limit=None):
+    """
+    Connect to Metax RabbitMQ and replay the dead-letter queues of the given message types
+
+    :param callback_types: List of 'create', 'update' and 'delete', all if None
+    :param limit: Maximum number of messages to replay per queue, all if None
+    :return: Dict of queue name to the number of replayed messages, None if unable to connect
+    """
+    rabbit_settings = get_metax_rabbit_mq_config()
+    if not rabbit_settings:
+        log.error("Unable to load RabbitMQ configuration")
+        return None
+
+    # The same queues the consumer consumes, which in local dev env have unique names
+    queues = get_queue_names(is_local_dev_environment())
+    if queues is None:
+        log.error("No local dev queues have been created by the consumer")
+        return None
+
+    try:
+        connection = pika.BlockingConnection(pika.ConnectionParameters(
+            random.choice(rabbit_settings['HOSTS']),
+            rabbit_settings['PORT'],
+            rabbit_settings['VHOST'],
+            pika.PlainCredentials(rabbit_settings['USER'], rabbit_settings['PASSWORD'])))
+    except Exception as e:
+        log.error(e)
+        log.error("Unable to connect to RabbitMQ server")
+        return None
+
+    try:
+        channel = connection.channel()
+        channel.confirm_delivery()
+        return dict((queues[callback_type], replay_dead_letters(channel, queues[callback_type], limit))
+                    for callback_type in callback_types or QUEUE_NAMES)
+    finally:
+        connection.close()
@@ -0,0 +1,117 @@
+# This file is part of the Etsin service
+#
+# Copyright 2017-2021 Ministry of Education and Culture, Finland
+#
+# :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# :license: MIT
+
+import json
+import os
+from collections import namedtuple
+
+from etsin_finder_search.reindexing_log import get_logger
+
+log = get_logger(__name__)
+
+# Event as it was received from RabbitMQ, body being the raw message body bytes
+JournalEntry = namedtuple('JournalEntry', ['routing_key', 'identifier', 'body'])
+
+
+class EventJournal:
+    """
+    Local append-only journal of RabbitMQ events, split into segment files of at most segment_max_bytes.
+    Each entry is a JSON header line with the routing key, catalog record identifier and body length, followed by
+    the raw message body and a newline. An entry is flushed and fsynced before append returns, so the message can be
+    acked right after. A partially written last entry, e.g. after a crash, is ignored when reading.
+    """
+
+    DEFAULT_SEGMENT_MAX_BYTES = 8 * 1024 * 1024
+    SEGMENT_NAME_FORMAT = 'events-{0:010d}.journal'
+
+    def __init__(self, directory, segment_max_bytes=DEFAULT_SEGMENT_MAX_BYTES):
+        self.directory = directory
+        self.segment_max_bytes = segment_max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+        # Segments left by earlier runs are complete, new entries go to a new segment
+        self.segments = sorted(name for name in os.listdir(directory) if self._is_segment_name(name))
+        self.next_segment_number = int(self.segments[-1][7:17]) + 1 if self.segments else 1
+        self.current_file = None
+        if self.segments:
+            log.info("Event journal {0} has {1} segments waiting to be replayed".format(directory, len(self.segments)))
+
+    def is_empty(self):
+        return not self.segments
+
+    def append(self, routing_key, identifier, body):
+        """
+        :param routing_key: Routing key of the event, i.e. create, update or delete
+        :param identifier: Catalog record identifier, None if not known
+        :param body: Message body bytes
+        """
+        if self.current_file is None or self.current_file.tell() >= self.segment_max_bytes:
+            self._start_segment()
+
+        header = json.dumps({'routing_key': routing_key, 'identifier': identifier, 'length': len(body)})
+        self.current_file.write(header.encode('utf-8') + b'\n' + body + b'\n')
+        self.current_file.flush()
+        os.fsync(self.current_file.fileno())
+
+    def sealed_segments(self):
+        """
+        Close the segment being written, so that every segment can be replayed
+
+        :return: Segment file names, oldest first
+        """
+        self._close_current_segment()
+        return list(self.segments)
+
+    def read_segment(self, segment):
+        """
+        :return: List of JournalEntry in the order they were appended
+        """
+        entries = []
+        with open(os.path.join(self.directory, segment), 'rb') as segment_file:
+            while True:
+                header_line = segment_file.readline()
+                if not header_line.endswith(b'\n'):
+                    break
+                try:
+                    header = json.loads(header_line)
+                except ValueError:
+                    log.error("Corrupted entry in event journal segment {0}, ignoring the rest of it".format(segment))
+                    break
+
+                body = segment_file.read(header['length'] + 1)
+                if len(body) != header['length'] + 1:
+                    break
+                entries.append(JournalEntry(header['routing_key'], header['identifier'], body[:-1]))
+
+        return entries
+
+    def remove_segment(self, segment):
+        """
+        Remove a segment whose entries have been applied
+        """
+        if self.current_file is not None and self.segments[-1] == segment:
+            self._close_current_segment()
+        os.remove(os.path.join(self.directory, segment))
+        self.segments.remove(segment)
+
+    def close(self):
+        self._close_current_segment()
+
+    def _start_segment(self):
+        self._close_current_segment()
+        segment = self.SEGMENT_NAME_FORMAT.format(self.next_segment_number)
+        self.next_segment_number += 1
+        self.current_file = open(os.path.join(self.directory, segment), 'ab')
+        self.segments.append(segment)
+
+    def _close_current_segment(self):
+        if self.current_file is not None:
+            self.current_file.close()
+            self.current_file = None
+
+    def _is_segment_name(self, name):
+        return name.startswith('events-') and name.endswith('.journal') and name[7:17].isdigit()
@@ -0,0 +1,100 @@
+# This file is part of the Etsin service
+#
+# Copyright 2017-2021 Ministry of Education and Culture, Finland
+#
+# :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# :license: MIT
+
+import random
+import time
+
+from etsin_finder_search.reindexing_log import get_logger
+
+log = get_logger(__name__)
+
+
+class HostHealth:
+
+    # Weight of the latest connection time in the moving average
+    LATENCY_WEIGHT = 0.3
+
+    def __init__(self, host):
+        self.host = host
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.latency = None
+        self.available_at = 0.0
+
+    def record_success(self, latency):
+        self.successes += 1
+        self.consecutive_failures = 0
+        self.available_at = 0.0
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += self.LATENCY_WEIGHT * (latency - self.latency)
+
+    def record_failure(self, available_at):
+        self.failures += 1
+        self.consecutive_failures += 1
+        self.available_at = available_at
+
+    def score(self):
+        """
+        :return: Sort key of the host, lower is healthier
+        """
+        failure_ratio = self.failures / float(self.successes + self.failures) if self.failures else 0.0
+        return self.consecutive_failures, failure_ratio, self.latency or 0.0
+
+
+class HostSelector:
+    """
+    Chooses which of the RabbitMQ hosts to connect to. A host that fails to connect is backed off for a jittered,
+    exponentially growing time, during which the other hosts are preferred. Of the hosts not backed off, the one
+    with the fewest consecutive failures, then the lowest failure ratio and then the lowest connection time is
+    chosen, with ties broken randomly so that consumers spread over the hosts.
+    """
+
+    def __init__(self, hosts, initial_backoff=0.5, max_backoff=30.0, clock=time.monotonic, rng=None):
+        """
+        :param hosts: Host names
+        :param initial_backoff: Seconds a host is backed off after its first failure, doubled for each further one
+        :param max_backoff: Upper limit of the backoff in seconds
+        """
+        self.health = dict((host, HostHealth(host)) for host in hosts)
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.clock = clock
+        self.rng = rng or random.Random()
+
+    def choose(self):
+        """
+        :return: Tuple of the host to connect to next and the seconds to wait before connecting to it
+        """
+        now = self.clock()
+        candidates = list(self.health.values())
+        self.rng.shuffle(candidates)
+
+        available = [health for health in candidates if health.available_at <= now]
+        if available:
+            return min(available, key=HostHealth.score).host, 0.0
+
+        health = min(candidates, key=lambda health: health.available_at)
+        return health.host, health.available_at - now
+
+    def record_success(self, host, latency):
+        self.health[host].record_success(latency)
+
+    def record_failure(self, host):
+        health = self.health[host]
+        health.record_failure(self.clock() + self.backoff(health.consecutive_failures + 1))
+        log.info("RabbitMQ host {0} has failed {1} times in a row".format(host, health.consecutive_failures))
+
+    def backoff(self, attempt):
+        """
+        :param attempt: Number of consecutive failures, starting from 1
+        :return: Seconds to back off, between half and all of the exponential delay
+        """
+        delay = min(self.max_backoff, self.initial_backoff * 2 ** min(attempt - 1, 32))
+        return delay / 2.0 + self.rng.uniform(0, delay / 2.0)
@@ -22,121 +22,361 @@ Press CTRL+C to exit script.
 import json
 import os
 import pika
-import random
-from time import sleep
+import threading
+from collections import namedtuple
+from functools import partial
+from time import perf_counter, sleep, time
 
 from elasticsearch.exceptions import RequestError
 
+from etsin_finder_search import metrics
 from etsin_finder_search.catalog_record_converter import CRConverter
+from etsin_finder_search.catalog_record_mapping import ReferenceInterner
+from etsin_finder_search.indexing_policy import CONVERSION_FAILED, DELETE, SKIP
+from etsin_finder_search.document_budget import DocumentBudget
 from etsin_finder_search.elastic.domain.es_dataset_data_model import ESDatasetModel
 from etsin_finder_search.elastic.service.es_service import ElasticSearchService
+from etsin_finder_search.metax.metax_api import MetaxAPIService
+from etsin_finder_search.partial_updates import PartialUpdates, add_fingerprints, get_fingerprint_digest
+from etsin_finder_search.rabbitmq.event_journal import EventJournal
+from etsin_finder_search.rabbitmq.host_selection import HostSelector
+from etsin_finder_search.rabbitmq.recent_documents import RecentDocuments
+from etsin_finder_search.rabbitmq.worker_pool import WorkerPool
 from etsin_finder_search.reindexing_log import get_logger
 from etsin_finder_search.utils import \
     get_metax_rabbit_mq_config, \
+    get_metax_api_config, \
     get_elasticsearch_config, \
     get_catalog_record_previous_dataset_version_identifier, \
     catalog_record_has_next_dataset_version, \
     catalog_record_has_previous_dataset_version, \
     catalog_record_is_deprecated, \
-    catalog_has_preservation_dataset_origin_version, \
     catalog_record_has_preferred_identifier, \
     catalog_record_has_identifier, \
-    catalog_record_should_be_indexed, \
-    get_catalog_record_identifier, \
-    catalog_record_is_pas_catalog, \
-    get_catalog_preservation_state
+    get_catalog_record_identifier
+
+
+# Message received from one of the queues, kept around until it has been acked or rejected
+ReceivedMessage = namedtuple('ReceivedMessage', ['callback_type', 'delivery_tag', 'properties', 'body'])
+
+QUEUE_NAMES = {'create': 'etsin-create', 'update': 'etsin-update', 'delete': 'etsin-delete'}
+
+# Unique names of the queues created in local dev env, see MetaxConsumer._set_queue_names
+LOCAL_DEV_QUEUES_FILE = '/home/etsin-user/rabbitmq_queues.json'
+
+# Header telling how many retry rounds a message has already been through
+RETRY_COUNT_HEADER = 'x-etsin-retry-count'
+
+# States of the consumer, see request_pause and request_resume
+STARTING = 'starting'
+CONSUMING = 'consuming'
+PAUSING = 'pausing'
+PAUSED = 'paused'
+
+
+def is_local_dev_environment():
+    return os.path.isfile("/.dockerenv")
+
+
+def get_queue_names(is_local_dev):
+    """
+    Get the names of the queues the consumer consumes
+
+    :param is_local_dev: Whether running in local dev env, where the queues have unique names
+    :return: Dict of callback type to queue name, None if the local dev queues have not been created yet
+    """
+    if not is_local_dev:
+        return dict(QUEUE_NAMES)
+
+    if not os.path.isfile(LOCAL_DEV_QUEUES_FILE):
+        return None
+
+    with open(LOCAL_DEV_QUEUES_FILE) as json_data:
+        queues = json.load(json_data)
+    return dict((callback_type, queues.get(callback_type, None)) for callback_type in QUEUE_NAMES)
+
+
+def get_retry_queue_name(queue, delay_ms):
+    # The delay is part of the name, since the message TTL of an existing queue cannot be changed
+    return '{0}-retry-{1}ms'.format(queue, delay_ms)
+
+
+def get_dead_letter_queue_name(queue):
+    return '{0}-dead-letter'.format(queue)
+
+
+def _get_modification_time(cr_json):
+    # Metax timestamps share one ISO 8601 format, so they compare correctly as strings
+    return cr_json.get('date_modified') or cr_json.get('date_created')
 
 
 class MetaxConsumer():
 
-    def __init__(self):
+    # Messages prefetched per worker thread in worker mode
+    WORKER_PREFETCH = 10
+    # Delays of the retry rounds of messages that failed due to a transient error
+    DEFAULT_RETRY_DELAYS_MS = [10000, 60000, 600000]
+    # Seconds between updates of the queue length metrics
+    QUEUE_METRICS_INTERVAL = 15
+    # METAX_RABBITMQ options of modes this consumer class does not implement, see _get_option_errors
+    UNSUPPORTED_OPTIONS = ()
+
+    def __init__(self, rabbit_settings=None, es_settings=None):
+        """
+        :param rabbit_settings: METAX_RABBITMQ settings, read from the config file if None
+        :param es_settings: ELASTICSEARCH settings, read from the config file if None
+        """
         self.log = get_logger(__name__)
         self.event_processing_completed = True
+        self.stop_requested = False
         self.init_ok = False
+        self.state = STARTING
+        # Held while the state is changed from the control thread or consumers are started according to it
+        self.state_lock = threading.Lock()
+        self.create_consumer_tag = self.update_consumer_tag = self.delete_consumer_tag = None
 
         # Get configs
         # If these raise errors, let consumer init fail
-        self.rabbit_settings = get_metax_rabbit_mq_config()
-        es_settings = get_elasticsearch_config()
+        self.rabbit_settings = rabbit_settings or get_metax_rabbit_mq_config()
+        es_settings = es_settings or get_elasticsearch_config()
 
-        self.is_local_dev = True if os.path.isfile("/.dockerenv") else False
+        self.is_local_dev = is_local_dev_environment()
 
         if not self.rabbit_settings or not es_settings:
             self.log.error("Unable to load RabbitMQ configuration or Elasticsearch configuration")
             return
 
+        option_errors = self._get_option_errors()
+        if option_errors:
+            for option_error in option_errors:
+                self.log.error("Invalid METAX_RABBITMQ configuration: {0}".format(option_error))
+            return
+
+        # The ELASTICSEARCH config tells how documents are converted, how large they may be and whether documents
+        # with small changes are sent as partial updates, see CRConverter.from_config, document_budget and
+        # partial_updates. The converted reference data objects are shared by the documents through a ReferenceInterner.
+        self.converter = CRConverter.from_config(es_settings, ReferenceInterner())
+        self.document_budget = DocumentBudget.from_config(es_settings)
+        self.partial_updates = PartialUpdates.from_config(es_settings)
         self.credentials = pika.PlainCredentials(self.rabbit_settings['USER'], self.rabbit_settings['PASSWORD'])
         self.exchange = self.rabbit_settings['EXCHANGE']
         self._set_queue_names(self.is_local_dev)
 
-        self.es_client = ElasticSearchService.get_elasticsearch_service(es_settings)
-        if self.es_client is None:
-            return
-
-        if not self.es_client.ensure_index_existence():
+        # With BATCH_SIZE set, messages from all queues are collected and written into the index with one bulk
+        # request when BATCH_SIZE messages have arrived or BATCH_MAX_WAIT_MS has passed since the first one
+        self.batch_size = self.rabbit_settings.get('BATCH_SIZE', 0)
+        self.batch_max_wait_ms = self.rabbit_settings.get('BATCH_MAX_WAIT_MS', 1000)
+        self.batch = []
+        self.batch_timer = None
+
+        # In batch mode, several events for the same catalog record within a batch can be coalesced into one write
+        self.coalesce_events = self.rabbit_settings.get('COALESCE_EVENTS', False)
+        self.coalesced_writes_saved = 0
+
+        # With WORKERS above 1, messages are processed by that many worker threads. Messages are assigned to workers
+        # by catalog record identifier, so events for the same dataset are still applied in order
+        self.workers = self.rabbit_settings.get('WORKERS', 1)
+        self.worker_pool = None
+        self.worker_converters = []
+        if self.workers > 1:
+            # ReferenceInterner is not thread safe, so each worker converts with its own, sharing the indexing policy
+            self.worker_converters = [CRConverter.from_config(es_settings, ReferenceInterner(), self.converter.policy)
+                                      for _ in range(self.workers)]
+
+        # With SKIP_UNCHANGED_DOCUMENTS set, the digests of the last UNCHANGED_CACHE_SIZE documents written are kept,
+        # and a converted document with the same digest as the one last written is not written again. Documents not
+        # in the cache are compared with the field fingerprints stored in the index, see partial_updates.
+        self.recent_documents = None
+        if self.rabbit_settings.get('SKIP_UNCHANGED_DOCUMENTS', False):
+            self.recent_documents = RecentDocuments(
+                self.rabbit_settings.get('UNCHANGED_CACHE_SIZE', RecentDocuments.DEFAULT_MAX_SIZE))
+
+        # Messages that failed due to a transient error, e.g. Elasticsearch being unavailable, are retried after each
+        # delay of RETRY_DELAYS_MS. Messages that run out of retries or cannot be processed at all are moved to the
+        # dead-letter queue of their queue, from where replay_dead_letters.py returns them once the cause is fixed.
+        self.retry_delays_ms = self.rabbit_settings.get('RETRY_DELAYS_MS', self.DEFAULT_RETRY_DELAYS_MS)
+        self.dead_letter_queues = self.rabbit_settings.get('DEAD_LETTER_QUEUES', True)
+
+        # With JOURNAL_DIR set, events that fail due to a transient error are appended to a local journal and acked
+        # instead. While the journal has entries, new events are journaled too so that they stay in order. The
+        # journal is replayed into the index every JOURNAL_REPLAY_INTERVAL seconds until Elasticsearch responds.
+        self.journal = None
+        self.journal_replay_interval = self.rabbit_settings.get('JOURNAL_REPLAY_INTERVAL', 30)
+        self.journal_replay_timer = None
+        if self.rabbit_settings.get('JOURNAL_DIR'):
+            self.journal = EventJournal(
+                self.rabbit_settings['JOURNAL_DIR'],
+                self.rabbit_settings.get('JOURNAL_SEGMENT_MAX_BYTES', EventJournal.DEFAULT_SEGMENT_MAX_BYTES))
+
+        # With FLOOD_THRESHOLD set, the length of the consumed queues is checked every FLOOD_CHECK_INTERVAL seconds.
+        # Once FLOOD_THRESHOLD messages are waiting, e.g. after a mass update in Metax, the consumer switches to flood
+        # mode: messages are collected into rounds of FLOOD_BATCH_SIZE, only the last event of each catalog record is
+        # kept, the current state of those records is fetched from Metax API and the round is written with one bulk
+        # request. Flood mode ends when the queues are down to a tenth of the threshold.
+        self.flood_threshold = self.rabbit_settings.get('FLOOD_THRESHOLD', 0)
+        self.flood_check_interval = self.rabbit_settings.get('FLOOD_CHECK_INTERVAL', 10)
+        self.flood_batch_size = self.rabbit_settings.get('FLOOD_BATCH_SIZE', 500)
+        self.metax_api = None
+        if self.flood_threshold:
+            self.metax_api = MetaxAPIService.get_metax_api_service(get_metax_api_config())
+            if self.metax_api is None:
+                self.log.warning("Flood mode writes the catalog records as they are in the messages")
+        self._init_flood_state()
+
+        # Hosts that fail to connect are backed off, starting from CONNECT_INITIAL_BACKOFF seconds and doubling up to
+        # CONNECT_MAX_BACKOFF seconds, and healthy hosts are preferred meanwhile
+        self.host_selector = HostSelector(self.rabbit_settings['HOSTS'],
+                                          self.rabbit_settings.get('CONNECT_INITIAL_BACKOFF', 0.5),
+                                          self.rabbit_settings.get('CONNECT_MAX_BACKOFF', 30))
+        self.host = None
+        self.connection = None
+
+        if not self._init_es_client(es_settings):
             return
 
         self.init_ok = True
 
+    def _get_option_errors(self):
+        """
+        Check that the modes enabled in the METAX_RABBITMQ config can be used together. Batch mode (BATCH_SIZE) and
+        worker mode (WORKERS above 1) exclude each other, coalescing needs batch mode, and the journal and flood
+        mode are not implemented in worker mode.
+
+        :return: List of the reasons the options cannot be used, empty if they can
+        """
+        settings = self.rabbit_settings
+        batch_mode = bool(settings.get('BATCH_SIZE', 0))
+        worker_mode = settings.get('WORKERS', 1) > 1
+        errors = []
+        if batch_mode and worker_mode:
+            errors.append("BATCH_SIZE and WORKERS above 1 cannot be used together")
+        if settings.get('COALESCE_EVENTS', False) and not batch_mode:
+            errors.append("COALESCE_EVENTS requires BATCH_SIZE")
+        for option in ('JOURNAL_DIR', 'FLOOD_THRESHOLD'):
+            if settings.get(option) and worker_mode:
+                errors.append("{0} cannot be used with WORKERS above 1".format(option))
+        for option in self.UNSUPPORTED_OPTIONS:
+            if settings.get(option) and (option != 'WORKERS' or worker_mode):
+                errors.append("{0} is not supported by {1}".format(option, type(self).__name__))
+        return errors
+
+    def _init_flood_state(self):
+        self.flood_mode = False
+        self.flood_batch = []
+        self.flood_timer = None
+        # Identifier to modification time of the catalog records fetched from Metax during the current flood
+        self.flood_reconciled = {}
+
+    def _init_es_client(self, es_settings):
+        # Documents carry field fingerprints when unchanged documents are skipped, see _prepare_index_writes
+        self.es_client = ElasticSearchService.get_elasticsearch_service(es_settings, self.recent_documents is not None)
+        if self.es_client is None:
+            return False
+
+        return self.es_client.ensure_index_existence()
+
     def run(self):
-        if self._setup_connection() and self._setup_consumers():
-            self.log.info('RabbitMQ client starting to consume messages..')
-            print('[*] RabbitMQ is running. To exit press CTRL+C. See logs for indexing details.')
+        if not self._setup_connection() or not self._setup_consumers():
+            self.log.error('Unable to setup RabbitMQ connection or consumers')
+            return
+
+        self.log.info('RabbitMQ client starting to consume messages..')
+        print('[*] RabbitMQ is running. To exit press CTRL+C. See logs for indexing details.')
+        while True:
             try:
                 self.channel.start_consuming()
+                return
+            except pika.exceptions.AMQPConnectionError as e:
+                if self.stop_requested:
+                    return
+                self.log.error(e)
+                self.log.error('Lost connection to RabbitMQ host {0}, reconnecting..'.format(self.host))
+                self.host_selector.record_failure(self.host)
+                metrics.RABBITMQ_RECONNECTS.inc()
             except Exception as e:
                 self.log.error(e)
                 self.log.error('An error occurred while consuming')
                 return
-        else:
-            self.log.error('Unable to setup RabbitMQ connection or consumers')
-            return
+
+            self._reset_connection_state()
+            if not self._setup_connection() or not self._setup_consumers():
+                self.log.error('Unable to setup RabbitMQ connection or consumers')
+                return
+
+    def _reset_connection_state(self):
+        """
+        Forget the messages received over the lost connection. They were not acked, so RabbitMQ delivers them again.
+        Timers belong to the lost connection and are set up again with the consumers.
+        """
+        self.batch = []
+        self.batch_timer = None
+        flood_mode = self.flood_mode
+        self._init_flood_state()
+        if flood_mode:
+            metrics.CONSUMER_FLOOD_MODE.set(0)
+        self.journal_replay_timer = None
+        if self.worker_pool is not None:
+            discarded = self.worker_pool.discard()
+            if discarded:
+                self.log.info("Discarded {0} messages waiting for a worker".format(len(discarded)))
+        self.event_processing_completed = True
 
     def _setup_connection(self):
         self.log.info("Setting up connection to RabbitMQ server..")
-        hosts = self.rabbit_settings['HOSTS']
+        self.connection = None
 
         # Connection retries are needed as long as there is no load balancer in front of rabbitmq-server VMs
-        sleep_time = 30
         num_conn_retries = 3000
 
         for x in range(0, num_conn_retries):
-            # Choose host randomly so that different hosts are tried out in case of connection problems
+            host, wait = self.host_selector.choose()
+            if wait > 0:
+                self.log.info("Connecting to RabbitMQ host {0} in {1:.1f} seconds...".format(host, wait))
+                sleep(wait)
+
+            start = perf_counter()
             try:
-                self.connection = pika.BlockingConnection(pika.ConnectionParameters(
-                    random.choice(hosts),
+                connection = pika.BlockingConnection(pika.ConnectionParameters(
+                    host,
                     self.rabbit_settings['PORT'],
                     self.rabbit_settings['VHOST'],
                     self.credentials))
-
+                self.connection = connection
                 self.channel = self.connection.channel()
                 self._create_and_bind_queues(self.is_local_dev)
-                str_error = None
             except Exception as e:
                 self.log.error(e)
-                self.log.error("Problem connecting to RabbitMQ server, trying to reconnect in {0} seconds...".
-                               format(str(sleep_time)))
-                str_error = e
-
-            if str_error:
-                sleep(sleep_time)  # wait before trying to connect again
-            else:
-                break
-
-        if not self.connection:
-            return False
-
-        self.log.info("Connection OK")
-        return True
+                self.log.error("Problem connecting to RabbitMQ host {0}".format(host))
+                self.host_selector.record_failure(host)
+                metrics.RABBITMQ_CONNECTIONS.labels(host, 'error').inc()
+                self._close_connection()
+                continue
+
+            self.host = host
+            self.host_selector.record_success(host, perf_counter() - start)
+            metrics.RABBITMQ_CONNECTIONS.labels(host, 'ok').inc()
+            self.log.info("Connection OK")
+            return True
+
+        return False
+
+    def _close_connection(self):
+        if self.connection is not None and self.connection.is_open:
+            try:
+                self.connection.close()
+            except Exception as e:
+                self.log.debug(e)
+        self.connection = None
 
     def _setup_consumers(self):
         self.log.info("Setting up consumers..")
 
         def callback_create(ch, method, properties, body):
-            if not self._init_event_callback_ok("create", ch, method):
+            message = ReceivedMessage('create', method.delivery_tag, properties, body)
+            if not self._init_event_callback_ok(ch, message):
                 return
 
-            body_as_json = self._get_event_json_body(ch, method, body)
+            body_as_json = self._get_event_json_body(ch, message)
             if not body_as_json:
                 return
 
@@ -149,98 +389,79 @@ class MetaxConsumer():
                 self.log.info(
                     "Identifier {0} has a previous dataset version {1}. Trying to delete the previous dataset version "
                     "from index...".format(incoming_cr_id, prev_version_cr_id))
+                self._forget_indexed_document(prev_version_cr_id)
                 self.es_client.delete_dataset_from_index(prev_version_cr_id)
 
-            # If catalog_has_preservation_dataset_origin_version is found, it means the dataset is stored in PAS and has an original version.
-            # This original version will be displayed in the dataset list instead, so this PAS dataset version should be excluded.
-            if catalog_has_preservation_dataset_origin_version(body_as_json):
-                incoming_cr_id = get_catalog_record_identifier(body_as_json)
-                self.log.info("Identifier {0} is a PAS dataset, and has a dataset in original version. "
-                            "Trying to delete from index if it exists..".format(incoming_cr_id))
-                self._delete_from_index(ch, method, body_as_json)
-                ch.basic_ack(delivery_tag=method.delivery_tag)
-                self.event_processing_completed = True
-                return
-
-            # If catalog is  PAS and the preservation state is NOT 120, then it should not be indexed.
-            # Also remove it from the index if it already is there.
-            if catalog_record_is_pas_catalog(body_as_json) and get_catalog_preservation_state(body_as_json) != 120:
-                incoming_cr_id = get_catalog_record_identifier(body_as_json)
-                self.log.info("Identifier {0} is a PAS dataset with preservation_state other than 120, Trying to delete from index if it exists..".format(incoming_cr_id))
-                self._delete_from_index(ch, method, body_as_json)
-                ch.basic_ack(delivery_tag=method.delivery_tag)
-                self.event_processing_completed = True
-                return
-
-            self._convert_to_es_doc_and_reindex(ch, method, body_as_json)
+            # Whether the record is indexed, deleted from the index or skipped is decided by the indexing policy
+            self._convert_to_es_doc_and_reindex(ch, message, body_as_json)
 
         def callback_update(ch, method, properties, body):
-            if not self._init_event_callback_ok("update", ch, method):
+            message = ReceivedMessage('update', method.delivery_tag, properties, body)
+            if not self._init_event_callback_ok(ch, message):
                 return
 
-            body_as_json = self._get_event_json_body(ch, method, body)
+            body_as_json = self._get_event_json_body(ch, message)
             if not body_as_json:
                 return
 
-            if catalog_record_has_identifier(body_as_json):
-                incoming_cr_id = get_catalog_record_identifier(body_as_json)
-
-                # If catalog record has been deprecated, delete it from index
-                if catalog_record_is_deprecated(body_as_json):
-                    self.log.info("Identifier {0} is deprecated. "
-                                  "Trying to delete from index if it exists..".format(incoming_cr_id))
-                    self._delete_from_index(ch, method, body_as_json)
-                    ch.basic_ack(delivery_tag=method.delivery_tag)
-                    self.event_processing_completed = True
-                    return
-
-                # If catalog record has next dataset version, do not index it
-                if catalog_record_has_next_dataset_version(body_as_json):
-                    self.log.info("Identifier {0} has a next dataset version. Skipping reindexing..."
-                                  .format(incoming_cr_id))
-                    ch.basic_ack(delivery_tag=method.delivery_tag)
-                    self.event_processing_completed = True
-                    return
-
-                # If catalog_has_preservation_dataset_origin_version is found, it means the dataset is stored in PAS and has an original version.
-                # This original version will be displayed in the dataset list instead, so this PAS dataset version should be excluded.
-                if catalog_has_preservation_dataset_origin_version(body_as_json):
-                    self.log.info("Identifier {0} is a PAS dataset, and has a dataset in original version. "
-                                "Trying to delete from index if it exists..".format(incoming_cr_id))
-                    self._delete_from_index(ch, method, body_as_json)
-                    ch.basic_ack(delivery_tag=method.delivery_tag)
-                    self.event_processing_completed = True
-                    return
-
-                # If catalog is  PAS and the preservation state is NOT 120, then it should not be indexed.
-                # Also remove it from the index if it already is there.
-                if catalog_record_is_pas_catalog(body_as_json) and get_catalog_preservation_state(body_as_json) != 120:
-                    self.log.info("Identifier {0} is a PAS dataset with preservation_state other than 120, Trying to delete from index if it exists..".format(incoming_cr_id))
-                    self._delete_from_index(ch, method, body_as_json)
-                    ch.basic_ack(delivery_tag=method.delivery_tag)
-                    self.event_processing_completed = True
-                    return
+            # If catalog record has next dataset version, do not index it, unless it is deprecated and to be deleted
+            if catalog_record_has_identifier(body_as_json) and not catalog_record_is_deprecated(body_as_json) and \
+                    catalog_record_has_next_dataset_version(body_as_json):
+                self.log.info("Identifier {0} has a next dataset version. Skipping reindexing..."
+                              .format(get_catalog_record_identifier(body_as_json)))
+                ch.basic_ack(delivery_tag=method.delivery_tag)
+                self.event_processing_completed = True
+                return
 
-            self._convert_to_es_doc_and_reindex(ch, method, body_as_json)
+            self._convert_to_es_doc_and_reindex(ch, message, body_as_json)
 
         def callback_delete(ch, method, properties, body):
-            if not self._init_event_callback_ok("delete", ch, method):
+            message = ReceivedMessage('delete', method.delivery_tag, properties, body)
+            if not self._init_event_callback_ok(ch, message):
                 return
 
-            body_as_json = self._get_event_json_body(ch, method, body)
+            body_as_json = self._get_event_json_body(ch, message)
             if not body_as_json:
                 return
 
-            self._delete_from_index(ch, method, body_as_json)
+            self._delete_from_index(ch, message, body_as_json)
+
+        callbacks = {'create': callback_create, 'update': callback_update, 'delete': callback_delete}
+        if self.batch_size:
+            self.log.info("Consuming in batches of at most {0} messages or {1} ms".format(
+                self.batch_size, self.batch_max_wait_ms))
+            callbacks = {callback_type: partial(self._on_batched_message, callback_type) for callback_type in callbacks}
+        elif self.workers > 1:
+            self.log.info("Consuming with {0} worker threads".format(self.workers))
+            if self.worker_pool is None:
+                self.worker_pool = WorkerPool(self.workers, self._process_event_in_worker, 'metax-consumer-worker')
+                self.worker_pool.start()
+            callbacks = {callback_type: partial(self._dispatch_to_worker, callback_type) for callback_type in callbacks}
+
+        if self.flood_threshold:
+            callbacks = {callback_type: partial(self._on_message_in_flood_mode, callback_type, callback)
+                         for callback_type, callback in callbacks.items()}
+            self.connection.call_later(self.flood_check_interval, self._check_for_flood)
+
+        if self.journal is not None:
+            callbacks = {callback_type: partial(self._on_message_while_journaling, callback_type, callback)
+                         for callback_type, callback in callbacks.items()}
+            if not self.journal.is_empty():
+                self._schedule_journal_replay()
+
+        callbacks = {callback_type: partial(self._on_measured_message, callback_type, callback)
+                     for callback_type, callback in callbacks.items()}
+        if metrics.is_serving():
+            self._update_queue_metrics()
 
         # Set up consumers so that acks are required
+        self.callbacks = callbacks
         try:
-            self.create_consumer_tag = self.channel.basic_consume(
-                self.create_queue, callback_create, auto_ack=False)
-            self.update_consumer_tag = self.channel.basic_consume(
-                self.update_queue, callback_update, auto_ack=False)
-            self.delete_consumer_tag = self.channel.basic_consume(
-                self.delete_queue, callback_delete, auto_ack=False)
+            if self.batch_size:
+                self.channel.basic_qos(prefetch_count=self.batch_size)
+            elif self.worker_pool is not None:
+                self.channel.basic_qos(prefetch_count=self.workers * self.WORKER_PREFETCH)
+            self._start_consumers_unless_paused()
         except Exception as e:
             self.log.error(e)
             self.log.error("Unable to setup consumers")
@@ -249,80 +470,863 @@ class MetaxConsumer():
         self.log.info("Consumers OK")
         return True
 
+    def _start_consumers_unless_paused(self):
+        with self.state_lock:
+            if self.state in (PAUSING, PAUSED):
+                # Messages being processed when pausing were forgotten with the connection they came from
+                self.state = PAUSED
+                self.log.info("Consumer is paused, not consuming until resumed")
+                return
+
+            self._start_consumers()
+            self.state = CONSUMING
+
+    def _start_consumers(self):
+        self.create_consumer_tag = self.channel.basic_consume(
+            self.create_queue, self.callbacks['create'], auto_ack=False)
+        self.update_consumer_tag = self.channel.basic_consume(
+            self.update_queue, self.callbacks['update'], auto_ack=False)
+        self.delete_consumer_tag = self.channel.basic_consume(
+            self.delete_queue, self.callbacks['delete'], auto_ack=False)
+
+    def request_pause(self):
+        """
+        Stop taking messages from the queues, leaving new messages waiting there. The state turns from pausing to
+        paused once the messages received so far have been processed. Can be called from any thread. Before the
+        consumer has connected or while it is reconnecting, the consumer is paused right away and stays paused on
+        the new connection.
+        """
+        with self.state_lock:
+            if self.state == STARTING or not self._is_connected():
+                self.state = PAUSED
+            else:
+                self._call_threadsafe(self._pause)
+
+    def request_resume(self):
+        """
+        Start taking messages from the queues again after a pause. Can be called from any thread. Before the
+        consumer has connected or while it is reconnecting, it starts consuming once connected.
+        """
+        with self.state_lock:
+            if not self._is_connected():
+                if self.state in (PAUSING, PAUSED):
+                    self.state = STARTING
+            else:
+                self._call_threadsafe(self._resume)
+
+    def get_status(self):
+        """
+        :return: Dict describing the state of the consumer
+        """
+        return {
+            'state': self.state,
+            'pid': os.getpid(),
+            'host': self.host,
+            'connected': self._is_connected(),
+            'processing': not self.processing_completed(),
+            'flood_mode': self.flood_mode,
+            'journaled_events': self.journal is not None and not self.journal.is_empty(),
+        }
+
+    def _is_connected(self):
+        return self.connection is not None and self.connection.is_open
+
+    def _call_threadsafe(self, callback):
+        self.connection.add_callback_threadsafe(callback)
+
+    def _call_later(self, delay, callback):
+        self.connection.call_later(delay, callback)
+
+    def _pause(self):
+        if self.state != CONSUMING:
+            return
+
+        self.log.info("Pausing consumer..")
+        self._cancel_consumers()
+        if self.batch:
+            self._flush_batch()
+        if self.flood_batch:
+            self._flush_flood_batch()
+        self.state = PAUSING
+        self._complete_pause()
+
+    def _complete_pause(self):
+        if self.state != PAUSING:
+            return
+
+        if self.processing_completed():
+            self.state = PAUSED
+            self.log.info("Consumer paused")
+        else:
+            self._call_later(0.1, self._complete_pause)
+
+    def _resume(self):
+        if self.state not in (PAUSING, PAUSED):
+            return
+
+        # The index may have been rewritten meanwhile, e.g. by the reindexer
+        if self.recent_documents is not None:
+            self.recent_documents.clear()
+        self._start_consumers()
+        self.state = CONSUMING
+        self.log.info("Consumer resumed")
+
+    def _on_measured_message(self, callback_type, callback, ch, method, properties, body):
+        metrics.CONSUMER_MESSAGES.labels(callback_type).inc()
+        if self.batch_size or self.worker_pool is not None or self.flood_mode:
+            # Processing happens later, where it is measured
+            callback(ch, method, properties, body)
+            return
+
+        start = perf_counter()
+        try:
+            callback(ch, method, properties, body)
+        finally:
+            self._record_processed_message(callback_type, start)
+
+    def _record_processed_message(self, callback_type, start):
+        metrics.CONSUMER_MESSAGE_SECONDS.labels(callback_type).observe(perf_counter() - start)
+        metrics.CONSUMER_LAST_PROCESSED.labels(callback_type).set_to_current_time()
+
+    def _update_queue_metrics(self):
+        queues = [self.create_queue, self.update_queue, self.delete_queue]
+        if self.dead_letter_queues:
+            queues += [get_dead_letter_queue_name(queue) for queue in queues]
+
+        try:
+            for queue in queues:
+                message_count = self.channel.queue_declare(queue, passive=True).method.message_count
+                metrics.CONSUMER_QUEUE_MESSAGES.labels(queue).set(message_count)
+        except Exception as e:
+            self.log.error(e)
+            self.log.error("Unable to update queue length metrics")
+            return
+
+        self.connection.call_later(self.QUEUE_METRICS_INTERVAL, self._update_queue_metrics)
+
     def before_stop(self):
         self._cancel_consumers()
+        if self.batch and self.event_processing_completed:
+            self._flush_batch()
+        if self.flood_batch and self.event_processing_completed:
+            self._flush_flood_batch()
+        if self.worker_pool is not None:
+            discarded = self.worker_pool.stop()
+            if discarded:
+                self.log.info("{0} messages waiting for a worker were left unacknowledged, RabbitMQ will redeliver "
+                              "them".format(len(discarded)))
+        if self.partial_updates.enabled:
+            self.log.info(self.partial_updates.report())
+        if self.recent_documents is not None:
+            self.log.info(self.recent_documents.report())
+
+    def processing_completed(self):
+        if self.worker_pool is not None:
+            return self.worker_pool.stopped() or self.worker_pool.idle()
+        return self.event_processing_completed
+
+    def wait_for_processing(self, seconds):
+        """
+        Wait for the current event processing. In worker mode the connection keeps sending the acks of the
+        workers meanwhile, since acks can only be sent from the connection thread.
+        """
+        if self.worker_pool is not None:
+            self.connection.process_data_events(time_limit=seconds)
+        else:
+            sleep(seconds)
+
+    def _dispatch_to_worker(self, callback_type, ch, method, properties, body):
+        message = ReceivedMessage(callback_type, method.delivery_tag, properties, body)
+        body_as_json = self._get_event_json_body(ch, message)
+        if not body_as_json:
+            return
+
+        ordering_key = get_catalog_record_identifier(body_as_json) or method.delivery_tag
+        # The converter of the worker the message is assigned to, only ever used by that worker thread
+        converter = self.worker_converters[self.worker_pool.worker_index(ordering_key)]
+        self.worker_pool.submit(ordering_key, (self.connection, message, body_as_json, converter))
+
+    def _process_event_in_worker(self, item):
+        connection, message, body_as_json, converter = item
+        self.log.debug("Received {0} message from Metax RabbitMQ".format(message.callback_type))
+        start = perf_counter()
+
+        event_ok = False
+        transient = True
+        try:
+            if self.es_client.ensure_index_existence():
+                es_actions = self._get_es_actions_for_event(message.callback_type, body_as_json, converter)
+                if es_actions is None:
+                    transient = False
+                else:
+                    event_ok = all(self._do_es_action(action) or not required for required, action in es_actions)
+        except Exception as e:
+            self.log.error(e)
+            event_ok = False
+
+        self._record_processed_message(message.callback_type, start)
+
+        if connection is not self.connection:
+            self.log.info("Connection lost while processing message with delivery tag {0}, RabbitMQ will deliver "
+                          "it again".format(message.delivery_tag))
+            return
+
+        # Channel methods are not thread safe, so acks are sent from the connection thread
+        if event_ok:
+            self.connection.add_callback_threadsafe(
+                partial(self.channel.basic_ack, delivery_tag=message.delivery_tag))
+        else:
+            self.log.error('Failed to process {0} message with delivery tag {1}'.format(
+                message.callback_type, message.delivery_tag))
+            self.connection.add_callback_threadsafe(partial(self._reject, self.channel, message, transient))
+
+    def _do_es_action(self, es_action):
+        action, payload = es_action
+        if action == 'index':
+            if self.es_client.reindex_dataset(payload):
+                return True
+            self._forget_indexed_document(payload.get_es_document_id())
+            return False
+        return self.es_client.delete_dataset_from_index(payload)
+
+    def _on_batched_message(self, callback_type, ch, method, properties, body):
+        self.batch.append(ReceivedMessage(callback_type, method.delivery_tag, properties, body))
+        if len(self.batch) >= self.batch_size:
+            self._flush_batch()
+        elif self.batch_timer is None:
+            self.batch_timer = self.connection.call_later(self.batch_max_wait_ms / 1000.0, self._flush_batch)
+
+    def _flush_batch(self):
+        """
+        Write the collected batch into the index with one bulk request. Messages whose actions failed are rejected
+        one by one, after which the rest of the batch is acked with a single multiple=True ack.
+        """
+        if self.batch_timer is not None:
+            self.connection.remove_timeout(self.batch_timer)
+            self.batch_timer = None
+
+        batch, self.batch = self.batch, []
+        self._write_batch(batch, self.coalesce_events)
+
+    def _write_batch(self, batch, coalesce, reconcile=False):
+        """
+        :param batch: List of ReceivedMessage
+        :param coalesce: Whether to coalesce events for the same catalog record into one write
+        :param reconcile: Whether to write the current state of the catalog records in Metax instead of the messages
+        """
+        if not batch:
+            return
+
+        if self.journal is not None and not self.journal.is_empty():
+            for event in batch:
+                if not self._journal_message(self.channel, event):
+                    self._reject(self.channel, event, transient=True)
+            return
+
+        self.event_processing_completed = False
+        metrics.CONSUMER_BATCH_SIZE.observe(len(batch))
+        start = perf_counter()
+        try:
+            failed_tags = self._process_batch(batch, coalesce, reconcile)
+            for event in batch:
+                if event.delivery_tag in failed_tags:
+                    self._reject(self.channel, event, failed_tags[event.delivery_tag])
+
+            succeeded_tags = [event.delivery_tag for event in batch if event.delivery_tag not in failed_tags]
+            if succeeded_tags:
+                self.channel.basic_ack(delivery_tag=max(succeeded_tags), multiple=True)
+
+            self.log.info("Processed batch of {0} messages, {1} failed".format(len(batch), len(failed_tags)))
+        finally:
+            metrics.CONSUMER_BATCH_SECONDS.observe(perf_counter() - start)
+            self.event_processing_completed = True
+
+    def _process_batch(self, batch, coalesce=False, reconcile=False):
+        """
+        :param batch: List of ReceivedMessage
+        :param coalesce: Whether to coalesce events for the same catalog record into one write
+        :param reconcile: Whether to write the current state of the catalog records in Metax instead of the messages,
+            requires coalesce
+        :return: Dict of delivery tags of the messages that failed to whether the failure was transient
+        """
+        if not self.es_client.ensure_index_existence():
+            return dict((event.delivery_tag, True) for event in batch)
+
+        failed_tags = {}
+        parsed_events = []
+        for event in batch:
+            self.log.debug("Received {0} message from Metax RabbitMQ".format(event.callback_type))
+            body_as_json = self._get_message_body_as_json(event.body)
+            if body_as_json:
+                parsed_events.append((event, body_as_json))
+            else:
+                failed_tags[event.delivery_tag] = False
+
+        superseded = {}
+        if coalesce:
+            parsed_events, superseded = self._coalesce_events(parsed_events)
+            if reconcile:
+                parsed_events = self._reconcile_with_metax(parsed_events)
+
+        tagged_actions = []
+        all_es_actions = self._get_es_actions_for_events(
+            [(event.callback_type, body_as_json) for event, body_as_json in parsed_events])
+        for (event, body_as_json), es_actions in zip(parsed_events, all_es_actions):
+            if es_actions is None:
+                failed_tags[event.delivery_tag] = False
+                continue
+
+            # Superseded create events may still have a previous dataset version to remove from the index
+            for superseded_event, superseded_body in superseded.get(event.delivery_tag, []):
+                if superseded_event.callback_type == 'create' and \
+                        catalog_record_has_previous_dataset_version(superseded_body):
+                    prev_version_cr_id = get_catalog_record_previous_dataset_version_identifier(superseded_body)
+                    es_actions = [(False, ('delete', prev_version_cr_id))] + es_actions
+
+            for required, action in es_actions:
+                tagged_actions.append((event.delivery_tag, required, action))
+
+        results = self.es_client.do_bulk_request_for_actions([action for _, _, action in tagged_actions])
+        for (delivery_tag, required, action), ok in zip(tagged_actions, results):
+            if not ok and action[0] == 'index':
+                self._forget_indexed_document(action[1].get_es_document_id())
+            if required and not ok:
+                failed_tags[delivery_tag] = True
+
+        # Superseded deliveries share the outcome of the event that replaced them
+        for delivery_tag, superseded_events in superseded.items():
+            if delivery_tag in failed_tags:
+                failed_tags.update((event.delivery_tag, failed_tags[delivery_tag]) for event, _ in superseded_events)
+
+        return failed_tags
+
+    def _coalesce_events(self, parsed_events):
+        """
+        Keep only one event per catalog record identifier: the last delete event if there is one, otherwise the
+        last event. Events without an identifier are kept as they are.
+
+        :param parsed_events: List of (ReceivedMessage, body_as_json) tuples in delivery order
+        :return: Tuple of the surviving (ReceivedMessage, body_as_json) tuples in delivery order and a dict of
+            surviving delivery tag to the list of (ReceivedMessage, body_as_json) tuples it superseded
+        """
+        groups = {}
+        for event, body_as_json in parsed_events:
+            cr_id = get_catalog_record_identifier(body_as_json) or ('no identifier', event.delivery_tag)
+            groups.setdefault(cr_id, []).append((event, body_as_json))
+
+        surviving_events = []
+        superseded = {}
+        for group in groups.values():
+            deletes = [item for item in group if item[0].callback_type == 'delete']
+            survivor = deletes[-1] if deletes else group[-1]
+            surviving_events.append(survivor)
+            if len(group) > 1:
+                superseded[survivor[0].delivery_tag] = [item for item in group if item is not survivor]
+
+        saved_writes = len(parsed_events) - len(surviving_events)
+        if saved_writes:
+            self.coalesced_writes_saved += saved_writes
+            self.log.info("Coalescing saved {0} index writes in this batch, {1} in total".format(
+                saved_writes, self.coalesced_writes_saved))
+
+        surviving_events.sort(key=lambda item: item[0].delivery_tag)
+        return surviving_events, superseded
+
+    def _on_message_in_flood_mode(self, callback_type, callback, ch, method, properties, body):
+        if not self.flood_mode:
+            callback(ch, method, properties, body)
+            return
+
+        self.flood_batch.append(ReceivedMessage(callback_type, method.delivery_tag, properties, body))
+        if len(self.flood_batch) >= self.flood_batch_size:
+            self._flush_flood_batch()
+        elif self.flood_timer is None:
+            self.flood_timer = self.connection.call_later(self.batch_max_wait_ms / 1000.0, self._flush_flood_batch)
+
+    def _flush_flood_batch(self):
+        if self.flood_timer is not None:
+            self.connection.remove_timeout(self.flood_timer)
+            self.flood_timer = None
+
+        batch, self.flood_batch = self.flood_batch, []
+        self._write_batch(batch, coalesce=True, reconcile=True)
+
+    def _check_for_flood(self):
+        """
+        Switch between flood mode and normal mode by the number of messages waiting in the consumed queues
+        """
+        if self.state in (PAUSING, PAUSED):
+            self.connection.call_later(self.flood_check_interval, self._check_for_flood)
+            return
 
-    def _delete_from_index(self, ch, method, body_as_json):
+        try:
+            message_count = sum(self.channel.queue_declare(queue, passive=True).method.message_count
+                                for queue in (self.create_queue, self.update_queue, self.delete_queue))
+        except Exception as e:
+            self.log.error(e)
+            self.log.error("Unable to check queue lengths for flood mode")
+            message_count = None
+
+        if message_count is not None:
+            if not self.flood_mode and message_count >= self.flood_threshold:
+                self._enter_flood_mode(message_count)
+            elif self.flood_mode and message_count <= self.flood_threshold // 10:
+                self._leave_flood_mode(message_count)
+
+        self.connection.call_later(self.flood_check_interval, self._check_for_flood)
+
+    def _enter_flood_mode(self, message_count):
+        self.log.info("{0} messages waiting, switching to flood mode".format(message_count))
+        # Messages collected before the switch are written first, so that events stay in order
+        if self.batch:
+            self._flush_batch()
+        self.flood_mode = True
+        self.channel.basic_qos(prefetch_count=self.flood_batch_size)
+        metrics.CONSUMER_FLOOD_MODE.set(1)
+
+    def _leave_flood_mode(self, message_count):
+        self.log.info("{0} messages waiting, leaving flood mode".format(message_count))
+        self._flush_flood_batch()
+        self._init_flood_state()
+        if self.batch_size:
+            self.channel.basic_qos(prefetch_count=self.batch_size)
+        else:
+            # No limit, as when no prefetch count has been set
+            self.channel.basic_qos(prefetch_count=0)
+        metrics.CONSUMER_FLOOD_MODE.set(0)
+
+    def _reconcile_with_metax(self, parsed_events):
+        """
+        Replace the message bodies of coalesced events with the current state of the catalog records in Metax. Events
+        of records removed from Metax become delete events. Create and update events of records already fetched
+        during this flood at the same or a later modification time are left out, since the index has their state
+        already. If a record cannot be fetched, its message body is used.
+
+        :param parsed_events: List of (ReceivedMessage, body_as_json) tuples with one event per catalog record
+        :return: List of (ReceivedMessage, body_as_json) tuples to write into the index
+        """
+        events = []
+        for event, body_as_json in parsed_events:
+            cr_id = get_catalog_record_identifier(body_as_json)
+            modified = _get_modification_time(body_as_json)
+            if event.callback_type != 'delete' and cr_id in self.flood_reconciled and modified and \
+                    modified <= self.flood_reconciled[cr_id]:
+                metrics.CONSUMER_FLOOD_SKIPPED_EVENTS.inc()
+                continue
+            events.append((event, body_as_json))
+
+        identifiers = [get_catalog_record_identifier(body_as_json) for _, body_as_json in events]
+        identifiers = [cr_id for cr_id in identifiers if cr_id]
+        if self.metax_api is None or not identifiers:
+            return events
+
+        records, removed = self.metax_api.get_catalog_records(identifiers)
+        self.log.info("Fetched {0} catalog records from Metax, {1} removed and {2} failed".format(
+            len(records), len(removed), len(identifiers) - len(records) - len(removed)))
+
+        reconciled_events = []
+        for event, body_as_json in events:
+            cr_id = get_catalog_record_identifier(body_as_json)
+            if cr_id in removed:
+                event, body_as_json = event._replace(callback_type='delete'), body_as_json
+            elif cr_id in records:
+                body_as_json = records[cr_id]
+                self.flood_reconciled[cr_id] = _get_modification_time(body_as_json)
+                # A create event still removes the previous dataset version from the index
+                if event.callback_type != 'create':
+                    event = event._replace(callback_type='update')
+            reconciled_events.append((event, body_as_json))
+
+        return reconciled_events
+
+    def _get_es_actions_for_event(self, callback_type, body_as_json, converter=None, prepare=True):
+        """
+        Decide the index actions for a message the same way the per message callbacks do.
+
+        :param converter: CRConverter of the calling worker thread, None for the converter of the consumer
+        :param prepare: Whether the index writes are prepared with _prepare_index_writes, False when the caller
+            does it itself
+        :return: List of (required, action) tuples, where action is ('index', ESDatasetModel) or ('delete', doc_id)
+            and failing of a non-required action does not fail the message. None if the message cannot be processed.
+        """
+        return self._get_es_actions_for_events([(callback_type, body_as_json)], converter, prepare)[0]
+
+    def _get_es_actions_for_events(self, events, converter=None, prepare=True):
+        """
+        Decide the index actions for several messages, converting their catalog records as one batch
+
+        :param events: List of (callback_type, body_as_json) tuples
+        :param converter: CRConverter of the calling worker thread, None for the converter of the consumer
+        :param prepare: See _get_es_actions_for_event
+        :return: List of the actions of each event as returned by _get_es_actions_for_event, in the same order
+        """
+        results = [None] * len(events)
+        to_convert = []
+        for position, (callback_type, body_as_json) in enumerate(events):
+            es_actions, convert = self._get_event_actions(callback_type, body_as_json)
+            if convert:
+                to_convert.append((position, es_actions, body_as_json))
+            else:
+                results[position] = es_actions
+
+        converted = (converter or self.converter).convert_many(body_as_json for _, _, body_as_json in to_convert)
+        for (position, es_actions, _), converted_record in zip(to_convert, converted):
+            results[position] = self._get_record_actions(es_actions, converted_record)
+
+        if prepare:
+            self._prepare_index_writes(results)
+        return results
+
+    def _prepare_index_writes(self, all_es_actions):
+        """
+        Leave out the index actions of documents unchanged since they were last written, and turn the documents with
+        small changes into partial updates. The field fingerprints of the documents are fetched from the index with
+        one request when needed.
+
+        :param all_es_actions: List of the actions of events as returned by _get_es_actions_for_event, modified in
+            place
+        """
+        dataset_models, previous_digests, to_fetch = self._get_fingerprints_to_fetch(all_es_actions)
+        stored_fingerprints = self.es_client.get_field_fingerprints(to_fetch) if to_fetch else {}
+        self._apply_field_fingerprints(all_es_actions, dataset_models, previous_digests, stored_fingerprints)
+
+    def _get_fingerprints_to_fetch(self, all_es_actions):
+        """
+        First half of _prepare_index_writes, up to fetching the field fingerprints from the index
+
+        :return: Tuple of the dataset models to prepare, the digests this consumer last wrote for them, or None
+            without SKIP_UNCHANGED_DOCUMENTS, and the doc ids whose field fingerprints are to be fetched
+        """
+        dataset_models = []
+        for es_actions in all_es_actions:
+            for _, (action, payload) in es_actions or []:
+                if action == 'index':
+                    dataset_models.append(payload)
+                else:
+                    self._forget_indexed_document(payload)
+
+        if not dataset_models or (self.recent_documents is None and not self.partial_updates.enabled):
+            return [], None, []
+
+        if self.recent_documents is None:
+            return dataset_models, None, [dataset_model.get_es_document_id() for dataset_model in dataset_models]
+
+        previous_digests = {}
+        for dataset_model in dataset_models:
+            doc_id = dataset_model.get_es_document_id()
+            if doc_id not in previous_digests:
+                previous_digests[doc_id] = self.recent_documents.get(doc_id)
+        to_fetch = list(previous_digests) if self.partial_updates.enabled else \
+            [doc_id for doc_id, digest in previous_digests.items() if digest is None]
+        return dataset_models, previous_digests, to_fetch
+
+    def _apply_field_fingerprints(self, all_es_actions, dataset_models, previous_digests, stored_fingerprints):
+        """
+        Second half of _prepare_index_writes, with the values returned by _get_fingerprints_to_fetch and the field
+        fingerprints fetched from the index
+        """
+        if not dataset_models:
+            return
+
+        if previous_digests is None:
+            self.partial_updates.prepare(dataset_models, stored_fingerprints)
+            return
+
+        unchanged = set()
+        changed_models = []
+        for dataset_model in dataset_models:
+            doc_id = dataset_model.get_es_document_id()
+            digest = get_fingerprint_digest(add_fingerprints(dataset_model.doc_obj))
+            previous_digest, source = previous_digests[doc_id], 'cache'
+            if previous_digest is None:
+                previous_digest, source = get_fingerprint_digest(stored_fingerprints.get(doc_id)), 'index'
+
+            if digest == previous_digest:
+                unchanged.add(id(dataset_model))
+                metrics.CONSUMER_UNCHANGED_DOCUMENTS.labels(source).inc()
+                self.log.debug("Document {0} is unchanged, not writing it into the index".format(doc_id))
+            else:
+                previous_digests[doc_id] = digest
+                self.recent_documents.put(doc_id, digest)
+                changed_models.append(dataset_model)
+
+        if unchanged:
+            for es_actions in all_es_actions:
+                if es_actions:
+                    es_actions[:] = [(required, (action, payload)) for required, (action, payload) in es_actions
+                                     if action != 'index' or id(payload) not in unchanged]
+        self.partial_updates.prepare(changed_models, stored_fingerprints)
+
+    def _forget_indexed_document(self, doc_id):
+        # The document is being deleted or failed to be written, so the index may not have its last digest
+        if self.recent_documents is not None:
+            self.recent_documents.forget(doc_id)
+
+    def _get_event_actions(self, callback_type, body_as_json):
+        """
+        :return: Tuple of the actions decided by the type of the event, None if the message cannot be processed, and
+            whether the catalog record is to be converted to decide the rest
+        """
+        incoming_cr_id = get_catalog_record_identifier(body_as_json)
+        if callback_type == 'delete':
+            if not incoming_cr_id:
+                self.log.error('No identifier found from RabbitMQ message, ignoring')
+                return None, False
+            return [(True, ('delete', incoming_cr_id))], False
+
+        es_actions = []
+        if callback_type == 'create':
+            if incoming_cr_id and catalog_record_has_previous_dataset_version(body_as_json):
+                prev_version_cr_id = get_catalog_record_previous_dataset_version_identifier(body_as_json)
+                self.log.info("Identifier {0} has a previous dataset version {1}. Trying to delete the previous "
+                              "dataset version from index...".format(incoming_cr_id, prev_version_cr_id))
+                es_actions.append((False, ('delete', prev_version_cr_id)))
+        elif incoming_cr_id and not catalog_record_is_deprecated(body_as_json) and \
+                catalog_record_has_next_dataset_version(body_as_json):
+            self.log.info("Identifier {0} has a next dataset version. Skipping reindexing...".format(incoming_cr_id))
+            return [], False
+
+        return es_actions, True
+
+    def _get_record_actions(self, es_actions, converted_record):
+        """
+        :param converted_record: ConvertedRecord of the catalog record from CRConverter.convert_many
+        :return: es_actions followed by the actions for the catalog record, None if the message cannot be processed
+        """
+        identifier, action, reason, es_doc = converted_record
+        if action == DELETE:
+            if not identifier:
+                self.log.error('No identifier found from RabbitMQ message, ignoring')
+                return None
+            self.log.info("Identifier {0} is to be deleted ({1}). "
+                          "Trying to delete from index if it exists..".format(identifier, reason))
+            return es_actions + [(True, ('delete', identifier))]
+
+        if action == SKIP:
+            if reason != CONVERSION_FAILED:
+                self.log.debug('Catalog record not indexed due to defined rules ({0})'.format(reason))
+                return []
+            self.log.error("Unable to convert Metax catalog record to es data model, not requeing message")
+            return None
+
+        separate_request = self.document_budget.apply(es_doc)
+        return es_actions + [(True, ('index', ESDatasetModel(es_doc, separate_request)))]
+
+    def _delete_from_index(self, ch, message, body_as_json):
         try:
             cr_id_for_doc_to_delete = get_catalog_record_identifier(body_as_json)
             if cr_id_for_doc_to_delete:
+                self._forget_indexed_document(cr_id_for_doc_to_delete)
                 delete_success = self.es_client.delete_dataset_from_index(cr_id_for_doc_to_delete)
                 if delete_success:
-                    ch.basic_ack(delivery_tag=method.delivery_tag)
+                    ch.basic_ack(delivery_tag=message.delivery_tag)
                 else:
                     self.log.error('Failed to delete document from index: %s', cr_id_for_doc_to_delete)
-                    ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+                    self._reject(ch, message, transient=True)
             else:
                 self.log.error('No identifier found from RabbitMQ message, ignoring')
-                ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+                self._reject(ch, message, transient=False)
         except RequestError:
             self.log.error('Request error on trying to delete from index triggered by RabbitMQ')
-            ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+            self._reject(ch, message, transient=True)
         finally:
             self.event_processing_completed = True
 
-    def _convert_to_es_doc_and_reindex(self, ch, method, body_as_json):
-        if not catalog_record_should_be_indexed(body_as_json):
-            self.log.debug('Catalog record not indexed due to defined rules')
-            ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
-            self.event_processing_completed = True
+    def _convert_to_es_doc_and_reindex(self, ch, message, body_as_json):
+        """
+        Index, delete or skip the catalog record of a message as decided by the indexing policy of the converter
+        """
+        identifier, action, reason, es_doc = next(self.converter.convert_many([body_as_json]))
+        if action == DELETE:
+            self.log.info("Identifier {0} is to be deleted ({1}). "
+                          "Trying to delete from index if it exists..".format(identifier, reason))
+            self._delete_from_index(ch, message, body_as_json)
             return
 
-        if not catalog_record_has_preferred_identifier(body_as_json) or not catalog_record_has_identifier(body_as_json):
-            self.log.error('No preferred_identifier or identifier found from RabbitMQ message, ignoring')
-            ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+        if action == SKIP and reason != CONVERSION_FAILED:
+            # Acked as on the batched path, there is nothing to retry
+            self.log.debug('Catalog record not indexed due to defined rules ({0})'.format(reason))
+            ch.basic_ack(delivery_tag=message.delivery_tag)
             self.event_processing_completed = True
             return
 
-        converter = CRConverter()
-        es_doc = converter.convert_metax_cr_json_to_es_data_model(body_as_json)
-        if not es_doc:
-            self.log.error("Unable to convert Metax catalog record to es data model, not requeing message")
-            ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+        if action == SKIP:
+            if not catalog_record_has_preferred_identifier(body_as_json) or \
+                    not catalog_record_has_identifier(body_as_json):
+                self.log.error('No preferred_identifier or identifier found from RabbitMQ message, ignoring')
+            else:
+                self.log.error("Unable to convert Metax catalog record to es data model, not requeing message")
+            self._reject(ch, message, transient=False)
             self.event_processing_completed = True
             return
 
         try:
-            es_reindex_success = self.es_client.reindex_dataset(ESDatasetModel(es_doc))
+            # Documents are indexed one by one here, only truncating or dropping fields matters
+            self.document_budget.apply(es_doc)
+            dataset_model = ESDatasetModel(es_doc)
+            es_actions = [(True, ('index', dataset_model))]
+            self._prepare_index_writes([es_actions])
+            if not es_actions:
+                ch.basic_ack(delivery_tag=message.delivery_tag)
+                return
+
+            es_reindex_success = self.es_client.reindex_dataset(dataset_model)
             if es_reindex_success:
-                ch.basic_ack(delivery_tag=method.delivery_tag)
+                ch.basic_ack(delivery_tag=message.delivery_tag)
             else:
                 self.log.error('Failed to reindex %s', get_catalog_record_identifier(body_as_json))
-                ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+                self._forget_indexed_document(dataset_model.get_es_document_id())
+                self._reject(ch, message, transient=True)
         except Exception:
-            ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+            self._forget_indexed_document(get_catalog_record_identifier(body_as_json))
+            self._reject(ch, message, transient=True)
         finally:
             self.event_processing_completed = True
 
-    def _init_event_callback_ok(self, callback_type, ch, method):
+    def _init_event_callback_ok(self, ch, message):
         self.event_processing_completed = False
-        self.log.debug("Received {0} message from Metax RabbitMQ".format(callback_type))
+        self.log.debug("Received {0} message from Metax RabbitMQ".format(message.callback_type))
 
         if not self.es_client.ensure_index_existence():
-            ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+            self._reject(ch, message, transient=True)
             self.event_processing_completed = True
             return False
 
         return True
 
-    def _get_event_json_body(self, ch, method, body):
-        body_as_json = self._get_message_body_as_json(body)
+    def _get_event_json_body(self, ch, message):
+        body_as_json = self._get_message_body_as_json(message.body)
         if not body_as_json:
-            ch.basic_nack(delivery_tag=method.delivery_tag, requeue=False)
+            self._reject(ch, message, transient=False)
             self.event_processing_completed = True
             return None
         return body_as_json
 
+    def _reject(self, ch, message, transient):
+        """
+        Take a message that could not be processed off its queue. A message that failed due to a transient error is
+        published to the retry queue of its next retry round, from where it returns to its queue when the delay has
+        passed. Other messages and those out of retries are published to the dead-letter queue of their queue.
+        Without retry and dead-letter queues the message is nacked without requeueing, which drops it.
+
+        :param ch: Channel the message was received from
+        :param message: ReceivedMessage
+        :param transient: Whether the failure was caused by an error that may go away by itself
+        """
+        if transient and self.journal is not None and self._journal_message(ch, message):
+            metrics.CONSUMER_REJECTED_MESSAGES.labels(message.callback_type, 'journal').inc()
+            return
+
+        queue = self._get_queue_name(message.callback_type)
+        headers = dict((message.properties.headers if message.properties else None) or {})
+        retry_count = headers.get(RETRY_COUNT_HEADER, 0)
+
+        if transient and retry_count < len(self.retry_delays_ms):
+            target_queue = get_retry_queue_name(queue, self.retry_delays_ms[retry_count])
+            headers[RETRY_COUNT_HEADER] = retry_count + 1
+            destination = 'retry'
+        elif self.dead_letter_queues:
+            target_queue = get_dead_letter_queue_name(queue)
+            destination = 'dead_letter'
+        else:
+            metrics.CONSUMER_REJECTED_MESSAGES.labels(message.callback_type, 'dropped').inc()
+            ch.basic_nack(delivery_tag=message.delivery_tag, requeue=False)
+            return
+
+        self.log.info("Moving message with delivery tag {0} to {1}".format(message.delivery_tag, target_queue))
+        if self._publish_message(ch, target_queue, message, headers):
+            metrics.CONSUMER_REJECTED_MESSAGES.labels(message.callback_type, destination).inc()
+            ch.basic_ack(delivery_tag=message.delivery_tag)
+        else:
+            self.log.error("Unable to move message to {0}, requeueing it".format(target_queue))
+            ch.basic_nack(delivery_tag=message.delivery_tag, requeue=True)
+
+    def _publish_message(self, ch, queue, message, headers):
+        try:
+            ch.basic_publish('', queue, message.body, pika.BasicProperties(
+                content_type=message.properties.content_type if message.properties else None,
+                delivery_mode=2,
+                headers=headers))
+        except Exception as e:
+            self.log.error(e)
+            return False
+        return True
+
+    def _on_message_while_journaling(self, callback_type, callback, ch, method, properties, body):
+        if self.journal.is_empty():
+            callback(ch, method, properties, body)
+            return
+
+        message = ReceivedMessage(callback_type, method.delivery_tag, properties, body)
+        if not self._journal_message(ch, message):
+            self._reject(ch, message, transient=True)
+
+    def _journal_message(self, ch, message):
+        """
+        Append a message to the event journal and ack it
+
+        :return: True if the message was journaled
+        """
+        body_as_json = self._get_message_body_as_json(message.body)
+        identifier = get_catalog_record_identifier(body_as_json) if body_as_json else None
+        try:
+            self.journal.append(message.callback_type, identifier, message.body)
+        except OSError as e:
+            self.log.error(e)
+            self.log.error("Unable to append message with delivery tag {0} to the event journal".format(
+                message.delivery_tag))
+            return False
+
+        ch.basic_ack(delivery_tag=message.delivery_tag)
+        self._schedule_journal_replay()
+        return True
+
+    def _schedule_journal_replay(self, delay=None):
+        if self.journal_replay_timer is None:
+            self.journal_replay_timer = self.connection.call_later(
+                self.journal_replay_interval if delay is None else delay, self._replay_journal)
+
+    def _replay_journal(self):
+        """
+        Write the events of the oldest event journal segment into the index with bulk requests and remove the
+        segment. Events for the same catalog record within the segment are collapsed into one write. One segment
+        is replayed at a time, so that the connection gets to send heartbeats and acks in between.
+        """
+        self.journal_replay_timer = None
+        segments = self.journal.sealed_segments()
+        if not segments:
+            return
+
+        if self.state in (PAUSING, PAUSED):
+            self._schedule_journal_replay()
+            return
+
+        if not self.es_client.ensure_index_existence():
+            self.log.info("Elasticsearch not available, replaying the event journal later")
+            self._schedule_journal_replay()
+            return
+
+        segment = segments[0]
+        events = [ReceivedMessage(entry.routing_key, delivery_tag, None, entry.body)
+                  for delivery_tag, entry in enumerate(self.journal.read_segment(segment), start=1)]
+        failed_tags = self._process_batch(events, coalesce=True) if events else {}
+        if any(failed_tags.values()):
+            self.log.error("Failed to replay event journal segment {0}, trying again later".format(segment))
+            self._schedule_journal_replay()
+            return
+
+        # The messages have been acked already, so events that cannot be processed are dead-lettered from here
+        for event in events:
+            if event.delivery_tag in failed_tags:
+                if not self.dead_letter_queues or not self._publish_message(
+                        self.channel, get_dead_letter_queue_name(self._get_queue_name(event.callback_type)), event, {}):
+                    self.log.error("Dropping journaled {0} event that cannot be processed".format(event.callback_type))
+
+        self.journal.remove_segment(segment)
+        self.log.info("Replayed {0} events from event journal segment {1}".format(len(events), segment))
+        if not self.journal.is_empty():
+            self._schedule_journal_replay(0)
+
     def _get_message_body_as_json(self, body):
         try:
             return json.loads(body)
@@ -332,16 +1336,18 @@ class MetaxConsumer():
         return None
 
     def _cancel_consumers(self):
-        self.channel.basic_cancel(consumer_tag=self.create_consumer_tag)
-        self.channel.basic_cancel(consumer_tag=self.update_consumer_tag)
-        self.channel.basic_cancel(consumer_tag=self.delete_consumer_tag)
+        for consumer_tag in (self.create_consumer_tag, self.update_consumer_tag, self.delete_consumer_tag):
+            if consumer_tag is not None:
+                self.channel.basic_cancel(consumer_tag=consumer_tag)
+        self.create_consumer_tag = self.update_consumer_tag = self.delete_consumer_tag = None
+
+    def _get_queue_name(self, callback_type):
+        return {'create': self.create_queue, 'update': self.update_queue, 'delete': self.delete_queue}[callback_type]
 
     def _set_queue_names(self, is_local_dev):
-        self.create_queue = 'etsin-create'
-        self.update_queue = 'etsin-update'
-        self.delete_queue = 'etsin-delete'
+        queues = get_queue_names(is_local_dev)
 
-        if is_local_dev:
+        if queues is None:
             # The point of this section is to give unique names to the queues created in local dev env
             # This is done to prevent the target rabbitmq server from having multiple consumers consuming the same
             # queue (this would result in round-robin type of delivering of messages).
@@ -349,28 +1355,15 @@ class MetaxConsumer():
             # Below, also a time-to-live for a local dev queue is set to automatically delete the queues from the
             # target rabbitmq server after a set period of time so as not to make the rabbitmq virtual host to be
             # filled with local dev queues. Cf. http://www.rabbitmq.com/ttl.html#queue-ttl
+            timestamp = str(time())
+            queues = dict((callback_type, queue + '-' + timestamp) for callback_type, queue in QUEUE_NAMES.items())
 
-            import json
-            if os.path.isfile('/home/etsin-user/rabbitmq_queues.json'):
-                with open('/home/etsin-user/rabbitmq_queues.json') as json_data:
-                    queues = json.load(json_data)
-                    self.create_queue = queues.get('create', None)
-                    self.update_queue = queues.get('update', None)
-                    self.delete_queue = queues.get('delete', None)
-            else:
-                import time
-                timestamp = str(time.time())
-
-                self.create_queue += '-' + timestamp
-                self.update_queue += '-' + timestamp
-                self.delete_queue += '-' + timestamp
-
-                queues = {'create': self.create_queue,
-                          'update': self.update_queue,
-                          'delete': self.delete_queue}
+            with open(LOCAL_DEV_QUEUES_FILE, 'w') as outfile:
+                json.dump(queues, outfile)
 
-                with open('/home/etsin-user/rabbitmq_queues.json', 'w') as outfile:
-                    json.dump(queues, outfile)
+        self.create_queue = queues['create']
+        self.update_queue = queues['update']
+        self.delete_queue = queues['delete']
 
     def _create_and_bind_queues(self, is_local_dev):
         args = {}
@@ -385,3 +1378,15 @@ class MetaxConsumer():
         self.channel.queue_bind(exchange=self.exchange, queue=self.create_queue, routing_key='create')
         self.channel.queue_bind(exchange=self.exchange, queue=self.update_queue, routing_key='update')
         self.channel.queue_bind(exchange=self.exchange, queue=self.delete_queue, routing_key='delete')
+
+        for queue in (self.create_queue, self.update_queue, self.delete_queue):
+            # Expired messages of a retry queue are routed back to the queue through the default exchange
+            for delay_ms in self.retry_delays_ms:
+                retry_args = dict(args, **{
+                    'x-message-ttl': delay_ms,
+                    'x-dead-letter-exchange': '',
+                    'x-dead-letter-routing-key': queue})
+                self.channel.queue_declare(get_retry_queue_name(queue, delay_ms), durable=True, arguments=retry_args)
+
+            if self.dead_letter_queues:
+                self.channel.queue_declare(get_dead_letter_queue_name(queue), durable=True, arguments=args)
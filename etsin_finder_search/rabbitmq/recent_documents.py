@@ -0,0 +1,67 @@
+# This file is part of the Etsin service
+#
+# Copyright 2017-2021 Ministry of Education and Culture, Finland
+#
+# :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# :license: MIT
+
+import threading
+from collections import OrderedDict
+
+
+class RecentDocuments:
+    """
+    Bounded LRU cache of doc id to the digest of the document last written into the index by the consumer, see
+    partial_updates.get_fingerprint_digest. Metax sends update events also when none of the indexed fields changed,
+    and comparing the digest of the converted document with the cached one lets the consumer leave those writes out.
+
+    Entries are added when a write is decided and forgotten if the write fails or the document is deleted. The cache
+    is only valid while the consumer is the only one writing into the index, so it is cleared when the consumer is
+    resumed after reindexing. Thread safe, the worker threads share one cache.
+    """
+
+    DEFAULT_MAX_SIZE = 10000
+
+    def __init__(self, max_size=DEFAULT_MAX_SIZE):
+        self.max_size = max_size
+        self._digests = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, doc_id):
+        """
+        :return: Digest of the document last written with doc_id, or None if not cached
+        """
+        with self._lock:
+            digest = self._digests.get(doc_id)
+            if digest is None:
+                self.misses += 1
+                return None
+            self._digests.move_to_end(doc_id)
+            self.hits += 1
+            return digest
+
+    def put(self, doc_id, digest):
+        with self._lock:
+            self._digests[doc_id] = digest
+            self._digests.move_to_end(doc_id)
+            if len(self._digests) > self.max_size:
+                self._digests.popitem(last=False)
+                self.evictions += 1
+
+    def forget(self, doc_id):
+        with self._lock:
+            self._digests.pop(doc_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._digests.clear()
+
+    def __len__(self):
+        return len(self._digests)
+
+    def report(self):
+        return "Recently indexed documents: {0} cached, {1} hits, {2} misses, {3} evicted".format(
+            len(self), self.hits, self.misses, self.evictions)
@@ -0,0 +1,98 @@
+# This file is part of the Etsin service
+#
+# Copyright 2017-2021 Ministry of Education and Culture, Finland
+#
+# :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# :license: MIT
+
+import queue
+import threading
+import zlib
+
+from etsin_finder_search.reindexing_log import get_logger
+
+log = get_logger(__name__)
+
+_STOP = object()
+
+
+class WorkerPool:
+    """
+    Fixed amount of worker threads, each with its own FIFO queue. Items are assigned to a worker by a stable hash of
+    their key, so items with the same key are always handled by the same worker in the order they were submitted.
+    """
+
+    def __init__(self, amount, handler, name='worker'):
+        self.handler = handler
+        self.queues = [queue.Queue() for _ in range(amount)]
+        self._pending = 0
+        self._pending_lock = threading.Lock()
+        self.threads = [threading.Thread(target=self._run, args=(i,), name='{0}-{1}'.format(name, i), daemon=True)
+                        for i in range(amount)]
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, key, item):
+        with self._pending_lock:
+            self._pending += 1
+        self.queues[self.worker_index(key)].put(item)
+
+    def worker_index(self, key):
+        # Built-in hash() of str is salted per process, crc32 stays the same across restarts
+        return zlib.crc32(str(key).encode('utf-8')) % len(self.queues)
+
+    def stop(self):
+        """
+        Discard the items still waiting in the queues and tell the workers to exit after their current item
+
+        :return: Discarded items
+        """
+        discarded = self.discard()
+        for worker_queue in self.queues:
+            worker_queue.put(_STOP)
+        return discarded
+
+    def discard(self):
+        """
+        Discard the items still waiting in the queues, the workers keep running
+
+        :return: Discarded items
+        """
+        discarded = []
+        for worker_queue in self.queues:
+            while True:
+                try:
+                    discarded.append(worker_queue.get_nowait())
+                except queue.Empty:
+                    break
+
+        with self._pending_lock:
+            self._pending -= len(discarded)
+        return discarded
+
+    def idle(self):
+        """
+        :return: True when no submitted item is waiting or being handled
+        """
+        with self._pending_lock:
+            return self._pending == 0
+
+    def stopped(self):
+        return not any(thread.is_alive() for thread in self.threads)
+
+    def _run(self, index):
+        worker_queue = self.queues[index]
+        while True:
+            item = worker_queue.get()
+            if item is _STOP:
+                return
+
+            try:
+                self.handler(item)
+            except Exception as e:
+                log.exception(e)
+            finally:
+                with self._pending_lock:
+                    self._pending -= 1
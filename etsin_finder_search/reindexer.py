@@ -5,24 +5,30 @@
 # :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
 # :license: MIT
 
+import asyncio
 import os
+import time
+from functools import partial
 
+from etsin_finder_search import metrics
 from etsin_finder_search.elastic.domain.es_dataset_data_model import ESDatasetModel
+from etsin_finder_search.elastic.service.async_es_service import AsyncElasticSearchService
 from etsin_finder_search.elastic.service.es_service import ElasticSearchService
 from etsin_finder_search.metax.metax_api import MetaxAPIService
 from etsin_finder_search.catalog_record_converter import CRConverter
+from etsin_finder_search.catalog_record_mapping import ReferenceInterner
+from etsin_finder_search.document_budget import DocumentBudget
+from etsin_finder_search.indexing_policy import DELETE, INDEX, IndexingPolicy
+from etsin_finder_search.partial_updates import PartialUpdates
+from etsin_finder_search.rabbitmq.consumer_control import get_consumer_status, pause_consumer, resume_consumer
 from etsin_finder_search.reindexing_log import get_logger
 from etsin_finder_search.utils import \
     get_metax_api_config, \
     get_elasticsearch_config, \
+    get_metax_rabbit_mq_config, \
     start_rabbitmq_consumer, \
     stop_rabbitmq_consumer, \
-    rabbitmq_consumer_is_running, \
-    catalog_record_is_deprecated, \
-    catalog_has_preservation_dataset_origin_version, \
-    catalog_record_should_be_indexed, \
-    catalog_record_is_pas_catalog, \
-    get_catalog_preservation_state
+    rabbitmq_consumer_is_running
 
 
 log = get_logger(__name__)
@@ -49,7 +55,12 @@ def reindex_all_by_emptying_index():
 
 
 def _start_rabbitmq_service_if_not_running():
-    if not rabbitmq_consumer_is_running():
+    control_socket = _get_consumer_control_socket()
+    running = control_socket and get_consumer_status(control_socket) is not None
+    if not running:
+        running = rabbitmq_consumer_is_running()
+
+    if not running:
         log.info("Starting RabbitMQ consumer..")
         if start_rabbitmq_consumer():
             log.info("Started")
@@ -57,13 +68,61 @@ def _start_rabbitmq_service_if_not_running():
             log.error("Unable to start RabbitMQ consumer service")
 
 
-def create_search_index_and_doc_type_mapping_if_not_exist():
+def _get_consumer_control_socket():
+    return (get_metax_rabbit_mq_config() or {}).get('CONTROL_SOCKET')
+
+
+def _pause_rabbitmq_consumer():
+    """
+    Pause the RabbitMQ consumer through its control socket, so that messages wait in the queues meanwhile. Without
+    a control socket, or when no consumer is listening at it, the consumer service is stopped instead, if running
+    outside Docker.
+
+    :return: True if the consumer was paused and should be resumed afterwards
+    """
+    control_socket = _get_consumer_control_socket()
+    if control_socket:
+        log.info("Trying to pause RabbitMQ consumer for the length of reindexing operation..")
+        status = pause_consumer(control_socket)
+        if status is not None:
+            if status.get('state') == 'paused':
+                log.info("RabbitMQ consumer paused")
+            else:
+                log.error("Unable to pause RabbitMQ consumer, its status is {0}, but continuing with reindexing "
+                          "operation..".format(status))
+            return True
+        log.info("No RabbitMQ consumer listening at control socket {0}".format(control_socket))
+
+    if not os.path.isfile("/.dockerenv"):
+        if rabbitmq_consumer_is_running():
+            log.info("Trying to stop RabbitMQ consumer service for the length of reindexing operation..")
+            if stop_rabbitmq_consumer():
+                log.info("RabbitMQ consumer service stopped")
+            else:
+                log.error("Unable to stop RabbitMQ consumer service, but continuing with reindexing operation..")
+    return False
+
+
+def _resume_rabbitmq_consumer():
+    status = resume_consumer(_get_consumer_control_socket())
+    if status and status.get('state') == 'consuming':
+        log.info("RabbitMQ consumer resumed")
+    else:
+        log.error("Unable to resume RabbitMQ consumer, its status is {0}".format(status))
+
+
+def create_search_index_and_doc_type_mapping_if_not_exist(expected_doc_count=None, avg_doc_bytes=None):
+    """
+    :param expected_doc_count: Amount of documents going to be indexed, or None
+    :param avg_doc_bytes: Average document size in bytes, or a function estimating it, called only if the index is
+        created with a shard count computed from the corpus size
+    """
     es_client = ElasticSearchService.get_elasticsearch_service(es_config)
     if es_client is None:
         log.error("Unable to initialize Elasticsearch client")
         return False
 
-    if not es_client.ensure_index_existence():
+    if not es_client.ensure_index_existence(expected_doc_count, avg_doc_bytes):
         return False
 
     return True
@@ -107,7 +166,17 @@ def load_test_data_into_es(dataset_amt):
     return False
 
 
-def convert_identifiers_to_es_data_models(metax_api, identifiers_to_convert, identifiers_to_delete, metax_crs_dict=None):
+def _fetch_catalog_records(metax_api, identifiers):
+    """
+    :return: Generator of the catalog records of identifiers fetched one by one from Metax API, None for the ones
+        that could not be fetched
+    """
+    for identifier in identifiers:
+        yield metax_api.get_catalog_record(identifier)
+
+
+def convert_identifiers_to_es_data_models(metax_api, identifiers_to_convert, identifiers_to_delete, metax_crs_dict=None,
+                                          stored_fingerprints=None, policy=None, decisions=None):
     """
     Takes in Metax catalog record identifiers, fetches their json from Metax, converts them to an ESDatasetModel
     object and adds to es_data_models list. Also checks if the dataset has been deprecated in which case also add it to
@@ -115,50 +184,75 @@ def convert_identifiers_to_es_data_models(metax_api, identifiers_to_convert, ide
 
     :param identifiers_to_convert: Metax identifiers to fetch from Metax potentially to be reindexed
     :param identifiers_to_delete: list of Metax identifiers that will be sent to es bulk request
+    :param stored_fingerprints: Dict of doc id to the field fingerprints in the index, for sending partial updates
+        of the documents with small changes, see PartialUpdates
+    :param policy: IndexingPolicy to classify and count the records with
+    :param decisions: Dict of identifier to the Decision already made by policy for the records of metax_crs_dict
     :return: List of ESDatasetModel objects
     """
 
     es_dataset_models = []
-    converter = CRConverter()
+    # The documents of the batch share the converted reference data objects, e.g. licenses and file types
+    converter = CRConverter.from_config(es_config, ReferenceInterner(), policy)
+    document_budget = DocumentBudget.from_config(es_config)
+    partial_updates = PartialUpdates.from_config(es_config)
     log.info("Trying to convert {0} Metax catalog records to Elasticsearch documents. "
              "If catalog record is deprecated, try to delete it from index.".format(len(identifiers_to_convert)))
 
-    for identifier in identifiers_to_convert:
-        if metax_crs_dict:
-            metax_cr_json = metax_crs_dict.get(identifier, None)
-        else:
-            metax_cr_json = metax_api.get_catalog_record(identifier)
-            if not catalog_record_should_be_indexed(metax_cr_json):
-                continue
-
-        if metax_cr_json:
-            # 1. If catalog record has been deprecated, delete its identifier from index
-            # 2. If catalog_has_preservation_dataset_origin_version is found, it means the dataset is stored in PAS and has an original version.
-            #    This original version will be displayed in the dataset list instead, so this PAS dataset version identifier should be excluded.
-            if ((catalog_record_is_deprecated(metax_cr_json)) or (catalog_has_preservation_dataset_origin_version(metax_cr_json))):
-                identifiers_to_delete.append(identifier)
-                continue
-
-            if (catalog_record_is_pas_catalog(metax_cr_json) and get_catalog_preservation_state(metax_cr_json) != 120):
-                identifiers_to_delete.append(identifier)
-                continue
-
-            es_dataset_json = converter.convert_metax_cr_json_to_es_data_model(metax_cr_json)
-            if es_dataset_json:
-                # The below 3 lines is in case you want to print the metax cr json and es dataset json to a file
-                # from etsin_finder_search.utils import append_json_to_file
-                # append_json_to_file(metax_cr_json, 'data.txt')
-                # append_json_to_file(es_dataset_json, 'data.txt')
-
-                es_dataset_models.append(ESDatasetModel(es_dataset_json))
-            else:
-                log.error("Something went wrong when converting {0} to es data model".format(identifier))
-                continue
+    record_decisions = None
+    if metax_crs_dict:
+        metax_cr_jsons = (metax_crs_dict.get(identifier, None) for identifier in identifiers_to_convert)
+        if decisions:
+            record_decisions = (decisions.get(identifier) or converter.policy.classify(None)
+                                for identifier in identifiers_to_convert)
+    else:
+        metax_cr_jsons = _fetch_catalog_records(metax_api, identifiers_to_convert)
+
+    for identifier, action, _, es_dataset_json in converter.convert_many(metax_cr_jsons, record_decisions):
+        if action == DELETE:
+            identifiers_to_delete.append(identifier)
+        elif action == INDEX:
+            separate_request = document_budget.apply(es_dataset_json)
+            es_dataset_models.append(ESDatasetModel(es_dataset_json, separate_request))
+    partial_updates.prepare(es_dataset_models, stored_fingerprints or {})
 
     log.info("Converted finally {0} Metax catalog records to Elasticsearch documents".format(len(es_dataset_models)))
+    log.info(converter.interner.report())
+    log.info(converter.policy.report())
+    if document_budget.oversized_documents:
+        log.warning(document_budget.report())
+    if partial_updates.enabled:
+        log.info(partial_updates.report())
     return es_dataset_models
 
 
+async def _do_async_bulk_request_for_datasets(es_data_models, ids_to_delete):
+    """
+    Send the bulk requests with several requests in flight at once, see MAX_IN_FLIGHT_REQUESTS in es config
+    """
+    async with AsyncElasticSearchService(es_config) as async_es_client:
+        if not await async_es_client.do_bulk_request_for_datasets(es_data_models, ids_to_delete):
+            log.error("One or more bulk requests failed")
+        log.info("Elasticsearch bulk transfer report:\n{0}".format(async_es_client.transfer_stats.report()))
+
+
+def estimate_average_es_document_size(metax_crs_dict, sample_size=200):
+    """
+    Convert a sample of the catalog records to estimate the average Elasticsearch document size, used for sizing
+    the shards of a new index
+
+    :return: Average document size in bytes, or None if nothing could be converted
+    """
+    converter = CRConverter.from_config(es_config)
+    sizes = []
+    for metax_cr_json in list(metax_crs_dict.values())[:sample_size]:
+        es_dataset_json = converter.convert_metax_cr_json_to_es_data_model(metax_cr_json)
+        if es_dataset_json:
+            sizes.append(len(ESDatasetModel(es_dataset_json).to_es_document_string().encode('utf-8')))
+
+    return sum(sizes) / len(sizes) if sizes else None
+
+
 class ReindexScheduledTask:
 
     def __init__(self):
@@ -166,6 +260,8 @@ class ReindexScheduledTask:
         self.es_client = ElasticSearchService.get_elasticsearch_service(es_config)
 
     def run_task(self, delete_index_first):
+        start = time.perf_counter()
+
         # 1a. Check elasticsearch client ok
         if self.es_client is None:
             log.error("Unable to create Elasticsearch client")
@@ -175,15 +271,15 @@ class ReindexScheduledTask:
             log.error("Unable to create Metax API client")
             return
 
-        # 1b. Stop RabbitMQ consumer if running outside Docker
-        if not os.path.isfile("/.dockerenv"):
-            if rabbitmq_consumer_is_running():
-                log.info("Trying to stop RabbitMQ consumer service for the length of reindexing operation..")
-                if stop_rabbitmq_consumer():
-                    log.info("RabbitMQ consumer service stopped")
-                else:
-                    log.error("Unable to stop RabbitMQ consumer service, but continuing with reindexing operation..")
+        # 1b. Pause the RabbitMQ consumer for the length of the reindexing operation
+        consumer_paused = _pause_rabbitmq_consumer()
+        try:
+            self._reindex(delete_index_first, start)
+        finally:
+            if consumer_paused:
+                _resume_rabbitmq_consumer()
 
+    def _reindex(self, delete_index_first, start):
         # 2a. Get all latest catalog records from Metax
         log.info("Trying to bulk fetch the latest catalog records from Metax..")
         metax_crs = self.metax_api.get_latest_catalog_records()
@@ -193,11 +289,15 @@ class ReindexScheduledTask:
         log.info("Done")
 
         # 2b. Decide whether catalog record is to be indexed, and for those to be indexed, change catalog record array
-        # to dictionary with catalog record identifier as the key
+        # to dictionary with catalog record identifier as the key. Records to be deleted or skipped are left out, so
+        # they are deleted from the index below if they are there.
+        policy = IndexingPolicy()
         metax_crs_dict = {}
-        for cr_json in metax_crs:
-            if catalog_record_should_be_indexed(cr_json):
-                metax_crs_dict[cr_json['identifier']] = cr_json
+        decisions = {}
+        for cr_json, decision in policy.classify_many(metax_crs):
+            if decision.action == INDEX and decision.identifier:
+                metax_crs_dict[decision.identifier] = cr_json
+                decisions[decision.identifier] = decision
 
         # 3. Create a list containing all catalog record identifiers
         metax_identifiers = list(metax_crs_dict.keys())
@@ -209,12 +309,19 @@ class ReindexScheduledTask:
                 log.error("Unable to delete search index. Aborting reindexing operation")
                 return
 
-        if not create_search_index_and_doc_type_mapping_if_not_exist():
+        if not create_search_index_and_doc_type_mapping_if_not_exist(
+                len(metax_crs_dict), partial(estimate_average_es_document_size, metax_crs_dict)):
             log.error("Unable to create search index and/or mapping. Aborting reindexing operation")
             return
 
-        # 5. Get all document identifiers (equivalent to Metax catalog record identifiers) from search index
-        es_identifiers = self.es_client.get_all_doc_ids_from_index() or []
+        # 5. Get all document identifiers (equivalent to Metax catalog record identifiers) from search index, with
+        # their field fingerprints when partial updates are enabled
+        stored_fingerprints = {}
+        if es_config.get('PARTIAL_UPDATES', False) and not delete_index_first:
+            stored_fingerprints = self.es_client.get_all_field_fingerprints_from_index() or {}
+            es_identifiers = list(stored_fingerprints)
+        else:
+            es_identifiers = self.es_client.get_all_doc_ids_from_index() or []
 
         # 6.
         # If metax_id in Metax and in es index -> index
@@ -236,9 +343,19 @@ class ReindexScheduledTask:
 
         # 7. Convert catalog records to es documents and for those records add their previous version ids to delete list
         es_data_models = convert_identifiers_to_es_data_models(self.metax_api, ids_to_index, ids_to_delete,
-                                                               metax_crs_dict)
+                                                               metax_crs_dict, stored_fingerprints, policy, decisions)
 
         # 8. Run bulk requests to search index
         # a. Create or update documents that are either new or already exist in search index
         # b. Delete documents from index no longer in metax
-        self.es_client.do_bulk_request_for_datasets(es_data_models, ids_to_delete)
+        if es_config.get('ASYNC_BULK', False):
+            asyncio.run(_do_async_bulk_request_for_datasets(es_data_models, ids_to_delete))
+        else:
+            self.es_client.do_bulk_request_for_datasets(es_data_models, ids_to_delete)
+
+        log.info("Elasticsearch transfer report:\n{0}".format(self.es_client.transfer_stats.report()))
+
+        metrics.REINDEX_DATASETS.labels('index').set(len(es_data_models))
+        metrics.REINDEX_DATASETS.labels('delete').set(len(ids_to_delete))
+        metrics.REINDEX_SECONDS.set(time.perf_counter() - start)
+        metrics.REINDEX_LAST_SUCCESS.set_to_current_time()
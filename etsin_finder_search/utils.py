@@ -52,6 +52,14 @@ def get_metax_rabbit_mq_config():
     return metax_rabbitmq_conf
 
 
+def get_metrics_config():
+    metrics_conf = get_config_from_file().get('METRICS', False)
+    if not metrics_conf or not isinstance(metrics_conf, dict):
+        return None
+
+    return metrics_conf
+
+
 def append_json_to_file(json_data, filename):
     with open(filename, "a") as output_file:
         json.dump(json_data, output_file, indent=4, sort_keys=True)
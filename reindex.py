@@ -7,6 +7,7 @@
 
 import sys
 
+from etsin_finder_search.metrics import start_metrics_server_if_configured
 from etsin_finder_search.reindexer import reindex_all_without_emptying_index
 from etsin_finder_search.reindexer import reindex_all_by_emptying_index
 from etsin_finder_search.reindexing_log import get_logger
@@ -35,6 +36,8 @@ def main():
         log.error(instructions)
         sys.exit(1)
 
+    start_metrics_server_if_configured('REINDEXER_PORT')
+
     if run_args[RECREATE_INDEX] == NO:
         reindex_all_without_emptying_index()
 
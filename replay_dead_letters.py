@@ -0,0 +1,46 @@
+# This file is part of the Etsin service
+#
+# Copyright 2017-2021 Ministry of Education and Culture, Finland
+#
+# :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# :license: MIT
+
+import sys
+
+from etsin_finder_search.rabbitmq.dead_letter_replay import replay_all_dead_letters
+from etsin_finder_search.rabbitmq.rabbitmq_client import QUEUE_NAMES
+from etsin_finder_search.reindexing_log import get_logger
+
+log = get_logger(__name__)
+
+QUEUE = 'queue'
+LIMIT = 'limit'
+ALL = 'all'
+
+
+def main():
+
+    instructions = """\nRun the program as etsin-user with pyenv activated using 'python replay_dead_letters.py queue=X [limit=N]'
+    where X = create, update, delete or all and N is the maximum number of messages to replay per queue"""
+
+    run_args = dict([arg.split('=', maxsplit=1) for arg in sys.argv[1:]])
+
+    if run_args.get(QUEUE) not in list(QUEUE_NAMES) + [ALL] or not run_args.get(LIMIT, '0').isdigit():
+        print(instructions)
+        log.error(instructions)
+        sys.exit(1)
+
+    callback_types = None if run_args[QUEUE] == ALL else [run_args[QUEUE]]
+    limit = int(run_args[LIMIT]) if LIMIT in run_args else None
+
+    replayed = replay_all_dead_letters(callback_types, limit)
+    if replayed is None:
+        sys.exit(1)
+
+    for queue, amount in replayed.items():
+        print("{0}: {1} messages replayed".format(queue, amount))
+
+
+if __name__ == '__main__':
+    # calling main function
+    main()
@@ -9,22 +9,28 @@
 
 import signal
 import sys
-import time
 
+from etsin_finder_search.metrics import start_metrics_server_if_configured
+from etsin_finder_search.rabbitmq.async_consumer import AsyncMetaxConsumer
+from etsin_finder_search.rabbitmq.consumer_control import start_control_server_if_configured
 from etsin_finder_search.rabbitmq.rabbitmq_client import MetaxConsumer
 from etsin_finder_search.reindexing_log import get_logger
+from etsin_finder_search.utils import get_metax_rabbit_mq_config
 
 
 log = get_logger(__name__)
 log.info("Initializing RabbitMQ consumer..")
-consumer = MetaxConsumer()
+if (get_metax_rabbit_mq_config() or {}).get('ASYNC_CONSUMER', False):
+    consumer = AsyncMetaxConsumer()
+else:
+    consumer = MetaxConsumer()
 
 
 def signal_term_handler(signal, frame):
     """
     Handler for the sigterm event occurring when the running of this code is being terminated by systemd.
     First cancel consumers in order not to receive any more messages. After that for 10 seconds
-    wait for the current reindexing operation to finish. After that exit the program anyway.
+    wait for the current reindexing operation of every worker to finish. After that exit the program anyway.
 
     :param signal:
     :param frame:
@@ -32,22 +38,29 @@ def signal_term_handler(signal, frame):
     """
 
     consumer.before_stop()
-    reindexing_ongoing = not consumer.event_processing_completed
+    reindexing_ongoing = not consumer.processing_completed()
     i = 0
     while reindexing_ongoing and i < 5:
         log.info("Waiting for reindexing operation to finish before exiting RabbitMQ consumer..")
-        time.sleep(1)
-        reindexing_ongoing = not consumer.event_processing_completed
+        consumer.wait_for_processing(1)
+        reindexing_ongoing = not consumer.processing_completed()
         i += 1
 
+    # Send the acks of the last finished operations
+    consumer.wait_for_processing(0)
     log.info("Exiting RabbitMQ consumer")
     sys.exit(0)
 
 
 # If consumer initialized ok (i.e. finished the __init__ without returning), start consuming
 if consumer.init_ok:
+    start_metrics_server_if_configured('CONSUMER_PORT')
+    start_control_server_if_configured(consumer)
     signal.signal(signal.SIGTERM, signal_term_handler)
     consumer.run()
+    if consumer.stop_requested:
+        log.info("Exiting RabbitMQ consumer")
+        sys.exit(0)
     log.error("Unable to consume, exiting service")
     sys.exit(1)
 else:
@@ -0,0 +1,181 @@
+# This file is part of the Etsin service
+#
+# Copyright 2017-2021 Ministry of Education and Culture, Finland
+#
+# :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# :license: MIT
+
+import gzip
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+
+class StubElasticsearch:
+    """
+    Minimal in-memory stand-in for the Elasticsearch REST endpoints used by the search index services:
+    index create/exists/delete, mapping, document index/update/delete, _mget, _bulk and scroll search.
+    """
+
+    def __init__(self):
+        self.indices = {}
+        self.requests = []
+        self.fail_bulk = False
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self._make_handler())
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self):
+        return 'http://127.0.0.1:{0}'.format(self.server.server_address[1])
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def requests_for(self, method, path_prefix=''):
+        return [r for r in self.requests if r['method'] == method and r['path'].startswith(path_prefix)]
+
+    def handle(self, method, path, query, headers, body):
+        parts = [unquote(p) for p in path.strip('/').split('/') if p]
+        with self.lock:
+            self.requests.append({'method': method, 'path': path, 'query': query, 'headers': headers,
+                                  'body': body})
+
+            if not parts:
+                return 200, {'name': 'stub', 'version': {'number': '5.6.0'}}
+            if parts[0] == '_bulk':
+                return self._bulk(body)
+            if parts[0] == '_search' and parts[1:] == ['scroll']:
+                if method == 'DELETE':
+                    return 200, {'succeeded': True}
+                return 200, {'_scroll_id': None, 'hits': {'hits': []}}
+
+            index = parts[0]
+            if len(parts) == 1:
+                if method == 'HEAD':
+                    return (200 if index in self.indices else 404), None
+                if method == 'PUT':
+                    if index in self.indices:
+                        return 400, {'error': 'index_already_exists_exception', 'status': 400}
+                    self.indices[index] = {}
+                    return 200, {'acknowledged': True}
+                if method == 'DELETE':
+                    if self.indices.pop(index, None) is None:
+                        return 404, {'error': 'index_not_found_exception', 'status': 404}
+                    return 200, {'acknowledged': True}
+
+            docs = self.indices.get(index)
+            if docs is None:
+                return 404, {'error': 'index_not_found_exception', 'status': 404}
+            if parts[1] == '_mapping':
+                return 200, {'acknowledged': True}
+            if parts[1] == '_search':
+                hits = [{'_id': doc_id} for doc_id in docs]
+                return 200, {'_scroll_id': 'stub-scroll', 'hits': {'hits': hits}}
+            if parts[1] == '_stats':
+                return 200, {'indices': {index: {'total': {'store': {'size_in_bytes': 0}}}}}
+
+            doc_id = parts[2]
+            if doc_id == '_mget':
+                return 200, {'docs': [self._get(docs, mget_id, parse_qs(query).get('_source_include'))
+                                      for mget_id in json.loads(body)['ids']]}
+            if parts[3:] == ['_update'] and method == 'POST':
+                if doc_id not in docs:
+                    return 404, {'error': 'document_missing_exception', 'status': 404}
+                docs[doc_id] = _merge(docs[doc_id], json.loads(body)['doc'])
+                return 200, {'_id': doc_id, 'result': 'updated'}
+            if method == 'PUT':
+                created = doc_id not in docs
+                docs[doc_id] = json.loads(body)
+                return (201 if created else 200), {'_id': doc_id, 'result': 'created' if created else 'updated'}
+            if method == 'DELETE':
+                if docs.pop(doc_id, None) is None:
+                    return 404, {'_id': doc_id, 'found': False, 'result': 'not_found'}
+                return 200, {'_id': doc_id, 'found': True, 'result': 'deleted'}
+            if method == 'HEAD':
+                return (200 if doc_id in docs else 404), None
+
+        return 400, {'error': 'unsupported stub request', 'status': 400}
+
+    @staticmethod
+    def _get(docs, doc_id, source_include):
+        if doc_id not in docs:
+            return {'_id': doc_id, 'found': False}
+        source = docs[doc_id]
+        if source_include:
+            source = dict((field, value) for field, value in source.items() if field in source_include)
+        return {'_id': doc_id, 'found': True, '_source': source}
+
+    def _bulk(self, body):
+        lines = [line for line in body.split('\n') if line]
+        items = []
+        i = 0
+        while i < len(lines):
+            action = json.loads(lines[i])
+            op, meta = next(iter(action.items()))
+            docs = self.indices.setdefault(meta['_index'], {})
+            if op in ('index', 'update'):
+                source = json.loads(lines[i + 1])
+                if op == 'update':
+                    docs[meta['_id']] = _merge(docs.get(meta['_id'], {}), source.get('doc', {}))
+                else:
+                    docs[meta['_id']] = source
+                i += 2
+            else:
+                docs.pop(meta['_id'], None)
+                i += 1
+
+            status = 500 if self.fail_bulk else 200
+            item = {'_id': meta['_id'], 'status': status}
+            if self.fail_bulk:
+                item['error'] = {'type': 'stub_failure'}
+            items.append({op: item})
+
+        return 200, {'errors': self.fail_bulk, 'items': items}
+
+    def _make_handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def _serve(self):
+                url = urlparse(self.path)
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                if body and self.headers.get('Content-Encoding') == 'gzip':
+                    body = gzip.decompress(body)
+                body = body.decode('utf-8')
+                status, payload = stub.handle(self.command, url.path, url.query, dict(self.headers), body)
+                data = json.dumps(payload).encode('utf-8') if payload is not None else b''
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                if self.command != 'HEAD':
+                    self.wfile.write(data)
+
+            do_GET = do_POST = do_PUT = do_DELETE = do_HEAD = _serve
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def _merge(document, partial_doc):
+    """
+    Merge a partial doc into a document as Elasticsearch does, objects recursively and other values replaced
+    """
+    merged = dict(document)
+    for field, value in partial_doc.items():
+        if isinstance(value, dict) and isinstance(merged.get(field), dict):
+            merged[field] = _merge(merged[field], value)
+        else:
+            merged[field] = value
+    return merged
@@ -7,8 +7,16 @@
 
 import json
 import os
+import time
 
 
 def get_test_object_from_file(filename):
     json_data = open('{0}/test_objects/{1}'.format(os.path.dirname(os.path.realpath(__file__)), filename)).read()
     return json.loads(json_data)
+
+
+def wait_until(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
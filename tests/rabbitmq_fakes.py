@@ -0,0 +1,204 @@
+# This file is part of the Etsin service
+#
+# Copyright 2017-2021 Ministry of Education and Culture, Finland
+#
+# :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# :license: MIT
+
+import json
+import os
+from types import SimpleNamespace
+from unittest import mock
+
+from etsin_finder_search.elastic.service.es_service import ElasticSearchService
+from etsin_finder_search.partial_updates import FINGERPRINT_FIELD
+from etsin_finder_search.rabbitmq import rabbitmq_client
+from etsin_finder_search.rabbitmq.rabbitmq_client import MetaxConsumer
+
+
+class FakeChannel:
+
+    def __init__(self):
+        self.acks = []
+        self.nacks = []
+        self.qos = None
+        # Queue name to its declare arguments and to the (properties, body) tuples published into it
+        self.declared = {}
+        self.queues = {}
+        self.consumers = {}
+        self._next_get_tag = 1000
+
+    def queue_declare(self, queue, passive=False, durable=False, arguments=None):
+        if not passive:
+            self.declared[queue] = arguments
+        message_count = len(self.queues.get(queue, []))
+        return SimpleNamespace(method=SimpleNamespace(queue=queue, message_count=message_count))
+
+    def queue_bind(self, queue, exchange, routing_key=None):
+        pass
+
+    def basic_publish(self, exchange, routing_key, body, properties=None, mandatory=False):
+        self.queues.setdefault(routing_key, []).append((properties, body))
+
+    def basic_get(self, queue, auto_ack=False):
+        if not self.queues.get(queue):
+            return None, None, None
+        properties, body = self.queues[queue].pop(0)
+        self._next_get_tag += 1
+        return SimpleNamespace(delivery_tag=self._next_get_tag), properties, body
+
+    def basic_consume(self, queue, on_message_callback, auto_ack=False):
+        consumer_tag = 'ctag-{0}-{1}'.format(queue, len(self.consumers))
+        self.consumers[consumer_tag] = queue
+        return consumer_tag
+
+    def basic_cancel(self, consumer_tag):
+        del self.consumers[consumer_tag]
+        return []
+
+    def basic_ack(self, delivery_tag=0, multiple=False):
+        self.acks.append((delivery_tag, multiple))
+
+    def basic_nack(self, delivery_tag=0, multiple=False, requeue=True):
+        self.nacks.append((delivery_tag, requeue))
+
+    def basic_qos(self, prefetch_size=0, prefetch_count=0, global_qos=False):
+        self.qos = prefetch_count
+
+    def confirm_delivery(self):
+        pass
+
+
+class FakeConnection:
+
+    def __init__(self):
+        self.is_open = True
+        self.timers = {}
+        self._next_timer = 0
+        self.threadsafe_callbacks = []
+
+    def channel(self):
+        return FakeChannel()
+
+    def close(self):
+        self.is_open = False
+
+    def add_callback_threadsafe(self, callback):
+        self.threadsafe_callbacks.append(callback)
+
+    def process_data_events(self, time_limit=0):
+        while self.threadsafe_callbacks:
+            self.threadsafe_callbacks.pop(0)()
+
+    def call_later(self, delay, callback):
+        self._next_timer += 1
+        self.timers[self._next_timer] = (delay, callback)
+        return self._next_timer
+
+    def remove_timeout(self, timeout_id):
+        self.timers.pop(timeout_id, None)
+
+    def fire_timers(self):
+        for timer_id in list(self.timers):
+            if timer_id in self.timers:
+                self.timers.pop(timer_id)[1]()
+
+
+class FakeESClient:
+    """
+    Records the Elasticsearch operations done by the consumer. Operations on doc ids listed in failing_ids fail,
+    and setting available to False makes the index unavailable.
+    """
+
+    def __init__(self, failing_ids=()):
+        self.failing_ids = set(failing_ids)
+        self.available = True
+        self.bulk_requests = []
+        self.indexed = []
+        self.deleted = []
+        # Doc id to the indexed document, partial updates merged into it
+        self.documents = {}
+
+    def ensure_index_existence(self, *args):
+        return self.available
+
+    def do_bulk_request_for_actions(self, actions):
+        self.bulk_requests.append(actions)
+        return [self._apply(action, payload) for action, payload in actions]
+
+    def reindex_dataset(self, dataset_data_model):
+        return self._apply('index', dataset_data_model)
+
+    def delete_dataset_from_index(self, doc_id):
+        return self._apply('delete', doc_id)
+
+    def _apply(self, action, payload):
+        doc_id = payload.get_es_document_id() if action == 'index' else payload
+        if doc_id in self.failing_ids:
+            return False
+        (self.indexed if action == 'index' else self.deleted).append(doc_id)
+        if action == 'index':
+            document = self.documents.get(doc_id, {}) if payload.partial else {}
+            self.documents[doc_id] = _merge(document, payload.doc_obj)
+        else:
+            self.documents.pop(doc_id, None)
+        return True
+
+    def get_field_fingerprints(self, doc_ids):
+        return dict((doc_id, self.documents[doc_id].get(FINGERPRINT_FIELD)) for doc_id in doc_ids
+                    if doc_id in self.documents)
+
+
+def _merge(document, partial_doc):
+    """
+    Merge a partial doc into a document as Elasticsearch does, objects recursively and other values replaced
+    """
+    merged = dict(document)
+    for field, value in partial_doc.items():
+        if isinstance(value, dict) and isinstance(merged.get(field), dict):
+            merged[field] = _merge(merged[field], value)
+        else:
+            merged[field] = value
+    return merged
+
+
+class FakeMetaxAPI:
+    """
+    Serves catalog records from a dict of identifier to record, identifiers missing from it are removed from Metax
+    """
+
+    def __init__(self, records):
+        self.records = records
+        self.requested = []
+
+    def get_catalog_records(self, cr_identifiers):
+        self.requested.append(list(cr_identifiers))
+        found = dict((cr_id, self.records[cr_id]) for cr_id in cr_identifiers if cr_id in self.records)
+        return found, set(cr_identifiers) - set(found)
+
+
+def make_consumer(es_client=None, consumer_class=MetaxConsumer, **rabbit_settings):
+    """
+    Consumer built with the given METAX_RABBITMQ settings, connected to a fake RabbitMQ connection and writing into a
+    fake Elasticsearch client, with its consumers set up
+    """
+    rabbit_settings = dict({'HOSTS': ['localhost'], 'PORT': 5672, 'VHOST': 'metax', 'EXCHANGE': 'datasets',
+                            'USER': 'user', 'PASSWORD': 'pw', 'RETRY_DELAYS_MS': [], 'DEAD_LETTER_QUEUES': False},
+                           **rabbit_settings)
+    es_client = es_client or FakeESClient()
+    isfile = os.path.isfile
+    with mock.patch.object(ElasticSearchService, 'get_elasticsearch_service', return_value=es_client), \
+            mock.patch.object(rabbitmq_client.pika, 'BlockingConnection', lambda parameters: FakeConnection()), \
+            mock.patch.object(rabbitmq_client, 'get_metax_api_config', return_value=None), \
+            mock.patch('os.path.isfile', lambda path: path != '/.dockerenv' and isfile(path)):
+        consumer = consumer_class(rabbit_settings, {'HOSTS': ['localhost']})
+        assert consumer.init_ok and consumer._setup_connection() and consumer._setup_consumers()
+    return consumer
+
+
+def method(delivery_tag, routing_key='update'):
+    return SimpleNamespace(delivery_tag=delivery_tag, routing_key=routing_key)
+
+
+def message_body(cr_json, **changes):
+    return json.dumps(dict(cr_json, **changes)).encode('utf-8')
@@ -0,0 +1,134 @@
+# This file is part of the Etsin service
+#
+# Copyright 2017-2021 Ministry of Education and Culture, Finland
+#
+# :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# :license: MIT
+
+import asyncio
+import json
+from unittest import mock
+
+import pytest
+
+from etsin_finder_search.elastic.service.async_es_service import AsyncElasticSearchService
+from etsin_finder_search.indexing_policy import INDEX, INDEXED
+from etsin_finder_search.partial_updates import FINGERPRINT_FIELD, PartialUpdates
+from etsin_finder_search.rabbitmq.async_consumer import AsyncMetaxConsumer
+from .es_stub_server import StubElasticsearch
+from .helpers import get_test_object_from_file
+from .rabbitmq_fakes import make_consumer, message_body, method
+
+
+@pytest.fixture
+def cr():
+    return get_test_object_from_file('metax_catalog_record.json')
+
+
+@pytest.fixture
+def stub_es():
+    stub = StubElasticsearch().start()
+    stub.indices['metax'] = {}
+    yield stub
+    stub.stop()
+
+
+def consume(stub_es, messages, concurrency=4, partial_updates=False, **rabbit_settings):
+    consumer = make_consumer(None, AsyncMetaxConsumer, CONCURRENCY=concurrency, **rabbit_settings)
+    consumer.concurrency = concurrency
+    consumer.partial_updates = PartialUpdates(partial_updates)
+
+    async def run():
+        consumer.loop = asyncio.get_running_loop()
+        consumer._init_processing_state()
+        es_settings = {'PARTIAL_UPDATES': partial_updates}
+        async with AsyncElasticSearchService(es_settings, base_urls=[stub_es.base_url],
+                                             field_fingerprints=consumer.recent_documents is not None) as es_client:
+            consumer.es_client = es_client
+            for delivery_tag, (callback_type, body) in enumerate(messages, start=1):
+                consumer._on_message(callback_type, consumer.channel, method(delivery_tag), None, body)
+            await asyncio.wait(consumer.tasks)
+
+    asyncio.run(run())
+    return consumer
+
+
+class TestAsyncMetaxConsumer:
+    def test_messages_are_indexed_and_acked(self, stub_es, cr):
+        consumer = consume(stub_es, [
+            ('create', message_body(cr, identifier='cr1')),
+            ('update', message_body(cr, identifier='cr2')),
+            ('delete', message_body(cr, identifier='cr3')),
+            ('update', b'not json'),
+        ])
+
+        assert sorted(stub_es.indices['metax']) == ['cr1', 'cr2']
+        assert sorted(consumer.channel.acks) == [(1, False), (2, False), (3, False)]
+        assert consumer.channel.nacks == [(4, False)]
+        assert consumer.processing_completed()
+        # Converted in the thread pool with converters of their own, sharing the indexing policy
+        assert len(consumer.converter.interner) == 0
+        assert consumer.converter.policy.counts[(INDEX, INDEXED)] == 2
+
+    def test_events_of_one_record_are_applied_in_order(self, stub_es, cr):
+        consumer = consume(stub_es, [
+            ('update', message_body(cr, identifier='cr1')),
+            ('delete', message_body(cr, identifier='cr1')),
+            ('update', message_body(cr, identifier='cr2')),
+        ])
+
+        assert stub_es.indices['metax'] == {'cr2': stub_es.indices['metax']['cr2']}
+        methods = [(r['method'], r['path']) for r in stub_es.requests
+                   if r['path'] == '/metax/dataset/cr1']
+        assert methods == [('PUT', '/metax/dataset/cr1'), ('DELETE', '/metax/dataset/cr1')]
+        assert len(consumer.channel.acks) == 3
+
+    def test_partial_updates_are_sent_for_indexed_documents(self, stub_es, cr):
+        consumer = consume(stub_es, [
+            ('update', message_body(cr, identifier='cr1')),
+            ('update', message_body(cr, identifier='cr1', preservation_state=10)),
+        ], partial_updates=True)
+
+        assert sorted(consumer.channel.acks) == [(1, False), (2, False)]
+        assert [(r['method'], r['path']) for r in stub_es.requests if r['method'] in ('PUT', 'POST')] == [
+            ('PUT', '/metax/_mapping/dataset'),
+            ('POST', '/metax/dataset/_mget'),
+            ('PUT', '/metax/dataset/cr1'),
+            ('POST', '/metax/dataset/_mget'),
+            ('POST', '/metax/dataset/cr1/_update'),
+        ]
+        assert json.loads(stub_es.requests_for('PUT', '/metax/_mapping')[0]['body']) == \
+            {'properties': {FINGERPRINT_FIELD: {'type': 'object', 'enabled': False}}}
+        assert stub_es.indices['metax']['cr1']['preservation_state'] == 10
+        assert consumer.partial_updates.bytes_saved > 0
+
+    def test_unchanged_documents_are_acked_without_writing(self, stub_es, cr):
+        consumer = consume(stub_es, [
+            ('update', message_body(cr, identifier='cr1')),
+            ('update', message_body(cr, identifier='cr1')),
+            ('update', message_body(cr, identifier='cr1', preservation_state=10)),
+        ], SKIP_UNCHANGED_DOCUMENTS=True)
+
+        assert sorted(consumer.channel.acks) == [(1, False), (2, False), (3, False)]
+        assert consumer.channel.nacks == []
+        assert [r['path'] for r in stub_es.requests_for('PUT')] == \
+            ['/metax/_mapping/dataset', '/metax/dataset/cr1', '/metax/dataset/cr1']
+        assert stub_es.indices['metax']['cr1']['preservation_state'] == 10
+        assert (consumer.recent_documents.hits, consumer.recent_documents.misses) == (2, 1)
+
+    @pytest.mark.parametrize('connection', [None, mock.Mock(is_closing=True, is_closed=False),
+                                            mock.Mock(is_closing=False, is_closed=True)])
+    def test_stopping_during_reconnect(self, connection):
+        consumer = make_consumer(None, AsyncMetaxConsumer)
+        consumer.channel = mock.Mock(is_open=False)
+        consumer.connection = connection
+
+        async def stop():
+            consumer._init_processing_state()
+            await consumer._stop()
+
+        asyncio.run(stop())
+        assert consumer.stop_requested
+        assert not consumer.channel.basic_cancel.called
+        if connection is not None:
+            assert not connection.close.called
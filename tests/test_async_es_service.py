@@ -0,0 +1,80 @@
+# This file is part of the Etsin service
+#
+# Copyright 2017-2021 Ministry of Education and Culture, Finland
+#
+# :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# :license: MIT
+
+import asyncio
+
+import pytest
+
+from etsin_finder_search.elastic.domain.es_dataset_data_model import ESDatasetModel
+from etsin_finder_search.elastic.service.async_es_service import AsyncElasticSearchService
+from .es_stub_server import StubElasticsearch
+
+
+@pytest.fixture
+def stub_es():
+    stub = StubElasticsearch().start()
+    yield stub
+    stub.stop()
+
+
+def run_with_client(stub_es, coro_func, **settings):
+    async def run():
+        async with AsyncElasticSearchService(settings, base_urls=[stub_es.base_url]) as es_client:
+            return await coro_func(es_client)
+    return asyncio.run(run())
+
+
+def models(amount):
+    return [ESDatasetModel({'identifier': 'cr{0}'.format(i), 'title': {'en': 'Dataset {0}'.format(i)}})
+            for i in range(amount)]
+
+
+class TestAsyncElasticSearchService:
+    def test_ensure_index_existence_creates_index_and_mapping(self, stub_es):
+        assert run_with_client(stub_es, lambda es: es.ensure_index_existence())
+        assert 'metax' in stub_es.indices
+        assert len(stub_es.requests_for('PUT', '/metax/_mapping/dataset')) == 1
+
+        # Second call only checks existence
+        assert run_with_client(stub_es, lambda es: es.ensure_index_existence())
+        assert len(stub_es.requests_for('PUT', '/metax')) == 2
+
+    def test_reindex_and_delete_dataset(self, stub_es):
+        stub_es.indices['metax'] = {}
+        model = ESDatasetModel({'identifier': 'urn:nbn:fi:att:1', 'title': {'en': 'Title'}})
+
+        assert run_with_client(stub_es, lambda es: es.reindex_dataset(model))
+        assert stub_es.indices['metax']['urn:nbn:fi:att:1'] == model.doc_obj
+
+        assert run_with_client(stub_es, lambda es: es.delete_dataset_from_index('urn:nbn:fi:att:1'))
+        assert stub_es.indices['metax'] == {}
+
+    def test_deleting_missing_document_is_ok(self, stub_es):
+        stub_es.indices['metax'] = {}
+        assert run_with_client(stub_es, lambda es: es.delete_dataset_from_index('missing'))
+
+    def test_bulk_request_is_split_and_sent_concurrently(self, stub_es):
+        stub_es.indices['metax'] = {'old1': {}, 'old2': {}}
+        to_index = models(AsyncElasticSearchService.BULK_OPERATION_ROW_SIZE * 2 + 1)
+
+        assert run_with_client(stub_es, lambda es: es.do_bulk_request_for_datasets(to_index, ['old1', 'old2']),
+                               MAX_IN_FLIGHT_REQUESTS=4)
+        assert len(stub_es.requests_for('POST', '/_bulk')) == 3
+        assert len(stub_es.indices['metax']) == len(to_index)
+        assert all(r['headers']['Content-Type'] == 'application/x-ndjson'
+                   for r in stub_es.requests_for('POST', '/_bulk'))
+
+    def test_failed_bulk_request_is_reported(self, stub_es):
+        stub_es.fail_bulk = True
+        assert not run_with_client(stub_es, lambda es: es.do_bulk_request_for_datasets(models(3), []))
+
+    def test_get_all_doc_ids_from_index(self, stub_es):
+        stub_es.indices['metax'] = {'cr1': {}, 'cr2': {}}
+        assert sorted(run_with_client(stub_es, lambda es: es.get_all_doc_ids_from_index())) == ['cr1', 'cr2']
+
+    def test_get_all_doc_ids_without_index(self, stub_es):
+        assert run_with_client(stub_es, lambda es: es.get_all_doc_ids_from_index()) is None
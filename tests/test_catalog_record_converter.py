@@ -5,7 +5,13 @@
 # :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
 # :license: MIT
 
+import copy
+
+import pytest
+
 from etsin_finder_search.catalog_record_converter import CRConverter
+from etsin_finder_search.catalog_record_mapping import FieldSpec, ReferenceInterner, compile_mapping
+from etsin_finder_search.indexing_policy import DELETE, INDEX, SKIP
 from .helpers import get_test_object_from_file
 
 
@@ -13,3 +19,219 @@ def test_get_es_person_or_org_common_data_from_metax_obj():
     converter = CRConverter()
     output = converter.convert_metax_cr_json_to_es_data_model(get_test_object_from_file('metax_catalog_record.json'))
     assert output == get_test_object_from_file('es_document.json')
+
+
+def _record_variants():
+    cr = get_test_object_from_file('metax_catalog_record.json')
+    rd = cr['research_dataset']
+    org = {'@type': 'Organization', 'name': {'und': 'Org'}, 'identifier': 'org',
+           'is_part_of': {'@type': 'Organization', 'name': {'sv': 'Parent'}}}
+    person = {'@type': 'Person', 'name': 'Person', 'member_of': org}
+
+    def variant(**changes):
+        record = copy.deepcopy(cr)
+        record['research_dataset'].update(changes.pop('research_dataset', {}))
+        record.update(changes)
+        return record
+
+    return [
+        variant(),
+        variant(date_modified=None, preservation_state=0, data_catalog={'identifier': 'dc'}),
+        variant(research_dataset={'theme': {'identifier': 't', 'pref_label': {'en': 'Theme'}, 'definition': 'd'},
+                                  'field_of_science': [{'identifier': 'f'}], 'infrastructure': [{'identifier': 'i'}],
+                                  'other_identifier': [{'notation': 'n', 'type': {'identifier': 'ty'}}, {}]}),
+        variant(research_dataset={'access_rights': dict(
+            rd['access_rights'], license={'identifier': 'l'}, access_type=[{'identifier': 'a'}])}),
+        variant(research_dataset={'files': [{'file_type': {'identifier': 'text'}}, {}],
+                                  'remote_resources': [{'file_type': {'identifier': 'video', 'pref_label': {}}}]}),
+        variant(research_dataset={'creator': person, 'publisher': org, 'curator': [person, {'name': 'x'}],
+                                  'contributor': [{'@type': 'Robot', 'name': 'r'}, org], 'rights_holder': []}),
+        variant(research_dataset={'is_output_of': [
+            {'name': {'fi': 'Projekti'}, 'has_funding_agency': [org], 'source_organization': [person]},
+            {'name': {'sv': 'Projekt'}}]}),
+        variant(research_dataset={'title': {}, 'keyword': [], 'description': None, 'access_rights': {}}),
+        variant(research_dataset={'preferred_identifier': None}),
+    ]
+
+
+def _expected_documents_of_record_variants():
+    """
+    :return: Expected documents of _record_variants. They are stored as the fields that differ from es_document.json
+        and the fields missing from it.
+    """
+    expected_documents = []
+    for difference in get_test_object_from_file('es_documents_of_record_variants.json'):
+        document = get_test_object_from_file('es_document.json')
+        document.update(difference['changed'])
+        for field in difference['removed']:
+            del document[field]
+        expected_documents.append(document)
+    return expected_documents
+
+
+@pytest.mark.parametrize('record, expected', list(zip(_record_variants(), _expected_documents_of_record_variants())))
+def test_documents_of_record_variants(record, expected):
+    assert CRConverter().convert_metax_cr_json_to_es_data_model(record) == expected
+
+
+def test_unknown_transform_kind_is_rejected():
+    with pytest.raises(ValueError):
+        compile_mapping([FieldSpec('title', ('title',), 'uppercase')])
+
+
+class TestNameDeduplication:
+
+    def test_repeated_names_are_listed_once_in_order(self):
+        output = CRConverter(deduplicate_names=True).convert_metax_cr_json_to_es_data_model(
+            get_test_object_from_file('metax_catalog_record.json'))
+        expected = get_test_object_from_file('es_document.json')
+        pairs = list(dict.fromkeys(zip(expected['organization_name_fi'], expected['organization_name_en'])))
+
+        assert list(zip(output['organization_name_fi'], output['organization_name_en'])) == pairs
+        assert len(output['organization_name_fi']) < len(expected['organization_name_fi'])
+        for field in expected:
+            if not field.startswith('organization_name'):
+                assert output[field] == expected[field]
+
+    def test_names_repeated_in_one_language_only_are_kept(self):
+        record = get_test_object_from_file('metax_catalog_record.json')
+        record['research_dataset']['is_output_of'] = [{'name': {'fi': 'Projekti', 'en': 'Project A'}},
+                                                      {'name': {'fi': 'Projekti', 'en': 'Project B'}},
+                                                      {'name': {'fi': 'Projekti', 'en': 'Project A'}}]
+        output = CRConverter.from_config({'DEDUPLICATE_NAMES': True}).convert_metax_cr_json_to_es_data_model(record)
+
+        assert output['project_name_fi'] == ['Projekti', 'Projekti']
+        assert output['project_name_en'] == ['Project A', 'Project B']
+        assert len(output['is_output_of']) == 3
+
+
+class TestFileTypes:
+
+    @staticmethod
+    def _record_with_files():
+        record = get_test_object_from_file('metax_catalog_record.json')
+        text = {'identifier': 'text', 'pref_label': {'en': 'Text'}}
+        video = {'identifier': 'video', 'pref_label': {'en': 'Video'}}
+        record['research_dataset']['files'] = [{'file_type': copy.deepcopy(text)} for _ in range(1000)] + \
+            [{'file_type': copy.deepcopy(video)}, {}, {'file_type': 'text'}]
+        record['research_dataset']['remote_resources'] = [{'file_type': copy.deepcopy(text)}]
+        return record
+
+    def test_file_types_are_listed_once_in_order(self):
+        output = CRConverter().convert_metax_cr_json_to_es_data_model(self._record_with_files())
+        assert output['file_type'] == [{'identifier': 'text', 'pref_label': {'en': 'Text'}},
+                                       {'identifier': 'video', 'pref_label': {'en': 'Video'}},
+                                       {}]
+
+    def test_files_of_each_file_type_are_counted(self):
+        converter = CRConverter.from_config({'FILE_TYPE_COUNTS': True}, ReferenceInterner())
+        first = converter.convert_metax_cr_json_to_es_data_model(self._record_with_files())
+        record = self._record_with_files()
+        del record['research_dataset']['remote_resources']
+        second = converter.convert_metax_cr_json_to_es_data_model(record)
+
+        assert [file_type['file_count'] for file_type in first['file_type']] == [1001, 1, 1]
+        assert [file_type['file_count'] for file_type in second['file_type']] == [1000, 1, 1]
+
+
+class TestConvertMany:
+
+    def test_records_are_indexed_deleted_or_skipped(self):
+        cr = get_test_object_from_file('metax_catalog_record.json')
+
+        def record(identifier, **changes):
+            copied = copy.deepcopy(cr)
+            copied['identifier'] = identifier
+            copied.update(changes)
+            return copied
+
+        records = [
+            record('indexed'),
+            record('deprecated', deprecated=True),
+            record('pas', data_catalog={'identifier': 'urn:nbn:fi:att:data-catalog-pas'}, preservation_state=80),
+            record('legacy', data_catalog={'identifier': 'urn:nbn:fi:att:data-catalog-legacy'}),
+            record('draft', state='draft'),
+            record('no preferred identifier', research_dataset={'title': {'en': 'Title'}}),
+            None,
+        ]
+        converter = CRConverter()
+        results = list(converter.convert_many(iter(records)))
+
+        assert [(result.identifier, result.action, result.reason) for result in results] == [
+            ('indexed', INDEX, 'indexed'), ('deprecated', DELETE, 'deprecated'), ('pas', DELETE, 'pas_not_preserved'),
+            ('legacy', SKIP, 'legacy_catalog'), ('draft', SKIP, 'not_published'),
+            ('no preferred identifier', SKIP, 'conversion_failed'), (None, SKIP, 'no_record')]
+        assert results[0].document['identifier'] == 'indexed'
+        assert all(result.document is None for result in results[1:])
+        # The record that failed to convert was classified to be indexed and is counted once
+        assert converter.policy.counts[(INDEX, 'indexed')] == 2
+        assert converter.policy.counts[(SKIP, 'conversion_failed')] == 0
+        assert converter.policy.conversion_failures == 1
+
+    def test_records_failing_conversion_are_counted_once_with_decisions(self):
+        cr = get_test_object_from_file('metax_catalog_record.json')
+        records = [cr, dict(cr, identifier='no preferred identifier', research_dataset={'title': {'en': 'Title'}})]
+        converter = CRConverter()
+        decisions = [decision for _, decision in converter.policy.classify_many(records)]
+        results = list(converter.convert_many(records, decisions))
+
+        assert [result.action for result in results] == [INDEX, SKIP]
+        assert converter.policy.counts == {(INDEX, 'indexed'): 2}
+        assert converter.policy.conversion_failures == 1
+        assert converter.policy.report() == \
+            "Indexing decisions: 2 index (indexed). 1 of the records to index could not be converted"
+
+    def test_records_share_the_interner(self):
+        converter = CRConverter(ReferenceInterner())
+        cr = get_test_object_from_file('metax_catalog_record.json')
+        documents = [result.document for result in converter.convert_many(copy.deepcopy(cr) for _ in range(3))]
+
+        assert documents[0]['file_type'][0] is documents[2]['file_type'][0]
+        assert converter.interner.hits > 0
+
+
+class TestReferenceInterner:
+
+    def test_interned_documents_match_the_expected_documents(self):
+        converter = CRConverter(ReferenceInterner())
+        for record, expected in list(zip(_record_variants(), _expected_documents_of_record_variants())) * 2:
+            assert converter.convert_metax_cr_json_to_es_data_model(copy.deepcopy(record)) == expected
+        assert converter.interner.hits > 0
+
+    def test_documents_share_equal_reference_data(self):
+        interner = ReferenceInterner()
+        converter = CRConverter(interner)
+        cr = get_test_object_from_file('metax_catalog_record.json')
+        first = converter.convert_metax_cr_json_to_es_data_model(copy.deepcopy(cr))
+        second = converter.convert_metax_cr_json_to_es_data_model(copy.deepcopy(cr))
+
+        assert first == second
+        assert first['file_type'][0] is second['file_type'][0]
+        assert first['access_rights']['access_type'] is second['access_rights']['access_type']
+        assert interner.hit_rate() > 0.4
+        assert interner.bytes_saved > 0
+
+    def test_changed_reference_data_is_not_reused(self):
+        interner = ReferenceInterner()
+        old = interner.reference({'identifier': 'cc-by', 'pref_label': {'en': 'CC BY'}}, 'pref_label')
+        new = interner.reference({'identifier': 'cc-by', 'pref_label': {'en': 'CC BY 4.0'}}, 'pref_label')
+        described = interner.reference({'identifier': 'cc-by', 'pref_label': {'en': 'CC BY 4.0'}, 'description': 'd'},
+                                       'pref_label')
+
+        assert old['pref_label'] == {'en': 'CC BY'}
+        assert new['pref_label'] == {'en': 'CC BY 4.0'}
+        assert described['description'] == 'd'
+        assert interner.hits == 0
+
+    def test_least_recently_used_objects_are_evicted(self):
+        interner = ReferenceInterner(max_size=2)
+        a = interner.reference({'identifier': 'a'}, 'pref_label')
+        interner.reference({'identifier': 'b'}, 'pref_label')
+        assert interner.reference({'identifier': 'a'}, 'pref_label') is a
+        interner.reference({'identifier': 'c'}, 'pref_label')
+
+        assert len(interner) == 2
+        assert interner.evictions == 1
+        assert interner.reference({'identifier': 'a'}, 'pref_label') is a
+        assert interner.reference({'identifier': 'b'}, 'pref_label') is not None
+        assert interner.hits == 2
@@ -0,0 +1,103 @@
+# This file is part of the Etsin service
+#
+# Copyright 2017-2021 Ministry of Education and Culture, Finland
+#
+# :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# :license: MIT
+
+import pytest
+
+from etsin_finder_search.rabbitmq.consumer_control import ConsumerControlServer, get_consumer_status, send_command
+from etsin_finder_search.rabbitmq.rabbitmq_client import CONSUMING, PAUSED, PAUSING, STARTING
+from .helpers import get_test_object_from_file
+from .rabbitmq_fakes import FakeConnection, make_consumer, message_body, method
+
+
+@pytest.fixture
+def cr():
+    return get_test_object_from_file('metax_catalog_record.json')
+
+
+@pytest.fixture
+def controlled_consumer(tmp_path):
+    consumer = make_consumer(BATCH_SIZE=10)
+    path = str(tmp_path / 'consumer.sock')
+    server = ConsumerControlServer(path, consumer)
+    server.start()
+    yield consumer, path
+    server.close()
+
+
+class TestConsumerControl:
+    def test_pause_processes_received_messages_and_leaves_the_rest_queued(self, controlled_consumer, cr):
+        consumer, path = controlled_consumer
+        consumer._on_batched_message('update', consumer.channel, method(1), None, message_body(cr, identifier='cr1'))
+
+        # Channel operations happen on the connection thread
+        assert send_command(path, 'pause')['state'] == CONSUMING
+        consumer.connection.process_data_events()
+
+        status = get_consumer_status(path)
+        assert status['state'] == PAUSED
+        assert not status['processing']
+        assert consumer.channel.consumers == {}
+        assert consumer.es_client.indexed == ['cr1']
+        assert consumer.channel.acks == [(1, True)]
+
+        send_command(path, 'resume')
+        consumer.connection.process_data_events()
+        assert get_consumer_status(path)['state'] == CONSUMING
+        assert sorted(consumer.channel.consumers.values()) == ['etsin-create', 'etsin-delete', 'etsin-update']
+
+    def test_pausing_waits_for_processing_to_complete(self, controlled_consumer):
+        consumer, path = controlled_consumer
+        consumer.event_processing_completed = False
+        consumer.request_pause()
+        consumer.connection.process_data_events()
+        assert consumer.state == PAUSING
+
+        consumer.event_processing_completed = True
+        consumer.connection.fire_timers()
+        assert consumer.state == PAUSED
+
+    def test_consumer_stays_paused_over_reconnect(self, controlled_consumer):
+        consumer, path = controlled_consumer
+        consumer.state = PAUSED
+        consumer._cancel_consumers()
+        consumer._start_consumers_unless_paused()
+        assert consumer.channel.consumers == {}
+        assert consumer.state == PAUSED
+
+    @pytest.mark.parametrize('lost_connection', ['closed', 'missing'])
+    def test_pause_while_reconnecting_is_kept_on_the_new_connection(self, controlled_consumer, lost_connection):
+        consumer, path = controlled_consumer
+        if lost_connection == 'closed':
+            consumer.connection.close()
+        else:
+            consumer.connection = None
+
+        status = send_command(path, 'pause')
+        assert status['state'] == PAUSED and not status['connected']
+
+        consumer.connection = FakeConnection()
+        consumer.channel = consumer.connection.channel()
+        consumer._start_consumers_unless_paused()
+        assert consumer.channel.consumers == {}
+        assert get_consumer_status(path)['state'] == PAUSED
+
+    def test_resume_while_reconnecting_consumes_on_the_new_connection(self, controlled_consumer):
+        consumer, path = controlled_consumer
+        consumer.state = PAUSED
+        consumer.connection = None
+        assert send_command(path, 'resume')['state'] == STARTING
+
+        consumer.connection = FakeConnection()
+        consumer.channel = consumer.connection.channel()
+        consumer._start_consumers_unless_paused()
+        assert consumer.state == CONSUMING
+        assert len(consumer.channel.consumers) == 3
+
+    def test_unknown_command_and_missing_consumer(self, controlled_consumer, tmp_path):
+        consumer, path = controlled_consumer
+        assert 'error' in send_command(path, 'restart')
+        assert get_consumer_status(str(tmp_path / 'missing.sock')) is None
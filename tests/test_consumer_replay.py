@@ -0,0 +1,64 @@
+# This file is part of the Etsin service
+#
+# Copyright 2017-2021 Ministry of Education and Culture, Finland
+#
+# :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# :license: MIT
+
+import json
+
+import pytest
+
+from benchmarks.consumer_replay import BENCHMARK_INDEX_NAME, BenchmarkConsumer, replay_direct
+from .es_stub_server import StubElasticsearch
+from .helpers import get_test_object_from_file
+
+
+@pytest.fixture
+def stub_es():
+    stub = StubElasticsearch().start()
+    yield stub
+    stub.stop()
+
+
+def recording():
+    cr = get_test_object_from_file('metax_catalog_record.json')
+    records = []
+    for i in range(6):
+        routing_key = 'delete' if i == 5 else 'update'
+        body = dict(cr, identifier='cr{0}'.format(i % 5))
+        records.append({'timestamp': 1000 + i * 0.01, 'routing_key': routing_key, 'body': json.dumps(body)})
+    records.append({'timestamp': 1000.1, 'routing_key': 'create', 'body': 'not json'})
+    return records
+
+
+def replay(stub_es, **rabbit_settings):
+    host, port = stub_es.server.server_address
+    consumer = BenchmarkConsumer(
+        rabbit_settings=dict({'HOSTS': ['stand-in'], 'PORT': 0, 'VHOST': '/', 'EXCHANGE': 'metax', 'USER': '',
+                              'PASSWORD': '', 'RETRY_DELAYS_MS': []}, **rabbit_settings),
+        es_settings={'HOSTS': ['{0}:{1}'.format(host, port)], 'USE_SSL': False})
+    assert consumer.init_ok
+    return replay_direct(consumer, recording(), settle_timeout=5)
+
+
+class TestConsumerReplay:
+    def test_replay_reports_throughput_latency_and_es_requests(self, stub_es):
+        results = replay(stub_es)
+
+        assert results['messages'] == 7
+        assert results['unsettled'] == 0
+        assert results['outcomes'] == {'ack': 7}
+        assert results['published'] == {'etsin-create-dead-letter': 1}
+        assert results['latency_ms']['p50'] <= results['latency_ms']['p99']
+        assert sorted(stub_es.indices[BENCHMARK_INDEX_NAME]) == ['cr1', 'cr2', 'cr3', 'cr4']
+        assert results['es_requests']['PUT other'] == 5
+        assert results['es_requests']['DELETE other'] == 1
+
+    def test_batch_mode_is_driven_by_prefetch_and_timers(self, stub_es):
+        results = replay(stub_es, BATCH_SIZE=4, BATCH_MAX_WAIT_MS=20)
+
+        assert results['unsettled'] == 0
+        assert results['outcomes'] == {'ack': 7}
+        assert results['es_requests']['POST _bulk'] == 2
+        assert sorted(stub_es.indices[BENCHMARK_INDEX_NAME]) == ['cr1', 'cr2', 'cr3', 'cr4']
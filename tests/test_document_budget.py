@@ -0,0 +1,130 @@
+# This file is part of the Etsin service
+#
+# Copyright 2017-2021 Ministry of Education and Culture, Finland
+#
+# :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# :license: MIT
+
+import json
+import threading
+
+import pytest
+
+from etsin_finder_search.document_budget import DocumentBudget
+from etsin_finder_search.elastic.domain.es_dataset_data_model import ESDatasetModel
+from etsin_finder_search.elastic.service.es_service import ElasticSearchService
+
+
+def _document(description_length=100, keywords=3):
+    return {
+        'identifier': 'cr-1',
+        'preferred_identifier': 'urn:nbn:fi:att:1',
+        'title': {'en': 'Title'},
+        'description': {'en': 'd' * description_length, 'fi': 'ä' * description_length},
+        'keyword': ['keyword {0}'.format(i) for i in range(keywords)],
+    }
+
+
+def _size(document):
+    return len(ESDatasetModel(document).to_es_document_string())
+
+
+class TestDocumentBudget:
+
+    def test_documents_within_budget_are_unchanged(self):
+        document = _document()
+        assert not DocumentBudget(max_document_bytes=10000, max_field_bytes=2000).apply(document)
+        assert document == _document()
+
+    def test_oversized_fields_are_truncated(self):
+        document = _document(description_length=5000, keywords=500)
+        budget = DocumentBudget(max_field_bytes=1000)
+
+        assert not budget.apply(document)
+        assert len(json.dumps(document['description'])) <= 1000
+        assert document['description']['en'].startswith('ddd')
+        assert document['description']['fi'].startswith('äää')
+        assert len(json.dumps(document['keyword'])) <= 1000
+        assert document['keyword'][:2] == ['keyword 0', 'keyword 1']
+        assert document['title'] == {'en': 'Title'}
+
+    def test_oversized_fields_are_dropped(self):
+        document = _document(description_length=5000)
+        assert not DocumentBudget(max_field_bytes=1000, policy='drop').apply(document)
+        assert 'description' not in document
+        assert document['keyword'] == _document()['keyword']
+
+    def test_largest_fields_are_shrunk_to_fit_the_document_budget(self):
+        document = _document(description_length=2000, keywords=200)
+        assert not DocumentBudget(max_document_bytes=5000).apply(document)
+        assert _size(document) <= 5000
+        assert document['identifier'] == 'cr-1'
+        assert document['keyword'] == _document(keywords=200)['keyword']
+
+    def test_oversized_documents_can_be_sent_separately(self):
+        document = _document(description_length=5000)
+        assert DocumentBudget(max_document_bytes=5000, policy='separate').apply(document)
+        assert document == _document(description_length=5000)
+
+    def test_largest_documents_are_reported(self):
+        budget = DocumentBudget(max_field_bytes=1000, policy='separate', report_size=2)
+        for i, length in enumerate((1000, 3000, 2000, 100)):
+            document = _document(description_length=length)
+            document['identifier'] = 'cr-{0}'.format(i)
+            budget.apply(document)
+
+        assert budget.oversized_documents == 3
+        assert [identifier for _, identifier, _ in budget.largest()] == ['cr-1', 'cr-2']
+        assert budget.largest()[0][2][0][0] == 'description'
+        assert 'cr-1' in budget.report()
+
+    def test_budget_is_shared_by_worker_threads(self):
+        budget = DocumentBudget(max_field_bytes=1000, policy='separate', report_size=5)
+
+        def apply_budget(worker):
+            for i in range(200):
+                document = _document(description_length=1000 + i)
+                document['identifier'] = 'cr-{0}-{1}'.format(worker, i)
+                budget.apply(document)
+
+        workers = [threading.Thread(target=apply_budget, args=(worker,)) for worker in range(4)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+        assert budget.oversized_documents == 800
+        assert sorted(identifier.rsplit('-', 1)[1] for _, identifier, _ in budget.largest()) == ['198'] + ['199'] * 4
+
+    def test_unknown_policy_is_rejected(self):
+        with pytest.raises(ValueError):
+            DocumentBudget.from_config({'MAX_DOCUMENT_BYTES': 1000, 'OVERSIZED_DOCUMENT_POLICY': 'compress'})
+
+
+class FakeElasticsearch:
+
+    def __init__(self):
+        self.bulk_bodies = []
+        self.indexed = []
+
+    def bulk(self, body, request_timeout=None):
+        self.bulk_bodies.append(body)
+        actions = [row[2:row.index('"', 2)] for row in body.strip().split('\n')
+                   if row.startswith(('{"index"', '{"delete"'))]
+        return {'errors': False, 'items': [{action: {'status': 200}} for action in actions]}
+
+    def index(self, index, doc_type, id, body):
+        self.indexed.append(id)
+        return {'result': 'created'}
+
+
+def test_separate_documents_are_left_out_of_bulk_requests():
+    es_service = ElasticSearchService({'HOSTS': ['localhost']})
+    es_service.es = FakeElasticsearch()
+    actions = [('index', ESDatasetModel({'identifier': 'a'})),
+               ('index', ESDatasetModel({'identifier': 'b'}, separate_request=True)),
+               ('delete', 'c')]
+
+    assert es_service.do_bulk_request_for_actions(actions) == [True, True, True]
+    assert es_service.es.indexed == ['b']
+    assert '"b"' not in es_service.es.bulk_bodies[0]
@@ -0,0 +1,92 @@
+# This file is part of the Etsin service
+#
+# Copyright 2017-2021 Ministry of Education and Culture, Finland
+#
+# :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# :license: MIT
+
+import asyncio
+
+import pytest
+from elasticsearch import Elasticsearch
+
+from etsin_finder_search.elastic.domain.es_dataset_data_model import ESDatasetModel
+from etsin_finder_search.elastic.service.async_es_service import AsyncElasticSearchService
+from etsin_finder_search.elastic.service.es_connection import MeasuredHttpConnection, TransferStats
+from .es_stub_server import StubElasticsearch
+
+BULK_BODY = '{"index":{"_index":"metax","_type":"dataset","_id":"cr1"}}\n' + \
+            '{"identifier":"cr1","description":{"en":"' + 'repetitive text ' * 200 + '"}}\n'
+
+
+@pytest.fixture
+def stub_es():
+    stub = StubElasticsearch().start()
+    yield stub
+    stub.stop()
+
+
+def es_client_for(stub_es, **kwargs):
+    return Elasticsearch(['127.0.0.1:{0}'.format(stub_es.server.server_address[1])],
+                         connection_class=MeasuredHttpConnection, **kwargs)
+
+
+class TestMeasuredHttpConnection:
+    def test_compressed_bulk_request(self, stub_es):
+        stats = TransferStats()
+        es = es_client_for(stub_es, http_compress=True, transfer_stats=stats)
+
+        assert not es.bulk(body=BULK_BODY)['errors']
+        assert stub_es.indices['metax']['cr1']['identifier'] == 'cr1'
+
+        request = stub_es.requests_for('POST', '/_bulk')[0]
+        assert request['headers']['content-encoding'] == 'gzip'
+        bulk_stats = stats.stats[TransferStats.BULK]
+        assert bulk_stats['requests'] == 1
+        assert bulk_stats['body_bytes'] == len(BULK_BODY.encode('utf-8'))
+        assert bulk_stats['wire_bytes'] < bulk_stats['body_bytes'] / 5
+
+    def test_requests_without_body_are_not_marked_compressed(self, stub_es):
+        es = es_client_for(stub_es, http_compress=True)
+
+        es.info()
+        assert not es.indices.exists(index='metax')
+        es.bulk(body=BULK_BODY)
+        for request in stub_es.requests_for('GET') + stub_es.requests_for('HEAD'):
+            headers = dict((name.lower(), value) for name, value in request['headers'].items())
+            assert 'content-encoding' not in headers
+            assert 'gzip' in headers['accept-encoding']
+        assert stub_es.requests_for('POST', '/_bulk')[0]['headers']['content-encoding'] == 'gzip'
+
+    def test_uncompressed_request_is_measured(self, stub_es):
+        stats = TransferStats()
+        es = es_client_for(stub_es, transfer_stats=stats)
+
+        es.bulk(body=BULK_BODY)
+        assert 'content-encoding' not in stub_es.requests_for('POST', '/_bulk')[0]['headers']
+        bulk_stats = stats.stats[TransferStats.BULK]
+        assert bulk_stats['wire_bytes'] == bulk_stats['body_bytes']
+        assert bulk_stats['compress_cpu_seconds'] == 0.0
+
+    def test_report(self):
+        stats = TransferStats()
+        assert stats.report() == 'No requests with a body were sent'
+        stats.record('/_bulk', 1000, 100, 0.002)
+        stats.record('/metax/_search', 50, 50, 0.0)
+        report = stats.report()
+        assert 'bulk requests: 1, request body bytes: 1000, bytes on the wire: 100 (10.0%)' in report
+        assert 'other requests: 1' in report
+
+
+def test_async_service_compresses_requests(stub_es):
+    async def run():
+        async with AsyncElasticSearchService({'HTTP_COMPRESS': True}, base_urls=[stub_es.base_url]) as es_client:
+            model = ESDatasetModel({'identifier': 'cr1', 'description': {'en': 'repetitive text ' * 200}})
+            ok = await es_client.do_bulk_request_for_datasets([model], [])
+            return ok, es_client.transfer_stats
+
+    ok, stats = asyncio.run(run())
+    assert ok
+    assert stub_es.indices['metax']['cr1']['identifier'] == 'cr1'
+    assert stub_es.requests_for('POST', '/_bulk')[0]['headers']['Content-Encoding'] == 'gzip'
+    assert stats.stats[TransferStats.BULK]['wire_bytes'] < stats.stats[TransferStats.BULK]['body_bytes'] / 5
@@ -0,0 +1,68 @@
+# This file is part of the Etsin service
+#
+# Copyright 2017-2021 Ministry of Education and Culture, Finland
+#
+# :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# :license: MIT
+
+from unittest import mock
+
+import pytest
+
+from etsin_finder_search.elastic.service.es_service import ElasticSearchService
+
+
+class TestIndexDefinition:
+    @pytest.mark.parametrize('profile', ElasticSearchService.ANALYZER_PROFILES)
+    def test_profiles_define_the_same_analyzers(self, profile):
+        index_definition = ElasticSearchService.get_index_definition(profile)
+        assert set(index_definition['settings']['analysis']['analyzer']) == \
+            {'etsin_ngram_analyzer', 'etsin_long_ngram_analyzer'}
+        assert index_definition['settings']['index']['number_of_shards'] == 2
+
+    def test_default_profile_uses_ngram_tokenizers(self):
+        tokenizers = ElasticSearchService.get_index_definition('ngram')['settings']['analysis']['tokenizer']
+        assert tokenizers['ngram_tokenizer'] == {'type': 'ngram', 'min_gram': 3, 'max_gram': 15}
+        assert tokenizers['long_ngram_tokenizer'] == {'type': 'ngram', 'min_gram': 3, 'max_gram': 20}
+
+    def test_unknown_profile_falls_back_to_default(self):
+        assert ElasticSearchService.get_index_definition('unknown') == \
+            ElasticSearchService.get_index_definition(ElasticSearchService.DEFAULT_ANALYZER_PROFILE)
+
+
+class TestIndexLayout:
+    def layout(self, expected_doc_count=None, avg_doc_bytes=None, **es_settings):
+        es_service = ElasticSearchService(dict({'HOSTS': ['localhost']}, **es_settings))
+        index_definition = es_service._get_index_definition_with_layout(expected_doc_count, avg_doc_bytes)
+        return index_definition['settings']['index']
+
+    def test_index_definition_values_are_used_when_corpus_size_is_unknown(self):
+        assert self.layout() == {'number_of_shards': 2, 'number_of_replicas': 1}
+
+    def test_shard_count_is_computed_from_corpus_size(self):
+        # 1 000 000 docs * 20 000 bytes * 1.5 ~ 27.9 GB
+        assert self.layout(1000000, 20000)['number_of_shards'] == 2
+        assert self.layout(1000000, 20000, TARGET_SHARD_SIZE_GB=5)['number_of_shards'] == 6
+        assert self.layout(100, 20000)['number_of_shards'] == 1
+
+    def test_config_overrides_computed_layout(self):
+        index_settings = self.layout(1000000, 20000, NUMBER_OF_SHARDS=3, NUMBER_OF_REPLICAS=0)
+        assert index_settings == {'number_of_shards': 3, 'number_of_replicas': 0}
+
+    def test_document_size_is_estimated_only_when_needed(self):
+        estimate = mock.Mock(return_value=20000)
+        assert self.layout(1000000, estimate, NUMBER_OF_SHARDS=3)['number_of_shards'] == 3
+        assert self.layout(None, estimate)['number_of_shards'] == 2
+        estimate.assert_not_called()
+
+        assert self.layout(1000000, estimate, TARGET_SHARD_SIZE_GB=5)['number_of_shards'] == 6
+        estimate.assert_called_once_with()
+
+    def test_document_size_is_not_estimated_for_existing_index(self):
+        es_service = ElasticSearchService({'HOSTS': ['localhost']})
+        es_service.es = mock.Mock()
+        es_service.es.indices.exists.return_value = True
+        estimate = mock.Mock(return_value=20000)
+
+        assert es_service.ensure_index_existence(1000000, estimate)
+        estimate.assert_not_called()
@@ -0,0 +1,49 @@
+# This file is part of the Etsin service
+#
+# Copyright 2017-2021 Ministry of Education and Culture, Finland
+#
+# :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# :license: MIT
+
+from etsin_finder_search.rabbitmq.event_journal import EventJournal, JournalEntry
+
+
+class TestEventJournal:
+    def test_entries_are_read_back_in_order(self, tmp_path):
+        journal = EventJournal(str(tmp_path))
+        assert journal.is_empty()
+        journal.append('update', 'cr1', b'{"identifier": "cr1"}\n')
+        journal.append('delete', None, b'not json')
+
+        segments = journal.sealed_segments()
+        assert len(segments) == 1
+        assert journal.read_segment(segments[0]) == [
+            JournalEntry('update', 'cr1', b'{"identifier": "cr1"}\n'), JournalEntry('delete', None, b'not json')]
+
+        journal.remove_segment(segments[0])
+        assert journal.is_empty()
+        assert list(tmp_path.iterdir()) == []
+
+    def test_segments_are_rotated_and_survive_restart(self, tmp_path):
+        journal = EventJournal(str(tmp_path), segment_max_bytes=100)
+        for i in range(4):
+            journal.append('update', 'cr{0}'.format(i), b'x' * 60)
+        journal.close()
+
+        reopened = EventJournal(str(tmp_path))
+        segments = reopened.sealed_segments()
+        assert len(segments) == 4
+        reopened.append('create', 'cr4', b'y')
+        assert reopened.sealed_segments()[:4] == segments
+        assert [entry.identifier for segment in reopened.sealed_segments()
+                for entry in reopened.read_segment(segment)] == ['cr0', 'cr1', 'cr2', 'cr3', 'cr4']
+
+    def test_partially_written_entry_is_ignored(self, tmp_path):
+        journal = EventJournal(str(tmp_path))
+        journal.append('update', 'cr1', b'complete')
+        journal.append('update', 'cr2', b'partial')
+        segment = journal.sealed_segments()[0]
+        path = tmp_path / segment
+        path.write_bytes(path.read_bytes()[:-4])
+
+        assert journal.read_segment(segment) == [JournalEntry('update', 'cr1', b'complete')]
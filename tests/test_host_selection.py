@@ -0,0 +1,61 @@
+# This file is part of the Etsin service
+#
+# Copyright 2017-2021 Ministry of Education and Culture, Finland
+#
+# :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# :license: MIT
+
+import random
+
+from etsin_finder_search.rabbitmq.host_selection import HostSelector
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestHostSelector:
+    def make_selector(self, hosts=('a', 'b', 'c')):
+        self.clock = FakeClock()
+        return HostSelector(list(hosts), initial_backoff=0.5, max_backoff=30, clock=self.clock, rng=random.Random(1))
+
+    def test_failed_host_is_avoided_until_its_backoff_passes(self):
+        selector = self.make_selector(('a', 'b'))
+        selector.record_failure('a')
+        assert all(selector.choose() == ('b', 0.0) for _ in range(10))
+
+        self.clock.now += 0.5
+        selector.record_failure('b')
+        assert selector.choose() == ('a', 0.0)
+
+    def test_backoff_grows_exponentially_with_jitter_up_to_the_limit(self):
+        selector = self.make_selector()
+        for attempt, delay in [(1, 0.5), (2, 1.0), (3, 2.0), (10, 30.0), (5000, 30.0)]:
+            backoff = selector.backoff(attempt)
+            assert delay / 2 <= backoff <= delay
+
+    def test_healthier_and_faster_hosts_are_preferred(self):
+        selector = self.make_selector()
+        selector.record_success('a', 0.2)
+        selector.record_success('b', 0.05)
+        selector.record_failure('c')
+        self.clock.now += 60
+        selector.record_success('c', 0.01)
+        assert selector.choose() == ('b', 0.0)
+
+        selector.record_failure('b')
+        assert selector.choose() == ('a', 0.0)
+
+    def test_waits_for_the_host_available_soonest_when_all_have_failed(self):
+        selector = self.make_selector(('a', 'b'))
+        selector.record_failure('a')
+        selector.record_failure('a')
+        selector.record_failure('b')
+        host, wait = selector.choose()
+        assert host == 'b'
+        assert 0.25 <= wait <= 0.5
@@ -0,0 +1,73 @@
+# This file is part of the Etsin service
+#
+# Copyright 2017-2021 Ministry of Education and Culture, Finland
+#
+# :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# :license: MIT
+
+import pytest
+
+from etsin_finder_search.catalog_record_converter import CRConverter
+from etsin_finder_search.indexing_policy import DELETE, INDEX, SKIP, IndexingPolicy
+from etsin_finder_search.rabbitmq.rabbitmq_client import ReceivedMessage
+from etsin_finder_search.utils import catalog_record_should_be_indexed
+from .helpers import get_test_object_from_file
+from .rabbitmq_fakes import make_consumer
+
+PAS_CATALOG = {'identifier': 'urn:nbn:fi:att:data-catalog-pas'}
+
+
+@pytest.fixture
+def cr():
+    return get_test_object_from_file('metax_catalog_record.json')
+
+
+@pytest.mark.parametrize('changes, action, reason', [
+    ({}, INDEX, 'indexed'),
+    ({'deprecated': True}, DELETE, 'deprecated'),
+    ({'deprecated': True, 'state': 'draft'}, DELETE, 'deprecated'),
+    ({'preservation_dataset_origin_version': {'identifier': 'cr-0'}}, DELETE, 'pas_origin_version'),
+    ({'data_catalog': PAS_CATALOG, 'preservation_state': 80}, DELETE, 'pas_not_preserved'),
+    ({'data_catalog': PAS_CATALOG, 'preservation_state': 120}, INDEX, 'indexed'),
+    ({'data_catalog': {}}, SKIP, 'no_data_catalog'),
+    ({'data_catalog': {'identifier': 'urn:nbn:fi:att:data-catalog-legacy'}}, SKIP, 'legacy_catalog'),
+    ({'state': 'draft'}, SKIP, 'not_published'),
+])
+def test_records_are_classified_by_the_first_matching_rule(cr, changes, action, reason):
+    record = dict(cr, **changes)
+    decision = IndexingPolicy().classify(record)
+
+    assert (decision.identifier, decision.action, decision.reason) == (cr['identifier'], action, reason)
+    if action != DELETE:
+        assert (action == INDEX) == catalog_record_should_be_indexed(record)
+
+
+def test_decisions_of_a_batch_are_counted(cr):
+    policy = IndexingPolicy()
+    classified = policy.classify_many([cr, dict(cr, state='draft'), None, dict(cr, identifier='cr-2')])
+
+    assert [decision.action for _, decision in classified] == [INDEX, SKIP, SKIP, INDEX]
+    assert classified[1][0]['state'] == 'draft'
+    assert policy.counts == {(INDEX, 'indexed'): 2, (SKIP, 'not_published'): 1, (SKIP, 'no_record'): 1}
+    assert policy.report() == "Indexing decisions: 2 index (indexed), 1 skip (not_published), 1 skip (no_record)"
+
+
+def test_convert_many_uses_decisions_made_earlier(cr):
+    policy = IndexingPolicy()
+    classified = policy.classify_many([cr, dict(cr, deprecated=True)])
+    converter = CRConverter(policy=policy)
+    results = list(converter.convert_many([record for record, _ in classified],
+                                          [decision for _, decision in classified]))
+
+    assert [result.action for result in results] == [INDEX, DELETE]
+    assert sum(policy.counts.values()) == 2
+
+
+def test_consumer_deletes_records_by_the_policy(cr):
+    consumer = make_consumer()
+    consumer._convert_to_es_doc_and_reindex(consumer.channel, ReceivedMessage('update', 1, None, b''),
+                                            dict(cr, identifier='cr1', data_catalog=PAS_CATALOG))
+
+    assert consumer.es_client.deleted == ['cr1']
+    assert consumer.channel.acks == [(1, False)]
+    assert consumer.converter.policy.counts == {(DELETE, 'pas_not_preserved'): 1}
@@ -0,0 +1,62 @@
+# This file is part of the Etsin service
+#
+# Copyright 2017-2021 Ministry of Education and Culture, Finland
+#
+# :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# :license: MIT
+
+import asyncio
+import socket
+from unittest import mock
+from urllib.request import urlopen
+
+import pytest
+from prometheus_client import REGISTRY
+
+from etsin_finder_search import metrics
+from etsin_finder_search.metrics import es_operation
+
+
+def _sample(name, **labels):
+    return REGISTRY.get_sample_value(name, labels) or 0
+
+
+class TestMetrics:
+    def test_es_operations_are_recorded_by_outcome(self):
+        @es_operation('test_sync')
+        def sync_operation(result):
+            return result
+
+        @es_operation('test_async')
+        async def async_operation():
+            raise ValueError('failed')
+
+        sync_operation(True)
+        sync_operation([True, False])
+        with pytest.raises(ValueError):
+            asyncio.run(async_operation())
+
+        assert _sample('etsin_es_operations_total', operation='test_sync', outcome='ok') == 1
+        assert _sample('etsin_es_operations_total', operation='test_sync', outcome='error') == 1
+        assert _sample('etsin_es_operations_total', operation='test_async', outcome='error') == 1
+        assert _sample('etsin_es_operation_last_success_timestamp_seconds', operation='test_sync') > 0
+        assert _sample('etsin_es_operation_duration_seconds_count', operation='test_async') == 1
+
+    def test_metrics_are_served_when_configured(self):
+        with socket.socket() as free_socket:
+            free_socket.bind(('127.0.0.1', 0))
+            port = free_socket.getsockname()[1]
+
+        metrics.CONSUMER_MESSAGES.labels('test').inc()
+        with mock.patch.object(metrics, 'get_metrics_config', return_value={'CONSUMER_PORT': port,
+                                                                            'ADDRESS': '127.0.0.1'}):
+            assert not metrics.start_metrics_server_if_configured('REINDEXER_PORT')
+            try:
+                assert metrics.start_metrics_server_if_configured('CONSUMER_PORT') and metrics.is_serving()
+            finally:
+                # Consumers built by the other tests would start updating the queue metrics
+                metrics._serving = False
+
+        with urlopen('http://127.0.0.1:{0}/metrics'.format(port)) as response:
+            assert response.headers['Content-Type'].startswith('text/plain')
+            assert 'etsin_consumer_messages_total{callback_type="test"} 1.0' in response.read().decode('utf-8')
@@ -0,0 +1,161 @@
+# This file is part of the Etsin service
+#
+# Copyright 2017-2021 Ministry of Education and Culture, Finland
+#
+# :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# :license: MIT
+
+import copy
+import json
+from unittest import mock
+
+import pytest
+
+from etsin_finder_search.catalog_record_converter import CRConverter
+from etsin_finder_search.elastic.domain.es_dataset_data_model import ESDatasetModel
+from etsin_finder_search.elastic.service.es_service import ElasticSearchService
+from etsin_finder_search.partial_updates import FIELD_GROUPS, FINGERPRINT_FIELD, OTHER_GROUP, PartialUpdates, \
+    get_fingerprints
+from .helpers import get_test_object_from_file
+from .rabbitmq_fakes import make_consumer, message_body, method
+
+
+@pytest.fixture
+def document():
+    return CRConverter().convert_metax_cr_json_to_es_data_model(get_test_object_from_file('metax_catalog_record.json'))
+
+
+def _prepare(document, stored_document, **options):
+    partial_updates = PartialUpdates(True, **options)
+    stored = {}
+    if stored_document is not None:
+        stored[document['identifier']] = get_fingerprints(stored_document)
+    dataset_model = ESDatasetModel(copy.deepcopy(document))
+    partial_updates.prepare([dataset_model], stored)
+    return dataset_model, partial_updates
+
+
+class TestPartialUpdates:
+
+    def test_fingerprints_follow_the_field_groups(self, document):
+        changed = dict(document, preservation_state=120)
+        fingerprints, changed_fingerprints = get_fingerprints(document), get_fingerprints(changed)
+        assert [group for group in list(FIELD_GROUPS) + [OTHER_GROUP]
+                if fingerprints[group] != changed_fingerprints[group]] == ['state']
+
+    def test_small_changes_are_sent_as_partial_updates(self, document):
+        document['preservation_state'] = 120
+        stored_document = dict(document, preservation_state=10)
+        dataset_model, partial_updates = _prepare(document, stored_document)
+
+        assert dataset_model.partial
+        assert dataset_model.get_es_document_id() == document['identifier']
+        assert set(dataset_model.doc_obj) == {'identifier', 'preservation_state', 'date_modified', 'data_catalog',
+                                              'data_catalog_identifier', FINGERPRINT_FIELD}
+        assert dataset_model.doc_obj[FINGERPRINT_FIELD] == get_fingerprints(document)
+        assert partial_updates.partial_updates == 1
+        assert partial_updates.bytes_saved == \
+            len(json.dumps(dict(document, **{FINGERPRINT_FIELD: get_fingerprints(document)}))) - \
+            len(dataset_model.to_es_document_string())
+
+    def test_fields_left_out_of_both_documents_do_not_prevent_partial_updates(self, document):
+        # The converter leaves out e.g. preservation_state 0
+        assert 'preservation_state' not in document
+        stored_document = dict(document, date_modified='2019-01-01T00:00:00+02:00')
+        dataset_model, _ = _prepare(document, stored_document)
+
+        assert dataset_model.partial
+        assert dataset_model.doc_obj['date_modified'] == document['date_modified']
+        assert 'title' not in dataset_model.doc_obj
+
+    def test_removed_object_keys_are_indexed_whole(self, document):
+        changed = copy.deepcopy(document)
+        changed['title'].pop(next(iter(changed['title'])))
+        dataset_model, _ = _prepare(changed, document)
+        assert not dataset_model.partial
+
+    def test_unchanged_documents_are_sent_as_empty_updates(self, document):
+        dataset_model, _ = _prepare(document, document)
+        assert dataset_model.partial
+        assert list(dataset_model.doc_obj) == ['identifier', FINGERPRINT_FIELD]
+
+    @pytest.mark.parametrize('stored_changes', [None, {'access_rights': {}, 'other_identifier': [], 'theme': [],
+                                                      'rights_holder': [], 'contributor': [], 'publisher': []}])
+    def test_new_documents_and_large_changes_are_indexed_whole(self, document, stored_changes):
+        stored_document = None if stored_changes is None else dict(document, **stored_changes)
+        dataset_model, partial_updates = _prepare(document, stored_document)
+
+        assert not dataset_model.partial
+        assert dataset_model.doc_obj == dict(document, **{FINGERPRINT_FIELD: get_fingerprints(document)})
+        assert partial_updates.full_documents == 1
+
+    def test_removed_fields_are_indexed_whole(self, document):
+        changed = dict(document)
+        del changed['curator']
+        dataset_model, _ = _prepare(changed, document)
+        assert not dataset_model.partial
+
+    def test_disabled_partial_updates_leave_documents_unchanged(self, document):
+        dataset_model = ESDatasetModel(copy.deepcopy(document))
+        PartialUpdates().prepare([dataset_model], {document['identifier']: get_fingerprints(document)})
+        assert dataset_model.doc_obj == document
+
+    @pytest.mark.parametrize('es_settings, field_fingerprints, mapped', [
+        ({'PARTIAL_UPDATES': True}, False, True),
+        ({}, True, True),
+        ({}, False, False),
+    ])
+    def test_fingerprints_are_mapped_into_existing_indexes(self, es_settings, field_fingerprints, mapped):
+        es_service = ElasticSearchService(dict(es_settings, HOSTS=['localhost']), field_fingerprints)
+        es_service.es = mock.Mock()
+        es_service.es.indices.exists.return_value = True
+        es_service.es.indices.put_mapping.return_value = {'acknowledged': True}
+
+        assert es_service.ensure_index_existence() and es_service.ensure_index_existence()
+        if mapped:
+            es_service.es.indices.put_mapping.assert_called_once_with(
+                index='metax', doc_type='dataset',
+                body={'properties': {FINGERPRINT_FIELD: {'type': 'object', 'enabled': False}}})
+        else:
+            es_service.es.indices.put_mapping.assert_not_called()
+
+    def test_partial_updates_are_update_rows(self):
+        row = ElasticSearchService({'HOSTS': ['localhost']})._create_bulk_update_row(
+            ESDatasetModel({'identifier': 'cr-1', 'preservation_state': 120}, partial=True))
+        action, body = row.split('\n')
+        assert json.loads(action) == {'update': {'_index': 'metax', '_type': 'dataset', '_id': 'cr-1'}}
+        assert json.loads(body) == {'doc': {'identifier': 'cr-1', 'preservation_state': 120}}
+
+
+def test_consumer_sends_partial_updates_of_indexed_documents():
+    cr = get_test_object_from_file('metax_catalog_record.json')
+    consumer = make_consumer(BATCH_SIZE=1)
+    consumer.partial_updates = PartialUpdates(True)
+
+    consumer._on_batched_message('update', consumer.channel, method(1), None, message_body(cr))
+    consumer._on_batched_message('update', consumer.channel, method(2), None,
+                                 message_body(cr, preservation_state=10))
+
+    first, second = [actions[0][1] for actions in consumer.es_client.bulk_requests]
+    assert not first.partial
+    assert second.partial and second.doc_obj['preservation_state'] == 10
+    expected = CRConverter().convert_metax_cr_json_to_es_data_model(dict(cr, preservation_state=10))
+    expected[FINGERPRINT_FIELD] = get_fingerprints(expected)
+    assert consumer.es_client.documents[cr['identifier']] == expected
+    assert consumer.partial_updates.bytes_saved > 0
+    assert consumer.channel.acks == [(1, True), (2, True)]
+
+
+def test_consumer_indexes_documents_with_removed_object_keys_whole():
+    cr = get_test_object_from_file('metax_catalog_record.json')
+    consumer = make_consumer(BATCH_SIZE=1)
+    consumer.partial_updates = PartialUpdates(True)
+    cr['research_dataset']['title'] = {'en': 'Wonderful Title', 'fi': 'Upea otsikko'}
+    changed = dict(cr, research_dataset=dict(cr['research_dataset'], title={'en': 'Wonderful Title'}))
+
+    consumer._on_batched_message('update', consumer.channel, method(1), None, message_body(cr))
+    consumer._on_batched_message('update', consumer.channel, method(2), None, message_body(changed))
+
+    expected = CRConverter().convert_metax_cr_json_to_es_data_model(changed)
+    expected[FINGERPRINT_FIELD] = get_fingerprints(expected)
+    assert consumer.es_client.documents[cr['identifier']] == expected
@@ -0,0 +1,489 @@
+# This file is part of the Etsin service
+#
+# Copyright 2017-2021 Ministry of Education and Culture, Finland
+#
+# :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# :license: MIT
+
+from functools import partial
+from unittest import mock
+
+import pika
+import pytest
+
+from etsin_finder_search.indexing_policy import INDEX, INDEXED
+from etsin_finder_search.rabbitmq import rabbitmq_client
+from etsin_finder_search.rabbitmq.async_consumer import AsyncMetaxConsumer
+from etsin_finder_search.rabbitmq import dead_letter_replay
+from etsin_finder_search.rabbitmq.dead_letter_replay import replay_all_dead_letters, replay_dead_letters
+from etsin_finder_search.rabbitmq.event_journal import EventJournal
+from etsin_finder_search.rabbitmq.rabbitmq_client import RETRY_COUNT_HEADER, MetaxConsumer, ReceivedMessage
+from etsin_finder_search.rabbitmq.recent_documents import RecentDocuments
+from .helpers import get_test_object_from_file, wait_until
+from .rabbitmq_fakes import FakeChannel, FakeConnection, FakeESClient, FakeMetaxAPI, make_consumer, message_body, method
+
+
+@pytest.fixture
+def cr():
+    return get_test_object_from_file('metax_catalog_record.json')
+
+
+class TestOptionValidation:
+    @pytest.mark.parametrize('consumer_class, rabbit_settings', [
+        (MetaxConsumer, {'BATCH_SIZE': 10, 'WORKERS': 2}),
+        (MetaxConsumer, {'COALESCE_EVENTS': True}),
+        (MetaxConsumer, {'WORKERS': 2, 'JOURNAL_DIR': '/tmp/journal'}),
+        (MetaxConsumer, {'WORKERS': 2, 'FLOOD_THRESHOLD': 100}),
+        (AsyncMetaxConsumer, {'BATCH_SIZE': 10}),
+        (AsyncMetaxConsumer, {'WORKERS': 2}),
+        (AsyncMetaxConsumer, {'JOURNAL_DIR': '/tmp/journal'}),
+    ])
+    def test_incompatible_options_fail_initialization(self, consumer_class, rabbit_settings):
+        consumer = consumer_class(dict(rabbit_settings, HOSTS=['localhost']), {'HOSTS': ['localhost']})
+        assert not consumer.init_ok
+
+    def test_compatible_options_are_accepted(self):
+        assert make_consumer(BATCH_SIZE=10, COALESCE_EVENTS=True, JOURNAL_DIR=None, FLOOD_THRESHOLD=100).init_ok
+        assert make_consumer(None, AsyncMetaxConsumer, WORKERS=1).init_ok
+
+
+class TestBatchedConsumption:
+    def test_full_batch_is_written_with_one_bulk_request(self, cr):
+        consumer = make_consumer(BATCH_SIZE=3)
+        consumer._on_batched_message('create', consumer.channel, method(1), None, message_body(cr, identifier='cr1'))
+        consumer._on_batched_message('update', consumer.channel, method(2), None, message_body(cr, identifier='cr2'))
+        assert consumer.es_client.bulk_requests == []
+        assert len(consumer.connection.timers) == 1
+
+        consumer._on_batched_message('delete', consumer.channel, method(3), None, message_body(cr, identifier='cr3'))
+        assert len(consumer.es_client.bulk_requests) == 1
+        assert consumer.es_client.indexed == ['cr1', 'cr2']
+        assert consumer.es_client.deleted == ['cr3']
+        assert consumer.channel.acks == [(3, True)]
+        assert consumer.channel.nacks == []
+        assert consumer.connection.timers == {}
+
+    def test_partial_batch_is_flushed_by_timer(self, cr):
+        consumer = make_consumer(BATCH_SIZE=10, BATCH_MAX_WAIT_MS=50)
+        consumer._on_batched_message('update', consumer.channel, method(1), None, message_body(cr, identifier='cr1'))
+        assert consumer.connection.timers[1][0] == 0.05
+
+        consumer.connection.fire_timers()
+        assert consumer.es_client.indexed == ['cr1']
+        assert consumer.channel.acks == [(1, True)]
+
+    def test_only_failed_messages_are_nacked(self, cr):
+        consumer = make_consumer(FakeESClient(failing_ids=['cr2']), BATCH_SIZE=4)
+        consumer._on_batched_message('update', consumer.channel, method(1), None, message_body(cr, identifier='cr1'))
+        consumer._on_batched_message('update', consumer.channel, method(2), None, message_body(cr, identifier='cr2'))
+        consumer._on_batched_message('update', consumer.channel, method(3), None, b'not json')
+        consumer._on_batched_message('update', consumer.channel, method(4), None, message_body(cr, identifier='cr4'))
+
+        assert consumer.channel.nacks == [(2, False), (3, False)]
+        assert consumer.channel.acks == [(4, True)]
+
+    def test_deprecated_and_pas_records_are_deleted(self, cr):
+        consumer = make_consumer(BATCH_SIZE=2)
+        consumer._on_batched_message('update', consumer.channel, method(1), None,
+                                     message_body(cr, identifier='cr1', deprecated=True))
+        consumer._on_batched_message('create', consumer.channel, method(2), None,
+                                     message_body(cr, identifier='cr2', preservation_dataset_origin_version={'id': 1}))
+        assert consumer.es_client.deleted == ['cr1', 'cr2']
+        assert consumer.es_client.indexed == []
+        assert consumer.channel.acks == [(2, True)]
+
+    def test_failing_previous_version_delete_does_not_fail_create(self, cr):
+        consumer = make_consumer(FakeESClient(failing_ids=['cr0']), BATCH_SIZE=1)
+        consumer._on_batched_message('create', consumer.channel, method(1), None,
+                                     message_body(cr, identifier='cr1', previous_dataset_version={'identifier': 'cr0'}))
+        assert consumer.es_client.indexed == ['cr1']
+        assert consumer.channel.acks == [(1, True)]
+        assert consumer.channel.nacks == []
+
+
+class TestEventCoalescing:
+    def consume(self, consumer, events):
+        for delivery_tag, (callback_type, body) in enumerate(events, start=1):
+            consumer._on_batched_message(callback_type, consumer.channel, method(delivery_tag), None, body)
+
+    def test_last_update_wins(self, cr):
+        consumer = make_consumer(BATCH_SIZE=4, COALESCE_EVENTS=True)
+        self.consume(consumer, [
+            ('update', message_body(cr, identifier='cr1', preservation_state=10)),
+            ('update', message_body(cr, identifier='cr2')),
+            ('update', message_body(cr, identifier='cr1', preservation_state=20)),
+            ('update', message_body(cr, identifier='cr1', preservation_state=30)),
+        ])
+
+        actions = consumer.es_client.bulk_requests[0]
+        assert [payload.get_es_document_id() for _, payload in actions] == ['cr2', 'cr1']
+        assert actions[1][1].doc_obj['preservation_state'] == 30
+        assert consumer.channel.acks == [(4, True)]
+        assert consumer.coalesced_writes_saved == 2
+
+    def test_delete_takes_priority(self, cr):
+        consumer = make_consumer(BATCH_SIZE=3, COALESCE_EVENTS=True)
+        self.consume(consumer, [
+            ('update', message_body(cr, identifier='cr1')),
+            ('delete', message_body(cr, identifier='cr1')),
+            ('update', message_body(cr, identifier='cr1')),
+        ])
+
+        assert consumer.es_client.bulk_requests == [[('delete', 'cr1')]]
+        assert consumer.channel.acks == [(3, True)]
+
+    def test_superseded_deliveries_fail_with_the_surviving_write(self, cr):
+        consumer = make_consumer(FakeESClient(failing_ids=['cr1']), BATCH_SIZE=3, COALESCE_EVENTS=True)
+        self.consume(consumer, [
+            ('update', message_body(cr, identifier='cr1')),
+            ('update', message_body(cr, identifier='cr2')),
+            ('update', message_body(cr, identifier='cr1')),
+        ])
+
+        assert consumer.channel.nacks == [(1, False), (3, False)]
+        assert consumer.channel.acks == [(2, True)]
+
+    def test_superseded_create_still_deletes_previous_version(self, cr):
+        consumer = make_consumer(BATCH_SIZE=2, COALESCE_EVENTS=True)
+        self.consume(consumer, [
+            ('create', message_body(cr, identifier='cr1', previous_dataset_version={'identifier': 'cr0'})),
+            ('update', message_body(cr, identifier='cr1')),
+        ])
+
+        assert consumer.es_client.deleted == ['cr0']
+        assert consumer.es_client.indexed == ['cr1']
+
+
+class TestSkippedRecords:
+    def test_skipped_records_are_acked_in_batches(self, cr):
+        consumer = make_consumer(BATCH_SIZE=1)
+        consumer._on_batched_message('update', consumer.channel, method(1), None,
+                                     message_body(cr, identifier='cr1', state='draft'))
+
+        assert consumer.es_client.indexed == []
+        assert consumer.channel.acks == [(1, True)]
+        assert consumer.channel.nacks == []
+
+    def test_skipped_records_are_acked_one_by_one(self, cr):
+        consumer = make_consumer()
+        consumer._convert_to_es_doc_and_reindex(consumer.channel, ReceivedMessage('update', 1, None, b''),
+                                                dict(cr, identifier='cr1', state='draft'))
+
+        assert consumer.es_client.indexed == []
+        assert consumer.channel.acks == [(1, False)]
+        assert consumer.channel.nacks == []
+        assert consumer.event_processing_completed
+
+
+class TestUnchangedDocuments:
+    def test_unchanged_documents_are_acked_without_writing(self, cr):
+        consumer = make_consumer(BATCH_SIZE=1, SKIP_UNCHANGED_DOCUMENTS=True)
+        consumer._on_batched_message('update', consumer.channel, method(1), None, message_body(cr, identifier='cr1'))
+        consumer._on_batched_message('update', consumer.channel, method(2), None, message_body(cr, identifier='cr1'))
+        consumer._on_batched_message('update', consumer.channel, method(3), None,
+                                     message_body(cr, identifier='cr1', preservation_state=10))
+
+        assert consumer.es_client.indexed == ['cr1', 'cr1']
+        assert consumer.channel.acks == [(1, True), (2, True), (3, True)]
+        assert consumer.recent_documents.hits == 2
+
+    def test_cache_misses_are_compared_with_the_index(self, cr):
+        es_client = FakeESClient()
+        writer = make_consumer(es_client, BATCH_SIZE=1, SKIP_UNCHANGED_DOCUMENTS=True)
+        writer._on_batched_message('update', writer.channel, method(1), None, message_body(cr, identifier='cr1'))
+
+        consumer = make_consumer(es_client, SKIP_UNCHANGED_DOCUMENTS=True)
+        consumer._convert_to_es_doc_and_reindex(consumer.channel, ReceivedMessage('update', 1, None, b''),
+                                                dict(cr, identifier='cr1'))
+
+        assert es_client.indexed == ['cr1']
+        assert consumer.channel.acks == [(1, False)]
+        assert consumer.recent_documents.misses == 1
+
+    def test_deleted_and_failed_documents_are_written_again(self, cr):
+        consumer = make_consumer(FakeESClient(failing_ids=['cr2']), BATCH_SIZE=1, SKIP_UNCHANGED_DOCUMENTS=True)
+        for delivery_tag, (callback_type, identifier) in enumerate(
+                [('update', 'cr1'), ('delete', 'cr1'), ('create', 'cr1'), ('update', 'cr2')], start=1):
+            consumer._on_batched_message(callback_type, consumer.channel, method(delivery_tag), None,
+                                         message_body(cr, identifier=identifier))
+
+        assert consumer.es_client.indexed == ['cr1', 'cr1']
+        assert consumer.recent_documents.get('cr2') is None
+
+    def test_least_recently_used_digests_are_evicted(self):
+        recent_documents = RecentDocuments(max_size=2)
+        recent_documents.put('cr1', 'a')
+        recent_documents.put('cr2', 'b')
+        assert recent_documents.get('cr1') == 'a'
+        recent_documents.put('cr3', 'c')
+
+        assert recent_documents.get('cr2') is None
+        assert (len(recent_documents), recent_documents.evictions) == (2, 1)
+
+
+class TestWorkerMode:
+    def test_events_are_processed_by_workers_and_acked_on_connection_thread(self, cr):
+        consumer = make_consumer(FakeESClient(failing_ids=['cr3']), WORKERS=3)
+
+        for delivery_tag in range(1, 5):
+            consumer._dispatch_to_worker('update', consumer.channel, method(delivery_tag), None,
+                                         message_body(cr, identifier='cr{0}'.format(delivery_tag)))
+
+        assert wait_until(consumer.processing_completed)
+        assert consumer.channel.acks == []
+        consumer.wait_for_processing(0)
+        assert sorted(consumer.channel.acks) == [(1, False), (2, False), (4, False)]
+        assert consumer.channel.nacks == [(3, False)]
+        assert sorted(consumer.es_client.indexed) == ['cr1', 'cr2', 'cr4']
+
+        consumer.worker_pool.stop()
+        assert wait_until(consumer.worker_pool.stopped)
+
+    def test_each_worker_converts_with_its_own_interner(self, cr):
+        consumer = make_consumer(WORKERS=2)
+        identifiers = ['cr{0}'.format(delivery_tag) for delivery_tag in range(1, 7)]
+        for delivery_tag, identifier in enumerate(identifiers, start=1):
+            consumer._dispatch_to_worker('update', consumer.channel, method(delivery_tag), None,
+                                         message_body(cr, identifier=identifier))
+
+        assert wait_until(consumer.processing_completed)
+        used_workers = sorted(set(consumer.worker_pool.worker_index(identifier) for identifier in identifiers))
+        assert [index for index, converter in enumerate(consumer.worker_converters)
+                if converter.interner.misses] == used_workers
+        assert len(consumer.converter.interner) == 0
+        assert consumer.converter.policy.counts == {(INDEX, INDEXED): 6}
+
+        consumer.worker_pool.stop()
+        assert wait_until(consumer.worker_pool.stopped)
+
+
+class TestRetryAndDeadLetterQueues:
+    def make_consumer(self, es_client=None, **rabbit_settings):
+        return make_consumer(es_client, RETRY_DELAYS_MS=[100, 1000], DEAD_LETTER_QUEUES=True, **rabbit_settings)
+
+    def test_retry_and_dead_letter_queues_are_declared(self):
+        consumer = self.make_consumer()
+        consumer._create_and_bind_queues(False)
+
+        assert consumer.channel.declared['etsin-update-retry-100ms'] == {
+            'x-message-ttl': 100, 'x-dead-letter-exchange': '', 'x-dead-letter-routing-key': 'etsin-update'}
+        assert consumer.channel.declared['etsin-delete-retry-1000ms']['x-message-ttl'] == 1000
+        assert consumer.channel.declared['etsin-create-dead-letter'] == {}
+
+    def test_transient_failures_are_retried_until_dead_lettered(self, cr):
+        consumer = self.make_consumer(FakeESClient(failing_ids=['cr1']))
+        body = message_body(cr, identifier='cr1')
+
+        properties = None
+        for delivery_tag, target_queue in enumerate(
+                ['etsin-update-retry-100ms', 'etsin-update-retry-1000ms', 'etsin-update-dead-letter'], start=1):
+            message = ReceivedMessage('update', delivery_tag, properties, body)
+            consumer._convert_to_es_doc_and_reindex(consumer.channel, message, dict(cr, identifier='cr1'))
+            properties, published_body = consumer.channel.queues[target_queue].pop()
+            assert published_body == body
+            assert properties.delivery_mode == 2
+
+        assert properties.headers[RETRY_COUNT_HEADER] == 2
+        assert consumer.channel.acks == [(1, False), (2, False), (3, False)]
+        assert consumer.channel.nacks == []
+
+    def test_unprocessable_messages_are_dead_lettered_without_retries(self, cr):
+        consumer = self.make_consumer(FakeESClient(failing_ids=['cr2']), BATCH_SIZE=3)
+        consumer._on_batched_message('update', consumer.channel, method(1), None, b'not json')
+        consumer._on_batched_message('delete', consumer.channel, method(2), None, message_body(cr, identifier='cr2'))
+        consumer._on_batched_message('update', consumer.channel, method(3), None, message_body(cr, identifier='cr3'))
+
+        assert [body for _, body in consumer.channel.queues['etsin-update-dead-letter']] == [b'not json']
+        assert len(consumer.channel.queues['etsin-delete-retry-100ms']) == 1
+        assert consumer.channel.acks == [(1, False), (2, False), (3, True)]
+
+    def test_dead_letters_are_replayed_to_their_queue(self, cr):
+        consumer = self.make_consumer()
+        for i in range(3):
+            consumer.channel.queues.setdefault('etsin-update-dead-letter', []).append(
+                (pika.BasicProperties(headers={RETRY_COUNT_HEADER: 2}), message_body(cr, identifier='cr{0}'.format(i))))
+
+        assert replay_dead_letters(consumer.channel, 'etsin-update', limit=2) == 2
+        replayed = consumer.channel.queues['etsin-update']
+        assert [properties.headers for properties, _ in replayed] == [{}, {}]
+        assert len(consumer.channel.queues['etsin-update-dead-letter']) == 1
+        assert len(consumer.channel.acks) == 2
+
+    def test_local_dev_dead_letters_are_replayed_to_the_queues_of_the_consumer(self, cr, tmp_path):
+        queues_file = str(tmp_path / 'rabbitmq_queues.json')
+        consumer = self.make_consumer()
+        with mock.patch.object(rabbitmq_client, 'LOCAL_DEV_QUEUES_FILE', queues_file):
+            assert rabbitmq_client.get_queue_names(True) is None
+            consumer._set_queue_names(True)
+            assert rabbitmq_client.get_queue_names(True) == {
+                'create': consumer.create_queue, 'update': consumer.update_queue, 'delete': consumer.delete_queue}
+            assert consumer.update_queue.startswith('etsin-update-')
+
+            connection = FakeConnection()
+            channel = connection.channel()
+            channel.queues[consumer.update_queue + '-dead-letter'] = [(pika.BasicProperties(), message_body(cr))]
+            connection.channel = lambda: channel
+            with mock.patch.object(dead_letter_replay, 'is_local_dev_environment', return_value=True), \
+                    mock.patch.object(dead_letter_replay, 'get_metax_rabbit_mq_config',
+                                      return_value=consumer.rabbit_settings), \
+                    mock.patch.object(dead_letter_replay.pika, 'BlockingConnection', return_value=connection):
+                assert replay_all_dead_letters(['update']) == {consumer.update_queue: 1}
+
+        assert len(channel.queues[consumer.update_queue]) == 1
+        assert not connection.is_open
+
+
+class TestEventJournaling:
+    def test_events_are_journaled_during_outage_and_replayed(self, cr, tmp_path):
+        consumer = make_consumer(BATCH_SIZE=2)
+        consumer.journal = EventJournal(str(tmp_path))
+        consumer.es_client.available = False
+        batched = partial(consumer._on_batched_message, 'update')
+        consume = consumer._on_message_while_journaling
+
+        consume('update', batched, consumer.channel, method(1), None,
+                message_body(cr, identifier='cr1'))
+        consume('update', batched, consumer.channel, method(2), None,
+                message_body(cr, identifier='cr2'))
+        assert consumer.channel.acks == [(1, False), (2, False)]
+        assert consumer.es_client.bulk_requests == []
+
+        # Elasticsearch is back, but events stay in order behind the journal until it has been replayed
+        consumer.es_client.available = True
+        consume('delete', partial(consumer._on_batched_message, 'delete'), consumer.channel, method(3), None,
+                message_body(cr, identifier='cr1'))
+        consume('update', batched, consumer.channel, method(4), None,
+                message_body(cr, identifier='cr2', research_dataset=dict(cr['research_dataset'], title={'en': 'x'})))
+        assert consumer.channel.acks[2:] == [(3, False), (4, False)]
+        assert consumer.es_client.bulk_requests == []
+
+        consumer.connection.fire_timers()
+        assert consumer.journal.is_empty()
+        assert len(consumer.es_client.bulk_requests) == 1
+        assert consumer.es_client.deleted == ['cr1']
+        assert consumer.es_client.indexed == ['cr2']
+        assert consumer.channel.nacks == []
+
+    def test_replay_waits_for_elasticsearch(self, cr, tmp_path):
+        consumer = make_consumer()
+        consumer.journal = EventJournal(str(tmp_path))
+        consumer.journal.append('update', 'cr1', message_body(cr, identifier='cr1'))
+        consumer.es_client.available = False
+
+        consumer._replay_journal()
+        assert not consumer.journal.is_empty()
+        assert len(consumer.connection.timers) == 1
+
+        consumer.es_client.available = True
+        consumer.connection.fire_timers()
+        assert consumer.journal.is_empty()
+        assert consumer.es_client.indexed == ['cr1']
+
+
+class TestFloodMode:
+    def make_consumer(self, records=None, **rabbit_settings):
+        consumer = make_consumer(FLOOD_THRESHOLD=10, **rabbit_settings)
+        consumer.metax_api = FakeMetaxAPI(records or {})
+        return consumer
+
+    def test_flood_mode_follows_queue_length(self):
+        consumer = self.make_consumer(FLOOD_BATCH_SIZE=50)
+        consumer.channel.queues['etsin-update'] = [(None, b'{}')] * 8
+        consumer.channel.queues['etsin-create'] = [(None, b'{}')] * 2
+        consumer._check_for_flood()
+        assert consumer.flood_mode
+        assert consumer.channel.qos == 50
+
+        # Stays in flood mode until the queues are down to a tenth of the threshold
+        consumer.channel.queues['etsin-update'] = [(None, b'{}')] * 3
+        consumer._check_for_flood()
+        assert consumer.flood_mode
+
+        consumer.channel.queues['etsin-update'] = []
+        consumer.channel.queues['etsin-create'] = [(None, b'{}')]
+        consumer._check_for_flood()
+        assert not consumer.flood_mode
+        assert consumer.channel.qos == 0
+
+    def test_round_writes_current_state_from_metax(self, cr):
+        title = {'en': 'Title in Metax'}
+        consumer = self.make_consumer(
+            {'cr1': dict(cr, identifier='cr1', research_dataset=dict(cr['research_dataset'], title=title)),
+             'cr2': dict(cr, identifier='cr2')},
+            FLOOD_BATCH_SIZE=4)
+        consumer.flood_mode = True
+        consume = partial(consumer._on_message_in_flood_mode, 'update', None, consumer.channel)
+
+        consume(method(1), None, message_body(cr, identifier='cr1'))
+        consume(method(2), None, message_body(cr, identifier='cr2'))
+        consume(method(3), None, message_body(cr, identifier='cr1'))
+        consume(method(4), None, message_body(cr, identifier='cr3'))
+
+        assert consumer.metax_api.requested == [['cr2', 'cr1', 'cr3']]
+        assert len(consumer.es_client.bulk_requests) == 1
+        assert consumer.es_client.indexed == ['cr2', 'cr1']
+        assert consumer.es_client.deleted == ['cr3']
+        indexed_cr1 = [payload for action, payload in consumer.es_client.bulk_requests[0]
+                       if action == 'index' and payload.get_es_document_id() == 'cr1'][0]
+        assert indexed_cr1.doc_obj['title'] == title
+        assert consumer.channel.acks == [(4, True)]
+
+    def test_records_already_fetched_during_flood_are_skipped(self, cr):
+        consumer = self.make_consumer({'cr1': dict(cr, identifier='cr1')}, FLOOD_BATCH_SIZE=2)
+        consumer.flood_mode = True
+        consume = partial(consumer._on_message_in_flood_mode, 'update', None, consumer.channel)
+
+        consume(method(1), None, message_body(cr, identifier='cr1'))
+        consume(method(2), None, message_body(cr, identifier='cr1'))
+        consume(method(3), None, message_body(cr, identifier='cr1'))
+        consumer.connection.fire_timers()
+
+        assert consumer.metax_api.requested == [['cr1']]
+        assert consumer.es_client.indexed == ['cr1']
+        assert consumer.channel.acks == [(2, True), (3, True)]
+
+
+class TestConnectionFailover:
+    def test_connects_to_the_next_host_when_one_is_down(self, monkeypatch):
+        consumer = make_consumer(HOSTS=['down', 'up'])
+        successes = consumer.host_selector.health['up'].successes
+        attempts = []
+
+        def connect(parameters):
+            attempts.append(parameters.host)
+            if parameters.host == 'down':
+                raise pika.exceptions.AMQPConnectionError('connection refused')
+            connection = FakeConnection()
+            connection.channel = FakeChannel
+            return connection
+
+        monkeypatch.setattr(rabbitmq_client.pika, 'BlockingConnection', connect)
+        monkeypatch.setattr(rabbitmq_client, 'sleep', lambda seconds: None)
+        for _ in range(5):
+            assert consumer._setup_connection()
+            assert consumer.host == 'up'
+
+        assert attempts.count('down') <= 1
+        assert consumer.host_selector.health['up'].successes == successes + 5
+
+    def test_consuming_continues_after_lost_connection(self, cr):
+        consumer = make_consumer(BATCH_SIZE=10)
+        consumer._on_batched_message('update', consumer.channel, method(1), None, message_body(cr, identifier='cr1'))
+        connections = []
+
+        def lose_connection():
+            raise pika.exceptions.StreamLostError('connection reset')
+
+        def setup_connection():
+            consumer.channel = FakeChannel()
+            consumer.channel.start_consuming = lose_connection if not connections else lambda: None
+            connections.append(consumer.channel)
+            return True
+
+        consumer._setup_connection = setup_connection
+        consumer._setup_consumers = lambda: True
+        consumer.run()
+
+        assert len(connections) == 2
+        assert consumer.batch == []
+        assert consumer.host_selector.health['localhost'].failures == 1
@@ -0,0 +1,54 @@
+# This file is part of the Etsin service
+#
+# Copyright 2017-2021 Ministry of Education and Culture, Finland
+#
+# :author: CSC - IT Center for Science Ltd., Espoo Finland <servicedesk@csc.fi>
+# :license: MIT
+
+import threading
+
+from etsin_finder_search.rabbitmq.worker_pool import WorkerPool
+from .helpers import wait_until
+
+
+class TestWorkerPool:
+    def test_items_with_same_key_are_handled_in_order_by_one_worker(self):
+        handled = []
+        lock = threading.Lock()
+
+        def handler(item):
+            with lock:
+                handled.append((threading.current_thread().name, item))
+
+        pool = WorkerPool(4, handler, 'test-worker')
+        pool.start()
+        for i in range(50):
+            pool.submit('cr{0}'.format(i % 5), ('cr{0}'.format(i % 5), i))
+
+        assert wait_until(pool.idle)
+        for key_no in range(5):
+            key = 'cr{0}'.format(key_no)
+            items = [(name, item) for name, item in handled if item[0] == key]
+            assert len(set(name for name, _ in items)) == 1
+            assert [item[1] for _, item in items] == sorted(item[1] for _, item in items)
+
+        pool.stop()
+        assert wait_until(pool.stopped)
+
+    def test_worker_index_is_stable(self):
+        pool = WorkerPool(8, None)
+        assert pool.worker_index('cr1') == WorkerPool(8, None).worker_index('cr1')
+
+    def test_stop_discards_waiting_items(self):
+        release = threading.Event()
+        pool = WorkerPool(1, lambda item: release.wait(5))
+        pool.start()
+        for i in range(3):
+            pool.submit('key', i)
+
+        assert wait_until(lambda: pool.queues[0].qsize() == 2)
+        assert pool.stop() == [1, 2]
+        assert not pool.idle()
+        release.set()
+        assert wait_until(pool.stopped)
+        assert pool.idle()